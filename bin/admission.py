@@ -0,0 +1,201 @@
+'''
+This module keeps one client from flooding the node.
+Every client (and, with a bigger budget, every known peer) has a token bucket,
+each endpoint costs a number of tokens, so /nodes/resolve or /mine run out long before /chain does.
+Requests over budget get a 429 from a before_request hook, before their body is parsed or any signature checked.
+A body without a Content-Length (chunked) can't be priced up front, it is charged as it is read instead.
+Heavy calls like consensus are coalesced: requests that arrive while one runs wait for it and share its result.
+
+Neetre 2024
+'''
+
+import threading
+from time import monotonic
+from collections import OrderedDict
+from flask import request, jsonify
+from config import (RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_PEER_RATE, RATE_LIMIT_PEER_BURST,
+                    RATE_LIMIT_COSTS, RATE_LIMIT_COST_PER_KB, RATE_LIMIT_CLIENTS, RATE_LIMIT_ENABLED)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        """
+        :param rate: <float> Tokens added per second
+        :param burst: <float> Most tokens the bucket holds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def take(self, cost):
+        """
+        Take tokens if there are enough
+        :param cost: <float> Tokens needed
+        :return: <float> 0 if taken, else seconds until there will be enough
+        """
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (min(cost, self.burst) - self.tokens) / self.rate
+
+    def spend(self, cost):
+        """
+        Take tokens even if there aren't enough, the debt delays the next requests
+        :param cost: <float> Tokens used
+        """
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - cost
+        self.updated = now
+
+
+class ChargedStream:
+    '''
+    A request body of unknown size, every read is charged to the client
+    '''
+    def __init__(self, stream, charge):
+        """
+        :param stream: File-like body, the WSGI input
+        :param charge: <callable> Takes the number of bytes read
+        """
+        self.stream = stream
+        self.charge = charge
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.charge(len(data))
+        return data
+
+    def readline(self, *args):
+        line = self.stream.readline(*args)
+        self.charge(len(line))
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+class RateLimiter:
+    def __init__(self, is_peer=None, costs=RATE_LIMIT_COSTS, max_clients=RATE_LIMIT_CLIENTS):
+        """
+        :param is_peer: (Optional) <callable> Takes a client address, True for the nodes we sync with
+        :param costs: <dict> URL rule -> tokens, the rest cost 1
+        :param max_clients: <int> Buckets kept, the least recently seen clients are forgotten (their bucket was full again anyway)
+        """
+        self.is_peer = is_peer
+        self.costs = costs
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def cost(self, rule, content_length=None):
+        return self.costs.get(rule, 1) + (content_length or 0) / 1024 * RATE_LIMIT_COST_PER_KB
+
+    def check(self, client, cost):
+        """
+        Charge a request to its client
+        :param client: <str> Address of the client
+        :param cost: <float> Tokens the request costs
+        :return: <float> 0 if the request can go ahead, else seconds to wait
+        """
+        with self.lock:
+            wait = self.bucket(client).take(cost)
+            if wait:
+                self.rejected += 1
+            else:
+                self.allowed += 1
+            return wait
+
+    def spend(self, client, cost):
+        """
+        Charge tokens a request already used, eg. for the body it sent
+        :param client: <str> Address of the client
+        :param cost: <float> Tokens used
+        """
+        with self.lock:
+            self.bucket(client).spend(cost)
+
+    def bucket(self, client):
+        # Under self.lock
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            if self.is_peer is not None and self.is_peer(client):
+                bucket = TokenBucket(RATE_LIMIT_PEER_RATE, RATE_LIMIT_PEER_BURST)
+            else:
+                bucket = TokenBucket(RATE_LIMIT_RATE, RATE_LIMIT_BURST)
+            self.buckets[client] = bucket
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+        return bucket
+
+    def init_app(self, app):
+        if not RATE_LIMIT_ENABLED:
+            return
+
+        @app.before_request
+        def limit():
+            rule = request.url_rule.rule if request.url_rule is not None else None
+            client = request.remote_addr
+            wait = self.check(client, self.cost(rule, request.content_length))
+            if wait:
+                response = jsonify({'error': 'Too many requests', 'retry_after': wait})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(max(1, round(wait)))
+                return response
+            if request.content_length is None and 'wsgi.input' in request.environ:
+                # Before anything reads the body: it pays per KB as it is read, like a sized one does up front
+                request.environ['wsgi.input'] = ChargedStream(
+                    request.environ['wsgi.input'], lambda size: self.spend(client, size / 1024 * RATE_LIMIT_COST_PER_KB))
+
+    def stats(self):
+        with self.lock:
+            return {'clients': len(self.buckets), 'allowed': self.allowed, 'rejected': self.rejected}
+
+
+class coalesced:
+    '''
+    Wraps a function so concurrent calls share one run: a call made while another runs waits for it
+    and gets its result (or exception) instead of starting a second run.
+    '''
+    def __init__(self, func):
+        self.func = func
+        self.lock = threading.Lock()
+        self.running = None  # (done event, result holder) of the run in progress
+        self.runs = 0
+        self.shared = 0
+
+    def __call__(self):
+        with self.lock:
+            running = self.running
+            if running is None:
+                running = self.running = (threading.Event(), {})
+                leader = True
+                self.runs += 1
+            else:
+                leader = False
+                self.shared += 1
+        done, outcome = running
+        if not leader:
+            done.wait()
+        else:
+            try:
+                outcome['result'] = self.func()
+            except Exception as e:
+                outcome['error'] = e
+            finally:
+                with self.lock:
+                    self.running = None
+                done.set()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def stats(self):
+        return {'runs': self.runs, 'shared': self.shared}
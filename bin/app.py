@@ -6,21 +6,40 @@ It also has a simple smart contract that can be used to validate transactions.
 Neetre 2024
 '''
 
+from boot import BootSequence
+boot_sequence = BootSequence()  # first, so the imports are timed too
+
 import time
 from uuid import uuid4
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, redirect, Response
 from argparse import ArgumentParser
-from config import MINING_REWARD
+from urllib.parse import urlparse
+from config import (HEADERS_PER_REQUEST, BODIES_PER_REQUEST, PEER_REFRESH_SECONDS,
+                    SYNC_CHECK_SECONDS, MEMPOOL_EXPIRY_SECONDS, MEMPOOL_TX_TTL, SNAPSHOT_SECONDS, CHAIN_SNAPSHOT,
+                    SERVER_THREADS, EXPLORER_WINDOW, EVENTS_PORT_OFFSET)
 from blockchain import Blockchain
 from peer_discovery import PeerDiscovery
+from chain_sync import ChainSync
+from gossip import Gossip
+from chain_stream import chain_response
+from http_cache import conditional, chain_etag, ResponseCache
 from contract import SmartContract
-import threading
+from data_manager import DB_manager
+from explorer import Explorer
+from admission import RateLimiter
+import metrics
+from profiling import Profiler
+from ingest import BulkIngest, bulk_response
+from events import EventBus
+from scheduler import Scheduler
+from serve import serve, cpu_executor
 import logging
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from security import Security
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+boot_sequence.mark('imports')
 
 # Instantiate our Node
 app = Flask(__name__)
@@ -42,29 +61,45 @@ contract = SmartContract(simple_contract)
 contract_address = blockchain.add_smart_contract(contract)
 
 registry_url = "http://127.0.0.1:5001"  # Replace with your actual registry server URL
-peer_discovery = PeerDiscovery(registry_url)
-
-my_node_url = "http://127.0.0.1:5000"  # Replace with your actual node URL
-peer_discovery.register(my_node_url)
+my_node_url = "http://127.0.0.1:5000"  # Replace with your actual node URL, boot() sets the port
+peer_discovery = PeerDiscovery(registry_url, my_node_url)  # registers with the first heartbeat, not at import
+chain_sync = ChainSync(blockchain)
+gossip = Gossip(blockchain, urlparse(my_node_url).netloc, chain_sync)
+scheduler = Scheduler()
+response_cache = ResponseCache(blockchain.state_version)
+explorer = Explorer(blockchain)
+events = EventBus()
+bulk = BulkIngest(blockchain, gossip)
+limiter = RateLimiter(is_peer=blockchain.nodes.has_host)
+metrics.init_app(app)  # first, so the requests the limiter turns away are counted too
+limiter.init_app(app)
+profiler = Profiler()
+profiler.init_app(app)
+blockchain.watch_metrics()
+blockchain.listeners.append(events.publish)
+app.config['EVENTS_PORT'] = 5000 + EVENTS_PORT_OFFSET
+boot_sequence.mark('app')
 
 
 @app.route('/')
+@conditional(cache=response_cache)
 def index():
-    return render_template('index.html', chain=blockchain.chain)
+    blocks, oldest = explorer.render_window(lambda window: render_template('blocks.html', blocks=window))
+    return render_template('index.html', blocks=blocks, oldest=oldest, height=len(blockchain.chain), page_size=EXPLORER_WINDOW)
 
 @app.route('/mine', methods=['GET'])
 def mine():
     last_block = blockchain.last_block
-    proof = blockchain.proof_or_work(last_block)
-    
-    blockchain.new_transaction(
-        sender='0',
-        recipient=node_identifier,
-        amount=MINING_REWARD,
-    )
+    proof = blockchain.proof_or_work(last_block, cpu_executor())
     
     previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
+    try:
+        # The reward is credited with the Block, so a 409 leaves nothing behind
+        block = blockchain.new_block(proof, previous_hash, reward_to=node_identifier)
+    except ValueError as e:
+        # A Block from a peer took the tip while we were mining
+        return jsonify({'error': str(e)}), 409
+    gossip.announce_block(block)
 
     response = {
         'message': "New Block Forged",
@@ -106,6 +141,7 @@ def new_transaction():
                 signature,
                 public_key
             )
+            gossip.announce_transaction(transaction, values['signature'], values['public_key'])
             response = {'message': f'Transaction will be added to Block {index}'}
             return jsonify(response), 201
         else:
@@ -113,14 +149,113 @@ def new_transaction():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/transactions/bulk', methods=['POST'])
+def new_transactions():
+    # NDJSON or a JSON array of the bodies /transactions/new takes, one result line per transaction
+    return bulk_response(bulk.transactions, request)
+
+@app.route('/transactions/pending', methods=['GET'])
+def pending_transactions():
+    # As of the published chain: a transaction shows here until /chain has its Block
+    return jsonify(blockchain.state.mempool.all_transactions()), 200
+
+@app.route('/events', methods=['GET'])
+def event_stream():
+    # The stream is served by the event server, see events.py
+    host = request.host.rsplit(':', 1)[0]
+    query = f"?{request.query_string.decode()}" if request.query_string else ''
+    return redirect(f"{request.scheme}://{host}:{app.config['EVENTS_PORT']}/events{query}", code=307)
+
+@app.route('/nodes/events', methods=['GET'])
+def event_stats():
+    return jsonify(events.stats()), 200
+
 @app.route('/chain', methods=['GET'])
+@conditional(lambda: chain_etag(blockchain), response_cache)
 def full_chain():
+    return chain_response(blockchain, request.args, request.headers.get('Accept', ''))
+
+@app.route('/headers', methods=['GET'])
+@conditional(lambda: chain_etag(blockchain), response_cache)
+def headers():
+    start = request.args.get('from', default=1, type=int)
+    count = min(request.args.get('count', default=HEADERS_PER_REQUEST, type=int), HEADERS_PER_REQUEST)
     response = {
-        'chain' : blockchain.chain,
-        'length' : len(blockchain.chain)
+        'headers': blockchain.get_headers(start, count),
+        'height': len(blockchain.chain)
     }
     return jsonify(response), 200
 
+@app.route('/blocks/<string:block_hash>', methods=['GET'])
+@conditional(lambda block_hash: block_hash if blockchain.get_block_by_hash(block_hash) else None)
+def block_by_hash(block_hash):
+    block = blockchain.get_block_by_hash(block_hash)
+    if block is None:
+        return jsonify({'error': 'Block not found'}), 404
+    return jsonify(block), 200
+
+@app.route('/blocks/batch', methods=['POST'])
+def blocks_by_hash():
+    values = request.get_json()
+    hashes = values.get('hashes')
+    if hashes is None:
+        return "Error: Please supply a list of block hashes", 400
+    if len(hashes) > BODIES_PER_REQUEST:
+        return f"Error: At most {BODIES_PER_REQUEST} blocks per request", 400
+    return jsonify({'blocks': [blockchain.get_block_by_hash(block_hash) for block_hash in hashes]}), 200
+
+@app.route('/blocks/bulk', methods=['POST'])
+def submit_blocks():
+    # NDJSON or a JSON array of blocks to append to our tip, one result line per block
+    return bulk_response(bulk.blocks, request)
+
+@app.route('/nodes/sync', methods=['GET'])
+def sync():
+    synced = chain_sync.sync()
+    response = {
+        'message': 'Our chain was updated' if synced else 'Our chain is up to date',
+        'length': len(blockchain.chain)
+    }
+    return jsonify(response), 200
+
+@app.route('/gossip/inv', methods=['POST'])
+def receive_inventory():
+    values = request.get_json()
+    if not isinstance(values, dict) or 'inventory' not in values or 'origin' not in values:
+        return "Error: Please supply inventory and origin", 400
+    if not gossip.valid_inventory(values['inventory'], values['origin']):
+        return "Error: Please supply a valid inventory", 400
+    wanted = gossip.receive_inventory(values['inventory'], values['origin'])
+    return jsonify({'wanted': wanted}), 202
+
+@app.route('/gossip/transactions/<string:txid>', methods=['GET'])
+def gossip_transaction(txid):
+    envelope = gossip.get_transaction(txid)
+    if envelope is None:
+        return jsonify({'error': 'Transaction not found'}), 404
+    return jsonify(envelope), 200
+
+@app.route('/gossip/compact/<string:block_hash>', methods=['GET'])
+def gossip_compact_block(block_hash):
+    compact = gossip.compact_block(block_hash)
+    if compact is None:
+        return jsonify({'error': 'Block not found'}), 404
+    return jsonify(compact), 200
+
+@app.route('/gossip/compact/<string:block_hash>/transactions', methods=['POST'])
+def gossip_block_transactions(block_hash):
+    values = request.get_json()
+    if not values or 'indexes' not in values:
+        return "Error: Please supply the transaction indexes", 400
+    transactions = gossip.block_transactions(block_hash, values['indexes'])
+    if transactions is None:
+        return jsonify({'error': 'Block not found'}), 404
+    return jsonify({'transactions': transactions}), 200
+
+@app.route('/gossip/stats', methods=['GET'])
+def gossip_stats():
+    return jsonify(gossip.stats()), 200
+
 @app.route('/nodes/register', methods=['POST'])
 def register_nodes():
     values = request.get_json()
@@ -143,20 +278,45 @@ def get_peers():
     peers = peer_discovery.get_peers()
     return jsonify(peers), 200
 
+@app.route('/nodes/stats', methods=['GET'])
+def peer_stats():
+    return jsonify(blockchain.nodes.stats()), 200
+
+@app.route('/nodes/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(response_cache.stats()), 200
+
+@app.route('/nodes/limits', methods=['GET'])
+def limit_stats():
+    return jsonify({
+        'rate_limit': limiter.stats(),
+        'resolve': blockchain.resolve_conflicts.stats(),
+        'sync': chain_sync.sync.stats(),
+        'writer': blockchain.writer.stats()
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/nodes/boot', methods=['GET'])
+def boot_report():
+    return jsonify(boot_sequence.report()), 200
+
+@app.route('/nodes/jobs', methods=['GET'])
+def job_stats():
+    return jsonify(scheduler.stats()), 200
+
 @app.route('/nodes/resolve', methods=['GET'])
 def consensus():
     replaced = blockchain.resolve_conflicts()
     
-    if replaced:
-        response = {
-            'message' : 'Our chain was replaced',
-            'new_chain' : blockchain.chain
-        }
-    else:
-        response = {
-            'message' : 'Our chain is authoritative',
-            'chain' : blockchain.chain
-        }
+    # Only the new tip is returned, the chain itself is served paginated by /chain
+    response = {
+        'message' : 'Our chain was replaced' if replaced else 'Our chain is authoritative',
+        'length' : len(blockchain.chain),
+        'last_block' : blockchain.last_block
+    }
     return jsonify(response), 200
 
 @app.route('/generate_keypair', methods=['GET'])
@@ -193,22 +353,89 @@ def execute_contract():
     result = blockchain.execute_smart_contract(values['address'], values['transaction'])
     return jsonify({'result': result}), 200
 
-def update_peers_periodically():
-    while True:
-        peers = peer_discovery.get_peers()
-        for peer in peers:
-            blockchain.register_node(peer)
-        time.sleep(300)
+def warm_start():
+    """
+    Syncs right away with the peers saved by the last run (loaded by boot) and registers with the registry.
+    The registry is only asked for peers when none of the saved ones answers.
+    """
+    started = time.time()
+    if len(blockchain.nodes):
+        chain_sync.sync()  # probes all the saved peers in parallel
+
+    answered = [node for node, stats in blockchain.nodes.stats().items() if (stats['last_seen'] or 0) >= started]
+    if answered:
+        peer_discovery.heartbeat()
+    else:
+        refresh_peers()
+        chain_sync.sync()
 
+def refresh_peers():
+    alive = peer_discovery.heartbeat()
+    for peer in peer_discovery.get_peers():
+        blockchain.register_node(peer)
+    if not alive:
+        raise RuntimeError("Registry unreachable")
 
-peer_update_thread = threading.Thread(target=update_peers_periodically)
-peer_update_thread.start()
+def expire_mempool():
+    blockchain.expire_transactions(MEMPOOL_TX_TTL)
+
+def snapshot():
+    blockchain.save_snapshot(CHAIN_SNAPSHOT)
+    DB_manager().save_peers(blockchain.nodes.records())
+
+def start_background_jobs():
+    scheduler.add_job('warm_start', warm_start, interval=None)
+    scheduler.add_job('peer_refresh', refresh_peers, interval=PEER_REFRESH_SECONDS)
+    scheduler.add_job('sync_check', chain_sync.sync, interval=SYNC_CHECK_SECONDS)
+    scheduler.add_job('mempool_expiry', expire_mempool, interval=MEMPOOL_EXPIRY_SECONDS)
+    scheduler.add_job('snapshot', snapshot, interval=SNAPSHOT_SECONDS)
+    scheduler.start()
+
+def boot(port=5000, events_port=None, registry=None):
+    """
+    Starts everything that has side effects: files, threads, the event server and the background jobs.
+    Nothing here waits for the network, syncing and registering run as jobs.
+    :param port: <int> Port of the API
+    :param events_port: (Optional) <int> Port of the event stream, API port + 100 by default
+    :param registry: (Optional) <str> URL of the registry server, registry_url by default
+    """
+    global my_node_url
+    my_node_url = f"http://127.0.0.1:{port}"
+    if registry:
+        peer_discovery.registry_url = registry
+    peer_discovery.node_url = my_node_url
+    gossip.node_address = urlparse(my_node_url).netloc
+    app.config['EVENTS_PORT'] = events_port or port + EVENTS_PORT_OFFSET
+
+    with boot_sequence.phase('snapshot'):
+        if blockchain.load_snapshot(CHAIN_SNAPSHOT):
+            logging.info(f"Loaded {len(blockchain.chain)} blocks from the snapshot")
+    with boot_sequence.phase('address_book'):
+        blockchain.nodes.restore(DB_manager().load_peers())
+        if len(blockchain.nodes):
+            logging.info(f"Loaded {len(blockchain.nodes)} peers from the address book")
+    with boot_sequence.phase('events'):
+        events.start(port=app.config['EVENTS_PORT'])
+    with boot_sequence.phase('jobs'):
+        start_background_jobs()
+    boot_sequence.ready()
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    parser.add_argument('-s', '--server', default='dev', choices=['dev', 'production'], help='server to run the API with')
+    parser.add_argument('-t', '--threads', default=SERVER_THREADS, type=int, help='request threads of the production server')
+    parser.add_argument('-e', '--events-port', default=None, type=int, help='port of the event stream, API port + 100 by default')
+    parser.add_argument('-r', '--registry', default=registry_url, help='URL of the registry server')
     args = parser.parse_args()
     port = args.port
 
-    app.run(host='0.0.0.0', port=port)
+    boot(port, args.events_port, args.registry)
+    try:
+        serve(app, port=port, server=args.server, threads=args.threads)
+    finally:
+        scheduler.stop(wait=False)
+        events.stop()
+        snapshot()
+        blockchain.writer.stop()
@@ -0,0 +1,72 @@
+'''
+This script measures the sustained transaction ingest rate of a running node,
+one request per transaction (/transactions/new) against the bulk endpoint (/transactions/bulk).
+Transactions are signed before the clock starts, so only the node's work is timed.
+
+Usage: python bench_ingest.py --node http://127.0.0.1:5000 --count 2000
+
+Neetre 2024
+'''
+
+import json
+import argparse
+from time import perf_counter
+import requests
+from cryptography.hazmat.primitives import serialization
+from security import Security
+
+
+def signed_transactions(count, sender, offset=0):
+    private_key, public_key = Security.generate_keypair()
+    public_pem = public_key.public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+    transactions = []
+    for i in range(count):
+        # The amount makes every transaction, and its signature, unique
+        transaction = {'sender': sender, 'recipient': 'bench', 'amount': offset + i + 1}
+        transaction['signature'] = Security.sign_with_key(transaction, private_key).hex()
+        transaction['public_key'] = public_pem
+        transactions.append(transaction)
+    return transactions
+
+
+def single(node, transactions):
+    session = requests.Session()
+    accepted = 0
+    start = perf_counter()
+    for transaction in transactions:
+        response = session.post(f'{node}/transactions/new', json=transaction)
+        accepted += response.status_code == 201
+    return accepted, perf_counter() - start
+
+
+def bulk(node, transactions, batch):
+    session = requests.Session()
+    accepted = 0
+    start = perf_counter()
+    for first in range(0, len(transactions), batch):
+        body = ''.join(json.dumps(transaction) + '\n' for transaction in transactions[first:first + batch])
+        response = session.post(f'{node}/transactions/bulk', data=body.encode(),
+                                headers={'Content-Type': 'application/x-ndjson'}, stream=True)
+        for line in response.iter_lines():
+            accepted += json.loads(line)['accepted']
+    return accepted, perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--node', default='http://127.0.0.1:5000', help='node to benchmark')
+    parser.add_argument('--count', default=2000, type=int, help='transactions per run')
+    parser.add_argument('--batch', default=1000, type=int, help='transactions per bulk request')
+    parser.add_argument('--sender', default='0', help='sender address, needs the balance for the whole run')
+    args = parser.parse_args()
+
+    runs = {
+        'single': lambda: single(args.node, signed_transactions(args.count, args.sender)),
+        'bulk': lambda: bulk(args.node, signed_transactions(args.count, args.sender, args.count), args.batch),
+    }
+    for name, run in runs.items():
+        accepted, elapsed = run()
+        print(f"{name:>6}: {accepted}/{args.count} accepted in {elapsed:.2f}s, {accepted / elapsed:.0f} tx/s")
@@ -0,0 +1,276 @@
+'''
+This is the micro-benchmark suite for the node's core primitives:
+block hashing, proof checks, chain validation, the mempool, transaction admission, signatures and smart contracts.
+It runs offline, writes the results with the machine's metadata to a JSON file
+and compares them with a stored baseline, any benchmark slower than the baseline by more than the threshold
+is flagged and the script exits with status 1.
+
+Usage:
+    python benchmarks.py                   # run everything, compare with ../data/benchmarks/baseline.json
+    python benchmarks.py --quick           # smaller chains and fewer repeats
+    python benchmarks.py --save-baseline   # make this run the new baseline
+    python benchmarks.py --filter mempool  # only the mempool benchmarks
+
+Neetre 2024
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import threading
+import subprocess
+from time import perf_counter
+
+import blockchain as blockchain_module
+from blockchain import Blockchain
+from mempool import Mempool
+from contract import SmartContract
+from security import Security, SigningSession
+
+RESULTS_DIR = '../data/benchmarks'
+BASELINE = f'{RESULTS_DIR}/baseline.json'
+# Synthetic chains are mined at a low difficulty so they can be built in seconds,
+# validating them costs the same hashing as at the real difficulty
+BENCH_DIFFICULTY = '0'
+TRANSACTIONS_PER_BLOCK = 5
+
+
+def measure(func, repeat, min_time=0.2):
+    """
+    Times func like timeit: calls it in a loop long enough to be measurable, repeat times
+    :return: <dict> Seconds per call (best and median) and calls per second
+    """
+    number = 1
+    while True:
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = perf_counter() - start
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        times.append((perf_counter() - start) / number)
+    median = statistics.median(times)
+    return {
+        'seconds_per_op': median,
+        'best_seconds_per_op': min(times),
+        'ops_per_second': 1 / median if median else None,
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def transaction(i):
+    return {'sender': f'sender{i % 100}', 'recipient': f'recipient{i % 37}', 'amount': i % 100 + 1}
+
+
+def synthetic_chain(length):
+    """
+    A valid chain of length blocks, each with a few transactions
+    """
+    genesis = {'index': 1, 'timestamp': 0, 'transactions': [], 'proof': 100, 'previous_hash': 1}
+    chain = [genesis]
+    for index in range(2, length + 1):
+        last = chain[-1]
+        last_hash = Blockchain.hash(last)
+        chain.append({
+            'index': index,
+            'timestamp': index,
+            'transactions': [transaction(index * TRANSACTIONS_PER_BLOCK + i) for i in range(TRANSACTIONS_PER_BLOCK)],
+            'proof': Blockchain.find_proof(last['proof'], last_hash),
+            'previous_hash': last_hash,
+        })
+    return chain
+
+
+# Benchmarks, each returns {name: measurement}
+def bench_hash(repeat, quick):
+    block = synthetic_chain(2)[-1]
+    return {'blockchain.hash': measure(lambda: Blockchain.hash(block), repeat)}
+
+
+def bench_valid_proof(repeat, quick):
+    last_hash = Blockchain.hash(synthetic_chain(1)[0])
+    proofs = iter(range(10 ** 9))
+    return {'blockchain.valid_proof': measure(lambda: Blockchain.valid_proof(100, next(proofs), last_hash), repeat)}
+
+
+def bench_valid_chain(repeat, quick):
+    results = {}
+    blockchain = Blockchain()
+    for length in (1000, 10000) if quick else (1000, 10000, 100000):
+        chain = synthetic_chain(length)
+        assert blockchain.valid_chain(chain)
+        results[f'blockchain.valid_chain.{length}'] = measure(lambda: blockchain.valid_chain(chain), repeat, min_time=0)
+    return results
+
+
+def bench_mempool(repeat, quick):
+    results = {}
+    for size in (10000,) if quick else (10000, 100000):
+        transactions = [transaction(i) for i in range(size)]
+
+        def fill():
+            mempool = Mempool()
+            for tx in transactions:
+                mempool.add_transactions(tx)
+            return mempool
+        results[f'mempool.add.{size}'] = measure(fill, repeat, min_time=0)
+
+        mempool = fill()
+        results[f'mempool.get_transactions.{size}'] = measure(lambda: mempool.get_transactions(10), repeat)
+
+        # A block's worth of transactions from random places in the pool, put back after each run
+        picked = random.Random(0).sample(transactions, 10)
+
+        def remove():
+            mempool.remove_transactions(picked)
+            for tx in picked:
+                mempool.add_transactions(tx)
+        results[f'mempool.remove_transactions.{size}'] = measure(remove, repeat)
+    return results
+
+
+def bench_admission(repeat, quick):
+    # Request threads admitting transactions at once, each for its own sender:
+    # they only wait for each other when their accounts share a mempool shard
+    results = {}
+    size = 10000 if quick else 40000
+    for threads in (1, 8):
+        blockchain = Blockchain()
+        for t in range(threads):
+            blockchain.new_transaction('0', f'sender{t}', 10 ** 12)
+
+        def admit(t):
+            for i in range(size // threads):
+                blockchain.new_transaction(f'sender{t}', f'recipient{i % 37}', 1)
+
+        def run():
+            workers = [threading.Thread(target=admit, args=(t,)) for t in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        results[f'blockchain.new_transaction.{threads}_threads.{size}'] = measure(run, repeat, min_time=0)
+        blockchain.writer.stop()
+    return results
+
+
+def bench_signatures(repeat, quick):
+    password = 'benchmark'
+    pem, public_key = Security.generate_key_pair(password)
+    tx = transaction(1)
+    signature = Security.sign_transaction(tx, pem, password)
+    session = SigningSession(pem, password)
+    return {
+        'security.sign_transaction': measure(lambda: Security.sign_transaction(tx, pem, password), repeat),
+        'security.signing_session.sign_transaction': measure(lambda: session.sign_transaction(tx), repeat),
+        'security.verify_signature': measure(lambda: Security.verify_signature(tx, signature, public_key), repeat),
+    }
+
+
+def bench_contract(repeat, quick):
+    contract = SmartContract("""
+if transaction['amount'] > 100:
+    result = reject()
+else:
+    result = approve()
+""")
+    blockchain = Blockchain()
+    tx = transaction(1)
+    return {'smart_contract.execute': measure(lambda: contract.execute(blockchain, tx), repeat)}
+
+
+BENCHMARKS = [bench_hash, bench_valid_proof, bench_valid_chain, bench_mempool, bench_admission, bench_signatures,
+              bench_contract]
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'time': time.time(),
+        'python': sys.version,
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit,
+        'difficulty': BENCH_DIFFICULTY,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: <list> Names of the benchmarks slower than the baseline by more than threshold (a fraction)
+    """
+    regressions = []
+    print(f"\n{'benchmark':<45} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print(f"{name:<45} {'-':>12} {result['seconds_per_op']:>12.3e} {'new':>8}")
+            continue
+        change = result['seconds_per_op'] / base['seconds_per_op'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<45} {base['seconds_per_op']:>12.3e} {result['seconds_per_op']:>12.3e} {change:>+8.1%}{flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quick', action='store_true', help='smaller inputs and fewer repeats')
+    parser.add_argument('--repeat', default=None, type=int, help='timed runs per benchmark')
+    parser.add_argument('--filter', default=None, help='only run the benchmark groups whose name contains this, eg. mempool')
+    parser.add_argument('--output', default=None, help='where to write the results')
+    parser.add_argument('--baseline', default=BASELINE, help='results to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--threshold', default=0.2, type=float, help='slowdown flagged as a regression, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    blockchain_module.PROOF_OF_WORK_DIFFICULTY = BENCH_DIFFICULTY
+    repeat = args.repeat or (3 if args.quick else 5)
+
+    results = {}
+    for benchmark in BENCHMARKS:
+        if args.filter and args.filter not in benchmark.__name__:
+            continue
+        for name, result in benchmark(repeat, args.quick).items():
+            results[name] = result
+            print(f"{name:<45} {result['seconds_per_op']:>12.3e} s/op {result['ops_per_second']:>14,.1f} op/s")
+
+    report = {'metadata': metadata(), 'results': results}
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = args.output or f"{RESULTS_DIR}/results-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
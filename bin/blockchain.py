@@ -4,51 +4,288 @@ This program is a simple blockchain implementation with a proof of work algorith
 Neetre 2024
 '''
 
+import os
 import hashlib
 import json
-from time import time
+from time import time, perf_counter
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-from config import PROOF_OF_WORK_DIFFICULTY
+from config import PROOF_OF_WORK_DIFFICULTY, MINING_REWARD, PEER_TIMEOUT, PEER_FETCH_WORKERS, SLOW_PEER_SECONDS
 from security import Security
-from mempool import Mempool
+from mempool import Mempool, MempoolView
+from peer_manager import PeerManager
+from admission import coalesced
+from chain_state import ChainState, ChainView, ChainWriter
+from metrics import Counter, Gauge, Histogram
+
+POW_SECONDS = Histogram('stellanova_pow_seconds', 'Time spent finding a proof of work',
+                        buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+POW_HASHES = Counter('stellanova_pow_hashes_total', 'Proofs tried by the proof of work')
+HASHRATE = Gauge('stellanova_pow_hashrate', 'Hashes per second of the last proof of work')
+VALIDATION_SECONDS = Histogram('stellanova_chain_validation_seconds', 'Time spent validating a chain')
+BLOCKS_VALIDATED = Counter('stellanova_blocks_validated_total', 'Blocks checked by valid_chain')
+RESOLVE_SECONDS = Histogram('stellanova_resolve_conflicts_seconds', 'Time spent running the consensus algorithm',
+                            buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+CHAIN_HEIGHT = Gauge('stellanova_chain_height', 'Blocks in our chain')
+PEERS = Gauge('stellanova_peers', 'Peers we know')
+CHAIN_WRITER_QUEUE = Gauge('stellanova_chain_writer_queue', 'Chain changes waiting for the writer')
+CHAIN_REPLACEMENTS = Counter('stellanova_chain_replacements_total', 'Times our chain was replaced by a longer one')
 
 
 class Blockchain():
-    def __init__(self) -> None:
+    def __init__(self, genesis=None, threaded=True) -> None:
+        """
+        :param genesis: (Optional) <dict> Genesis Block to start from, eg. one shared by simulated nodes
+        :param threaded: <bool> Apply the changes on a writer thread, False for single threaded users, see ChainWriter
+        """
         self.current_transactions = []
-        self.chain = []
-        self.nodes = set()
+        # The writer's state, everyone else reads the published ChainState, see chain_state.py
+        self._blocks = []
+        self._positions = {}
+        self._version = 0  # changes whenever the chain changes
+        self._tip = None
+        self._state = None
+        self.writer = ChainWriter(self._publish, threaded=threaded)
+        self.nodes = PeerManager()
         self.mempool = Mempool()
         self.smart_contracts = {}
-        self.balances = {}
+        self.session = self.new_peer_session()
+        self.peer_etags = {}
+        self.listeners = []  # callables taking (event, data), see events.py
+        # Concurrent consensus requests share one run instead of each fetching every peer's chain
+        self.resolve_conflicts = coalesced(self.resolve_conflicts)
         
         # create the genesis block
-        self.new_block(previous_hash=1, proof=100)
-        
-    def new_block(self, proof, previous_hash=None):
+        if genesis is None:
+            self._new_block(previous_hash=1, proof=100)
+        else:
+            self._append(genesis)
+        self._publish()
+
+    def watch_metrics(self):
+        # The node gauges read this Blockchain at every scrape, there is one per node process
+        CHAIN_HEIGHT.set_function(lambda: len(self.chain))
+        PEERS.set_function(lambda: len(self.nodes))
+        CHAIN_WRITER_QUEUE.set_function(lambda: self.writer.queue.qsize())
+
+    # State
+    def _publish(self):
+        # Called by the writer after each batch of changes
+        previous = self._state
+        self._state = ChainState(ChainView(self._blocks, len(self._blocks)), self._positions, self._version, self._tip,
+                                 MempoolView(self.mempool, self._version))
+        if previous is not None:
+            # One state late, so readers still on the previous state find them in its chain if not in its pending list
+            self.mempool.purge(previous.version)
+
+    @property
+    def state(self):
+        """
+        The chain state to read: the last published one, or the writer's own while it applies a change
+        :return: <ChainState>
+        """
+        if self.writer.on_writer_thread():
+            return ChainState(ChainView(self._blocks, len(self._blocks)), self._positions, self._version, self._tip,
+                              MempoolView(self.mempool, self._version))
+        return self._state
+
+    @property
+    def chain(self):
+        return self.state.chain
+
+    @property
+    def balances(self):
+        # Not part of the chain state: admissions move them off the writer, see mempool.py
+        return self.mempool.balances
+
+    @property
+    def version(self):
+        return self.state.version
+
+    @property
+    def tip_hash(self):
+        return self.state.tip
+
+    def _append(self, block):
+        self._blocks.append(block)
+        self._tip = self.hash(block)
+        self._positions[self._tip] = len(self._blocks) - 1
+        self._version += 1
+
+    # Changes, applied by the writer
+    def new_block(self, proof, previous_hash=None, reward_to=None):
         """
         Create a new Block in the Blockchain
         :param proof: <int> The proof given by the Proof of Work algorithm
         :param previous_hash: (Optional) <str> Hash of previous Block
+        :param reward_to: (Optional) <str> Address credited MINING_REWARD by a transaction in the Block
         :return: <dict> New Block
+        :raises ValueError: if the tip is no longer the Block with previous_hash, the proof was found for an old tip,
+                            nothing is credited then
         """
-        transactions = self.mempool.get_transactions(10)
+        return self.writer.submit(self._new_block, proof, previous_hash, reward_to)
+
+    def _new_block(self, proof, previous_hash=None, reward_to=None):
+        if self._blocks and previous_hash is not None and previous_hash != self._tip:
+            raise ValueError("Our chain moved on while mining, the proof is for an old tip")
+        mined = self.mempool.get_transactions(10 if reward_to is None else 9)
+        transactions = mined
+        if reward_to is not None:
+            # Straight into the Block and credited only once the Block is sure to be made
+            reward = {'sender': '0', 'recipient': reward_to, 'amount': MINING_REWARD}
+            self.update_balances(reward)
+            transactions = mined + [reward]
         block = {
-            'index' : len(self.chain) + 1,
+            'index' : len(self._blocks) + 1,
             'timestamp' : time(),
             'transactions' : transactions,
             'proof' : proof,
-            'previous_hash' : previous_hash or self.hash(self.chain[-1])
+            'previous_hash' : previous_hash or self._tip
         }
         
-        # Reset the current list of transactions
-        self.mempool.remove_transactions(transactions)
+        self._append(block)
+        # Reset the current list of transactions, they stay pending for the states before this Block
+        self.mempool.remove_transactions(mined, mined_at=self._version)
         self.current_transactions = []
-        self.chain.append(block)
+        self.emit('block', block)
+        if mined:
+            self.emit('mempool_remove', {'reason': 'mined', 'transactions': mined})
         
         return block
+
+    def add_block(self, block):
+        """
+        Append a Block mined by another node on top of our tip
+        :param block: <dict> Block
+        :return: <bool> True if the Block extended our chain, False if it doesn't fit on our tip
+        """
+        return self.writer.submit(self._add_block, block)
+
+    def _add_block(self, block):
+        if block['index'] != len(self._blocks) + 1 or not self.valid_chain([self._blocks[-1], block]):
+            return False
+        self._append(block)
+        self.mempool.remove_transactions(block['transactions'], mined_at=self._version)
+        self.emit('block', block)
+        if block['transactions']:
+            self.emit('mempool_remove', {'reason': 'mined', 'transactions': block['transactions']})
+        return True
+
+    def replace_chain(self, chain):
+        """
+        Swap our chain for a longer valid one and rebuild the hash index
+        :param chain: <list> The new chain, already validated
+        :return: <bool> True if swapped, False if our chain grew meanwhile and is at least as long
+        """
+        # The index is built here, so the writer only swaps it in
+        hashes = [self.hash(block) for block in chain]
+        positions = {block_hash: position for position, block_hash in enumerate(hashes)}
+        return self.writer.submit(self._replace_chain, list(chain), positions, hashes[-1])
+
+    def _replace_chain(self, chain, positions, tip):
+        old_length = len(self._blocks)
+        if len(chain) <= old_length:
+            return False
+        self._blocks = chain
+        self._positions = positions
+        self._tip = tip
+        self._version += 1
+        self.emit('reorg', {'old_length': old_length, 'length': len(chain), 'tip': tip})
+        return True
+
+    def emit(self, event, data):
+        """
+        Tells the listeners about a change of the chain or the mempool, a failing listener doesn't stop the others
+        :param event: <str> 'block', 'reorg', 'mempool_add' or 'mempool_remove'
+        :param data: The Block, transactions or reorg summary
+        """
+        for listener in self.listeners:
+            try:
+                listener(event, data)
+            except Exception as e:
+                logging.error(f"Error in {event} listener: {str(e)}")
+
+    def state_version(self):
+        """
+        A value that changes whenever the chain or the mempool change, for caches
+        :return: <tuple>
+        """
+        return self.version, self.mempool.version
+
+    @staticmethod
+    def header(block, block_hash=None):
+        """
+        Returns the header of a Block: everything but the transactions, plus the Block hash.
+        The proof only depends on the previous hash, so a chain of headers can be
+        checked for links and PoW before any transaction is downloaded.
+        :param block: <dict> Block
+        :param block_hash: (Optional) <str> Hash of the Block, if already known
+        :return: <dict> Header
+        """
+        return {
+            'index': block['index'],
+            'timestamp': block['timestamp'],
+            'proof': block['proof'],
+            'previous_hash': block['previous_hash'],
+            'hash': block_hash or Blockchain.hash(block),
+        }
+
+    def get_headers(self, start, count):
+        """
+        Returns a range of headers of our chain
+        :param start: <int> Index of the first Block (the genesis Block has index 1)
+        :param count: <int> Maximum number of headers
+        :return: <list> Headers
+        """
+        first = max(start, 1) - 1
+        return [self.header(block) for block in self.chain[first:first + max(count, 0)]]
+
+    def iter_blocks(self, start=1, limit=None, chain=None):
+        """
+        Yields a range of Blocks without copying the chain
+        :param start: <int> Index of the first Block (the genesis Block has index 1)
+        :param limit: (Optional) <int> Maximum number of Blocks
+        :param chain: (Optional) <ChainView> The chain to read, our current one by default
+        :return: <generator> Blocks
+        """
+        if chain is None:
+            chain = self.chain  # a snapshot, Blocks added or a chain swapped meanwhile don't show
+        first = max(start, 1) - 1
+        end = len(chain) if limit is None else min(len(chain), first + max(limit, 0))
+        for position in range(first, end):
+            yield chain[position]
+
+    def get_block_by_hash(self, block_hash):
+        state = self.state
+        # The index is shared with newer states, the Blocks past our height aren't ours yet
+        position = state.positions.get(block_hash)
+        if position is None or position >= len(state.chain):
+            return None
+        return state.chain[position]
+
+    def valid_headers(self, headers, previous_header=None):
+        """
+        Determine if a run of headers is linked and carries valid proofs
+        :param headers: <list> Headers, in chain order
+        :param previous_header: (Optional) <dict> Header the run builds on
+        :return: <bool> True if valid, False if not
+        """
+        last_header = previous_header
+        for header in headers:
+            if last_header is not None:
+                if header['index'] != last_header['index'] + 1:
+                    return False
+                if header['previous_hash'] != last_header['hash']:
+                    return False
+                if not self.valid_proof(last_header['proof'], header['proof'], header['previous_hash']):
+                    return False
+                if header['timestamp'] <= last_header['timestamp']:
+                    return False
+            last_header = header
+        return True
     
     def new_transaction(self, sender, recipient, amount, signature=None, public_key=None):
         """
@@ -67,31 +304,24 @@ class Blockchain():
             ValueError: insufficient balance
 
         Returns:
-            _type_: _description_
+            int: the index of the Block the transaction will be in
         """
         transaction = {
             'sender': sender,
             'recipient': recipient,
             'amount': amount,
         }
-        if signature and public_key:
-            if Security.verify_signature(transaction, signature, public_key):
-                if self.check_balance(transaction):
-                    self.update_balances(transaction)
-                    self.mempool.add_transaction(transaction)
-                    return self.last_block['index'] + 1
-                else:
-                    raise ValueError("Insufficient balance")
-            else:
-                raise ValueError("Invalid transaction signature")
-        else:
-            if self.check_balance(sender, amount):
-                self.update_balances(transaction)
-                self.mempool.add_transactions(transaction)
-                return self.last_block['index'] + 1
-            else:
-                raise ValueError("Insufficient balance")
-            
+        if signature and public_key and not Security.verify_signature(transaction, signature, public_key):
+            raise ValueError("Invalid transaction signature")
+        # Not a chain change: admitted by the calling thread under the sender's and recipient's shard locks,
+        # so admissions touching other shards don't wait for it, nor for the writer
+        with self.mempool.locked(sender, recipient):
+            self.mempool.transfer(sender, recipient, amount)
+            # Numbered in the order the balances moved, and announced before a Block can take it
+            self.mempool.insert(transaction)
+            self.emit('mempool_add', transaction)
+        return len(self.chain) + 1
+
     def get_transaction(self, transaction_id):
         for block in self.chain:
             for transaction in block['transactions']:
@@ -99,8 +329,37 @@ class Blockchain():
                     return transaction
         return None
             
+    def expire_transactions(self, max_age):
+        """
+        Drops the transactions that stayed too long in the mempool and gives the amounts back.
+        A transaction whose amount the recipient already spent stays, until a Block takes it.
+        :param max_age: <int> Seconds a transaction can wait for a Block
+        :return: <int> Number of expired transactions
+        """
+        return self.writer.submit(self._expire_transactions, max_age)
+
+    def _expire_transactions(self, max_age):
+        expired = self.mempool.expire(max_age, self._refund)
+        if expired:
+            logging.info(f"Expired {len(expired)} transactions from the mempool")
+            self.emit('mempool_remove', {'reason': 'expired', 'transactions': expired})
+        return len(expired)
+
+    def _refund(self, transaction):
+        # Gives the amount back to the sender, unless the recipient spent it already:
+        # taking it back would leave them a negative balance, so the transaction stays for a Block.
+        # The mempool holds the sender's and recipient's shard locks, see Mempool.expire
+        recipient = transaction['recipient']
+        if recipient != transaction['sender'] and self.mempool.balance(recipient) < transaction['amount']:
+            return False
+        if transaction['sender'] != "0":
+            self.mempool.credit(transaction['sender'], transaction['amount'])
+        self.mempool.credit(recipient, -transaction['amount'])
+        return True
+
     def check_balance(self, account, amount):
-        return account == "0" or (account in self.balances and self.balances[account] >= amount)
+        balances = self.balances
+        return account == "0" or (account in balances and balances[account] >= amount)
     
     @property
     def last_block(self):
@@ -109,14 +368,8 @@ class Blockchain():
     def update_balances(self, transaction):
         sender = transaction['sender']
         recipient = transaction['recipient']
-        amount = transaction['amount']
-        
-        if sender != "0":  # "0" is used for mining rewards
-            if sender not in self.balances or self.balances[sender] < amount:
-                raise ValueError("Insufficient balance")
-            self.balances[sender] -= amount
-            
-        self.balances[recipient] = self.balances.get(recipient, 0) + amount
+        with self.mempool.locked(sender, recipient):
+            self.mempool.transfer(sender, recipient, transaction['amount'])
     
     @staticmethod
     def hash(block):
@@ -130,21 +383,38 @@ class Blockchain():
         block_string = json.dumps(block, sort_keys=True).encode()
         return hashlib.sha256(block_string).hexdigest()
     
-    def proof_or_work(self, last_block):
+    def proof_or_work(self, last_block, executor=None):
         """
         Simple Proof of Work Algorithm:
          - Find a number p' such that hash(pp') contains leading 4 zeroes
          - Where p is the previous proof, and p' is the new proof
         :param last_block: <dict> last Block
+        :param executor: (Optional) <Executor> Run the search there, eg. a process pool,
+                         so it doesn't hold the GIL of the threads serving requests
         :return: <int>
         """
         logging.info(f"Starting proof of work for block {last_block['index']}")
         last_proof = last_block['proof']
         last_hash = self.hash(last_block)
+        start = perf_counter()
+        if executor is not None:
+            proof = executor.submit(Blockchain.find_proof, last_proof, last_hash).result()
+        else:
+            proof = self.find_proof(last_proof, last_hash)
+        elapsed = perf_counter() - start
+        # The search tries the proofs from 0 up, so the proof is also the number of hashes
+        POW_SECONDS.observe(elapsed)
+        POW_HASHES.inc(proof + 1)
+        if elapsed > 0:
+            HASHRATE.set((proof + 1) / elapsed)
+        logging.info(f"Proof of work completed. Proof: {proof}")
+        return proof
+
+    @staticmethod
+    def find_proof(last_proof, last_hash):
         proof = 0
-        while self.valid_proof(last_proof, proof, last_hash) is False:
+        while Blockchain.valid_proof(last_proof, proof, last_hash) is False:
             proof += 1
-        logging.info(f"Proof of work completed. Proof: {proof}")
         return proof
     
     @staticmethod
@@ -178,6 +448,7 @@ class Blockchain():
             logging.error(f"Error registering node {address}: {str(e)}")
             raise
     
+    @VALIDATION_SECONDS.time()
     def valid_chain(self, chain):
         """
         Determine if a given blockchain is valid
@@ -186,14 +457,11 @@ class Blockchain():
         """
         last_block = chain[0]
         current_index = 1
+        BLOCKS_VALIDATED.inc(len(chain) - 1)
         
         while current_index < len(chain):
             block = chain[current_index]
 
-            print(f'{last_block}')
-            print(f'{block}')
-            print("\n-----------\n")
-
             if block['previous_hash'] != self.hash(last_block):
                 return False
 
@@ -220,33 +488,144 @@ class Blockchain():
         # - Is the transaction format correct?
         return all(k in transaction for k in ['sender', 'recipient', 'amount'])
     
+    @staticmethod
+    def new_peer_session():
+        """
+        Creates a requests Session that keeps connections to peers alive
+        :return: <requests.Session>
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=PEER_FETCH_WORKERS, pool_maxsize=PEER_FETCH_WORKERS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def conditional_get(self, url, params=None):
+        """
+        GET a peer resource, sending back the ETag we remembered for it.
+        An unchanged resource costs a 304 with an empty body.
+        :param url: <str> URL of the resource
+        :param params: (Optional) <dict> Query parameters
+        :return: <requests.Response>
+        """
+        headers = {}
+        etag = self.peer_etags.get((url, tuple(sorted((params or {}).items()))))
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        return self.session.get(url, params=params, headers=headers, timeout=PEER_TIMEOUT)
+
+    def remember_etag(self, url, params, etag):
+        """
+        Sends etag with the next conditional_get of the resource, so a 304 means "nothing new".
+        Only call it once the answer was used up: adopted, or known to have nothing for us,
+        a download or validation that failed must get the whole answer again next time.
+        :param etag: <str> ETag of the answer, or None
+        """
+        if etag is not None:
+            self.peer_etags[(url, tuple(sorted((params or {}).items())))] = etag
+
+    def fetch_chain(self, node):
+        """
+        Downloads the chain of a single peer
+        :param node: <str> Address of the peer. Eg. '192.168.0.5:5000'
+        :return: <tuple> (node, chain or None, latency in seconds, ETag of the chain or None)
+        """
+        start = perf_counter()
+        try:
+            response = self.conditional_get(f'http://{node}/chain')
+            latency = perf_counter() - start
+            if response.status_code == 304:
+                # Same chain as the last one we adopted or had no use for
+                logging.debug(f"Peer {node} chain unchanged ({latency:.3f}s)")
+                self.nodes.record_success(node, latency)
+                return node, None, latency, None
+            if response.status_code != 200:
+                logging.warning(f"Peer {node} answered {response.status_code} in {latency:.3f}s")
+                self.nodes.record_failure(node)
+                return node, None, latency, None
+            chain = response.json()['chain']
+            self.nodes.record_success(node, latency, len(response.content))
+            return node, chain, latency, response.headers.get('ETag')
+        except (requests.RequestException, ValueError, KeyError) as e:
+            latency = perf_counter() - start
+            logging.warning(f"Failed to fetch chain from {node} after {latency:.3f}s: {str(e)}")
+            self.nodes.record_failure(node)
+            return node, None, latency, None
+
+    @RESOLVE_SECONDS.time()
     def resolve_conflicts(self):
         """
         This is our Consensus Algorithm, it resolves conflicts
         by replacing our chain with the longest one in the network.
+        Peers are queried concurrently, so a slow peer doesn't hold back the others.
         :return: <bool> True if our chain was replaced, False if not
         """
-        neighbours = self.nodes
+        neighbours = list(self.nodes)
         new_chain = None
+        new_chain_from = None
         max_length = len(self.chain)
+
+        if not neighbours:
+            return False
+
+        with ThreadPoolExecutor(max_workers=min(PEER_FETCH_WORKERS, len(neighbours))) as executor:
+            futures = [executor.submit(self.fetch_chain, node) for node in neighbours]
+            for future in as_completed(futures):
+                node, chain, latency, etag = future.result()
+                if latency > SLOW_PEER_SECONDS:
+                    logging.info(f"Slow peer {node}: {latency:.3f}s")
+                if chain is None:
+                    continue
+
+                if len(chain) <= len(self.chain):
+                    # No longer than ours, until it changes there is nothing to adopt
+                    self.remember_etag(f'http://{node}/chain', None, etag)
+                elif len(chain) > max_length:
+                    if self.valid_chain(chain):
+                        max_length = len(chain)
+                        new_chain = chain
+                        new_chain_from = (node, etag)
+                    else:
+                        self.nodes.record_invalid(node)
         
-        for node in neighbours:
-            response = requests.get(f'http//{node}/chain')
-            
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-                
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
-        
-        if new_chain:
-            self.chain = new_chain
+        # Our chain may have grown while we were fetching, the writer checks the length again
+        if new_chain and self.replace_chain(new_chain):
+            node, etag = new_chain_from
+            self.remember_etag(f'http://{node}/chain', None, etag)
+            CHAIN_REPLACEMENTS.inc()
             return True
         
         return False
     
+    def save_snapshot(self, path):
+        """
+        Writes the chain to a file, through a temporary file so a crash never leaves half a snapshot
+        :param path: <str> Path of the snapshot
+        """
+        chain = self.chain[:]  # a list of the Blocks of one state
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as snapshot:
+            json.dump(chain, snapshot)
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path):
+        """
+        Loads a chain snapshot if it is valid and longer than our chain
+        :param path: <str> Path of the snapshot
+        :return: <bool> True if the snapshot was loaded
+        """
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path) as snapshot:
+                chain = json.load(snapshot)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading chain snapshot {path}: {str(e)}")
+            return False
+        if len(chain) > len(self.chain) and self.valid_chain(chain):
+            return self.replace_chain(chain)
+        return False
+
     def add_smart_contract(self, contract):
         contract_address = hashlib.sha256(contract.code.encode()).hexdigest()
         self.smart_contracts[contract_address] = contract
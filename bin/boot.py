@@ -0,0 +1,51 @@
+'''
+This module times the node's startup.
+Importing the app only builds in-memory objects, everything with side effects (files, network, threads)
+runs in an explicit boot sequence, one timed phase at a time, and the report is logged and served at /nodes/boot.
+Work that can wait for the network (syncing, asking the registry for peers) is left to the scheduler,
+so it doesn't hold back the start of the API.
+
+Neetre 2024
+'''
+
+import logging
+from time import perf_counter, time
+from contextlib import contextmanager
+
+
+class BootSequence:
+    def __init__(self):
+        self.started = perf_counter()
+        self.last = self.started
+        self.phases = []  # (name, seconds)
+        self.ready_at = None
+
+    def mark(self, name):
+        """
+        Ends a phase that started when the last one ended, eg. 'imports'
+        """
+        now = perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    @contextmanager
+    def phase(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.last = perf_counter()
+            self.phases.append((name, self.last - start))
+
+    def ready(self):
+        self.ready_at = time()
+        self.last = perf_counter()
+        logging.info(f"Node ready in {self.last - self.started:.3f}s: " +
+                     ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases))
+
+    def report(self):
+        return {
+            'phases': [{'name': name, 'seconds': seconds} for name, seconds in self.phases],
+            'total_seconds': self.last - self.started,
+            'ready_at': self.ready_at,
+        }
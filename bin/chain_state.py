@@ -0,0 +1,233 @@
+'''
+This module keeps the chain state consistent when many threads use the node at once.
+Request threads, gossip, the scheduler's jobs and mining all change the chain: every change is handed
+to one writer thread, which applies them one at a time in the order they came,
+so a chain swap by the consensus can't land in the middle of /mine appending a block.
+New transactions aren't chain changes, they are admitted under the mempool's shard locks, see mempool.py.
+Readers never lock: they read the last published ChainState, an immutable view that the writer replaces
+with a single assignment after each batch of changes. Expensive checks (signatures, whole chains)
+are done by the caller before the change is submitted, the writer only re-checks what depends on the tip.
+
+Neetre 2024
+'''
+
+import queue
+import logging
+import threading
+from collections import namedtuple
+from collections.abc import Mapping, Sequence
+from concurrent.futures import Future
+from config import CHAIN_WRITER_BATCH
+
+
+class ChainView(Sequence):
+    '''
+    The first `height` Blocks of an append-only list.
+    The writer only ever appends to the list (a new chain is a new list), so the view never changes.
+    '''
+    __slots__ = ('blocks', 'height')
+
+    def __init__(self, blocks, height):
+        self.blocks = blocks
+        self.height = height
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.height)
+            if step > 0:
+                return self.blocks[start:stop:step]
+            # A stop of -1 means "past the first one" here, but "the last one" to the list
+            return [self.blocks[j] for j in range(start, stop, step)]
+        if i < 0:
+            i += self.height
+        if not 0 <= i < self.height:
+            raise IndexError('chain index out of range')
+        return self.blocks[i]
+
+    def __iter__(self):
+        blocks = self.blocks
+        for i in range(self.height):
+            yield blocks[i]
+
+    def __repr__(self):
+        return f'ChainView(height={self.height})'
+
+
+class Balances(Mapping):
+    '''
+    Immutable account -> balance mapping: a base dict with layers of changes on top, oldest first.
+    A new one costs the accounts that changed, not all of them. Layers of similar size are merged,
+    so there are O(log n) of them, and they are folded into a new base once they changed half as many accounts.
+    '''
+    __slots__ = ('base', 'layers', 'layered')
+
+    def __init__(self, base=None, layers=(), layered=0):
+        self.base = base if base is not None else {}
+        self.layers = layers
+        self.layered = layered  # accounts written to the layers, repeats included
+
+    def changed(self, changes, current):
+        """
+        :param changes: <dict> Accounts changed since this mapping, with their new balance
+        :param current: <dict> All the balances, copied when the layers are folded into the base
+        :return: <Balances> A new mapping with the changes
+        """
+        if not changes:
+            return self
+        layered = self.layered + len(changes)
+        if layered > len(self.base) // 2:
+            return Balances(dict(current))
+        layers = list(self.layers) + [dict(changes)]
+        while len(layers) > 1 and len(layers[-2]) <= 2 * len(layers[-1]):
+            newest = layers.pop()
+            merged = dict(layers.pop())
+            merged.update(newest)
+            layers.append(merged)
+        return Balances(self.base, tuple(layers), layered)
+
+    def __getitem__(self, account):
+        for layer in reversed(self.layers):
+            if account in layer:
+                return layer[account]
+        return self.base[account]
+
+    def _merged(self):
+        merged = dict(self.base)
+        for layer in self.layers:
+            merged.update(layer)
+        return merged
+
+    def __iter__(self):
+        return iter(self._merged())
+
+    def __len__(self):
+        return len(self._merged())
+
+
+# chain: <ChainView>, positions: <dict> Block hash -> position (only the ones below the height count),
+# version: <int> changes with the chain, tip: <str> hash of the last Block,
+# mempool: <MempoolView> the transactions pending for this chain: ones in a newer Block still show, see mempool.py
+ChainState = namedtuple('ChainState', ['chain', 'positions', 'version', 'tip', 'mempool'])
+
+
+class ChainWriter:
+    '''
+    Runs the submitted changes one at a time on its own thread, in submission order.
+    After each batch it calls publish(), so readers see the whole batch or none of it.
+    Without a thread (threaded=False) the calling thread applies its change under a lock and publishes it,
+    for single threaded users like the simulator that would only pay for the hand-off.
+    '''
+    STOP = object()
+
+    def __init__(self, publish, name='chain-writer', threaded=True):
+        self.publish = publish
+        self.name = name
+        self.threaded = threaded
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.ident = None
+        self.stopped = False
+        self.lock = threading.RLock()  # guards starting the thread, or applying the changes without one
+        self.applied = 0
+        self.batches = 0
+
+    def on_writer_thread(self):
+        return threading.get_ident() == self.ident
+
+    def submit(self, change, *args):
+        """
+        Applies change(*args) on the writer thread and waits for it
+        :return: What change returned, its exception is raised here
+        :raises RuntimeError: if the writer was stopped
+        """
+        if self.on_writer_thread():
+            return change(*args)  # a change made by another change, eg. from a listener
+        if not self.threaded:
+            return self.apply(change, args)
+        future = Future()
+        with self.lock:
+            # Under the lock, so nothing is queued behind the stop
+            if self.stopped:
+                raise RuntimeError("The chain writer is stopped")
+            self.queue.put((future, change, args))
+            if self.thread is None:
+                self.start()
+        return future.result()
+
+    def apply(self, change, args):
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("The chain writer is stopped")
+            self.ident = threading.get_ident()
+            try:
+                return change(*args)
+            finally:
+                self.ident = None
+                self.safe_publish()
+                self.applied += 1
+                self.batches += 1
+
+    def safe_publish(self):
+        # A failing publish mustn't kill the writer, or every later submit would wait forever
+        try:
+            self.publish()
+        except Exception:
+            logging.exception("Error publishing the chain state")
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the writer once the changes already submitted are applied, later submits raise RuntimeError
+        :param timeout: (Optional) <float> Seconds to wait for the thread
+        """
+        with self.lock:
+            self.stopped = True
+            thread = self.thread
+            if thread is not None:
+                self.queue.put(self.STOP)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def run(self):
+        self.ident = threading.get_ident()
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < CHAIN_WRITER_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # Nothing is queued after the stop, see submit
+            stop = batch[-1] is self.STOP
+            if stop:
+                batch.pop()
+            done = []
+            try:
+                for future, change, args in batch:
+                    try:
+                        done.append((future, change(*args), None))
+                    except BaseException as e:
+                        done.append((future, None, e))
+                self.safe_publish()
+                self.applied += len(batch)
+                self.batches += 1
+            finally:
+                # Only now, so a caller reads its own change as soon as it returns
+                for future, result, error in done:
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(error)
+            if stop:
+                return
+
+    def stats(self):
+        return {'applied': self.applied, 'batches': self.batches, 'queued': self.queue.qsize()}
@@ -0,0 +1,51 @@
+'''
+This module builds the /chain responses for the node APIs.
+Blocks are written one by one from a generator, so serving a long chain
+never holds the whole JSON document in memory.
+
+Neetre 2024
+'''
+
+import json
+from flask import Response, stream_with_context
+from config import CHAIN_PAGE_LIMIT
+
+
+def chain_response(blockchain, args, accept=''):
+    """
+    Serves the chain, or a range of it, as streamed JSON or NDJSON
+    :param blockchain: <Blockchain> The node's blockchain
+    :param args: <dict> Query parameters: start, limit, format
+    :param accept: <str> Accept header of the request
+    :return: <Response>
+    """
+    start = args.get('start', default=1, type=int)
+    limit = args.get('limit', default=None, type=int)
+    if limit is not None:
+        limit = min(limit, CHAIN_PAGE_LIMIT)
+    chain = blockchain.chain  # one snapshot for the length and the Blocks
+    length = len(chain)
+    blocks = blockchain.iter_blocks(start, limit, chain)
+
+    if args.get('format') == 'ndjson' or 'application/x-ndjson' in accept:
+        return Response(stream_with_context(ndjson_blocks(blocks)), mimetype='application/x-ndjson')
+    return Response(stream_with_context(json_chain(blocks, length, start, limit)), mimetype='application/json')
+
+
+def ndjson_blocks(blocks):
+    for block in blocks:
+        yield json.dumps(block) + '\n'
+
+
+def json_chain(blocks, length, start=1, limit=None):
+    """
+    Writes {"chain": [...], "length": N} piece by piece.
+    Pages also carry their start and limit so clients can ask for the next one.
+    """
+    yield '{"chain": ['
+    for i, block in enumerate(blocks):
+        yield (', ' if i else '') + json.dumps(block)
+    yield f'], "length": {length}'
+    if limit is not None:
+        yield f', "start": {start}, "limit": {limit}'
+    yield '}'
@@ -0,0 +1,212 @@
+'''
+This is a headers-first sync for the blockchain.
+The node first downloads and checks the chain of headers (links and proof of work) from the best peer,
+then downloads the block bodies in parallel batches from every peer that has them.
+
+Neetre 2024
+'''
+
+import logging
+from time import perf_counter
+from itertools import cycle
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from config import PEER_TIMEOUT, PEER_FETCH_WORKERS, HEADERS_PER_REQUEST, BODIES_PER_REQUEST
+from admission import coalesced
+
+
+class ChainSync:
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.session = blockchain.session
+        # The scheduler, gossip and /nodes/sync can ask at the same time, they share one sync
+        self.sync = coalesced(self.sync)
+
+    def fetch_headers(self, node, start, count=HEADERS_PER_REQUEST, conditional=False):
+        """
+        Downloads a range of headers from a peer
+        :param node: <str> Address of the peer
+        :param start: <int> Index of the first header
+        :param count: <int> Number of headers
+        :param conditional: <bool> Send the ETag remembered for this request, the page then carries
+                            the new one as 'etag' for the caller to remember once it used the page
+        :return: <dict> {'headers': [...], 'height': <int>} or None if failed or unchanged
+        """
+        url = f'http://{node}/headers'
+        params = {'from': start, 'count': count}
+        start_time = perf_counter()
+        try:
+            if conditional:
+                response = self.blockchain.conditional_get(url, params)
+            else:
+                response = self.session.get(url, params=params, timeout=PEER_TIMEOUT)
+            if response.status_code == 200:
+                page = response.json()
+                if conditional:
+                    page['etag'] = response.headers.get('ETag')
+                self.blockchain.nodes.record_success(node, perf_counter() - start_time, len(response.content))
+                return page
+            if response.status_code == 304:
+                self.blockchain.nodes.record_success(node, perf_counter() - start_time)
+                return None
+            logging.warning(f"Peer {node} answered {response.status_code} to a headers request")
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(f"Error getting headers from {node}: {str(e)}")
+        self.blockchain.nodes.record_failure(node)
+        return None
+
+    def fetch_bodies(self, node, hashes):
+        """
+        Downloads a batch of blocks by hash from a peer
+        :param node: <str> Address of the peer
+        :param hashes: <list> Block hashes
+        :return: <list> Blocks, in the same order, or None
+        """
+        start_time = perf_counter()
+        try:
+            response = self.session.post(f'http://{node}/blocks/batch', json={'hashes': hashes}, timeout=PEER_TIMEOUT)
+            if response.status_code == 200:
+                blocks = response.json()['blocks']
+                if len(blocks) == len(hashes) and all(
+                        block is not None and self.blockchain.hash(block) == block_hash
+                        for block, block_hash in zip(blocks, hashes)):
+                    self.blockchain.nodes.record_success(node, perf_counter() - start_time, len(response.content))
+                    return blocks
+                logging.warning(f"Peer {node} served blocks that don't match the requested hashes")
+                self.blockchain.nodes.record_invalid(node)
+                return None
+            logging.warning(f"Peer {node} answered {response.status_code} to a blocks request")
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.warning(f"Error getting blocks from {node}: {str(e)}")
+        self.blockchain.nodes.record_failure(node)
+        return None
+
+    def best_peers(self, peers):
+        """
+        Asks every peer for the header after our tip and sorts them by height
+        :param peers: <list> Peers to probe
+        :return: <list> (height, node) for peers taller than us, tallest first
+        """
+        our_height = len(self.blockchain.chain)
+        heights = []
+        with ThreadPoolExecutor(max_workers=min(PEER_FETCH_WORKERS, len(peers))) as executor:
+            # A 304 means the same answer as a probe that showed the peer wasn't taller than us
+            futures = {executor.submit(self.fetch_headers, node, our_height, 1, True): node for node in peers}
+            for future in as_completed(futures):
+                result = future.result()
+                if not result:
+                    continue
+                if result.get('height', 0) > our_height:
+                    heights.append((result['height'], futures[future]))
+                else:
+                    # Taller peers aren't remembered: if the sync from them fails, the next probe must see them again
+                    self.blockchain.remember_etag(f'http://{futures[future]}/headers',
+                                                  {'from': our_height, 'count': 1}, result.get('etag'))
+        # Tallest first, and the better scored peer among peers of the same height
+        rank = {node: i for i, node in enumerate(peers)}
+        return sorted(heights, key=lambda peer: (-peer[0], rank[peer[1]]))
+
+    def download_headers(self, node, chain):
+        """
+        Downloads the headers we are missing from one peer and checks them as they arrive.
+        When the peer doesn't build on our tip we start again from the genesis Block.
+        :param node: <str> Address of the peer
+        :param chain: <ChainView> Our chain, the fork is found against it
+        :return: <tuple> (fork position, headers) or (None, None) if the peer served bad headers
+        """
+        start = len(chain)
+        page = self.fetch_headers(node, start)
+        if not page or not page['headers']:
+            return None, None
+        if page['headers'][0]['hash'] != self.blockchain.hash(chain[start - 1]):
+            start = 1
+            page = self.fetch_headers(node, start)
+            if not page or not page['headers']:
+                return None, None
+
+        headers = []
+        while page and page['headers']:
+            previous_header = headers[-1] if headers else None
+            if not self.blockchain.valid_headers(page['headers'], previous_header):
+                logging.warning(f"Peer {node} served an invalid header chain")
+                self.blockchain.nodes.record_invalid(node)
+                return None, None
+            headers.extend(page['headers'])
+            if len(page['headers']) < HEADERS_PER_REQUEST:
+                break
+            page = self.fetch_headers(node, start + len(headers))
+
+        # Skip the headers we already have, the fork is where they stop matching our chain
+        fork = 0
+        while fork < len(headers) and headers[fork]['index'] <= len(chain) \
+                and headers[fork]['hash'] == self.blockchain.hash(chain[headers[fork]['index'] - 1]):
+            fork += 1
+        if fork == 0 and headers[0]['index'] == 1:
+            return None, None  # different genesis Block
+        return headers[fork - 1]['index'], headers[fork:]
+
+    def download_bodies(self, headers, peers):
+        """
+        Downloads the blocks for the given headers in parallel, spreading batches over the peers.
+        A batch that fails is retried on the next peer.
+        :param headers: <list> Headers of the blocks to download
+        :param peers: <list> Peers that have the blocks
+        :return: <list> Blocks, in chain order, or None
+        """
+        hashes = [header['hash'] for header in headers]
+        batches = [hashes[i:i + BODIES_PER_REQUEST] for i in range(0, len(hashes), BODIES_PER_REQUEST)]
+        results = [None] * len(batches)
+        peer_cycle = cycle(peers)
+
+        with ThreadPoolExecutor(max_workers=min(PEER_FETCH_WORKERS, len(batches))) as executor:
+            pending = {executor.submit(self.fetch_bodies, next(peer_cycle), batch): (i, 1) for i, batch in enumerate(batches)}
+            while pending:
+                future = next(as_completed(pending))
+                i, attempts = pending.pop(future)
+                blocks = future.result()
+                if blocks is not None:
+                    results[i] = blocks
+                elif attempts < len(peers):
+                    pending[executor.submit(self.fetch_bodies, next(peer_cycle), batches[i])] = (i, attempts + 1)
+                else:
+                    logging.error(f"No peer could serve blocks {batches[i][0]}..{batches[i][-1]}")
+                    return None
+
+        return [block for batch in results for block in batch]
+
+    def sync(self):
+        """
+        Brings our chain up to date with the tallest valid peer
+        :return: <bool> True if our chain was extended or replaced, False if not
+        """
+        peers = self.blockchain.nodes.best()
+        if not peers:
+            return False
+
+        for height, node in self.best_peers(peers):
+            # One snapshot for the fork and the prefix, a reorg meanwhile would make them disagree
+            chain = self.blockchain.chain
+            fork, headers = self.download_headers(node, chain)
+            if headers is None or fork + len(headers) <= len(chain):
+                continue
+
+            # Bodies are the bulk of the download, spread them over the fastest peers
+            body_peers = [node] + [peer for peer in self.blockchain.nodes.best(key='throughput') if peer != node]
+            blocks = self.download_bodies(headers, body_peers)
+            if blocks is None:
+                continue
+
+            new_chain = chain[:fork] + blocks
+            # The prefix is ours and already valid, only check from the fork point on
+            if self.blockchain.valid_chain(new_chain[fork - 1:]):
+                if not self.blockchain.replace_chain(new_chain):
+                    return False  # our chain grew past it meanwhile
+                logging.info(f"Synced {len(blocks)} blocks from {node}, height is now {len(new_chain)}")
+                return True
+            if self.blockchain.chain[-1] is not chain[-1]:
+                logging.info(f"Our chain moved while syncing from {node}, not holding it against the peer")
+                continue
+            logging.warning(f"Blocks downloaded for {node}'s headers are invalid")
+            self.blockchain.nodes.record_invalid(node)
+
+        return False
@@ -0,0 +1,74 @@
+'''
+This is a compact block format for relaying new blocks.
+Instead of every full transaction, a compact block carries the header and a short id for each transaction.
+The receiving node rebuilds the block from its own mempool and asks only for the transactions it is missing.
+
+Neetre 2024
+'''
+
+import json
+import hashlib
+
+SHORT_ID_LENGTH = 12  # hex characters, 6 bytes
+
+
+def short_id(transaction, salt):
+    """
+    Short id of a transaction inside one block.
+    The salt (the previous block hash) changes every block, so collisions can't be planned ahead.
+    :param transaction: <dict> Transaction
+    :param salt: <str> Previous hash of the block
+    :return: <str>
+    """
+    data = f"{salt}{json.dumps(transaction, sort_keys=True)}".encode()
+    return hashlib.sha256(data).hexdigest()[:SHORT_ID_LENGTH]
+
+
+def compact_block(block):
+    """
+    Builds the compact form of a Block
+    :param block: <dict> Block
+    :return: <dict> Header fields plus the short ids of the transactions
+    """
+    salt = str(block['previous_hash'])
+    return {
+        'index': block['index'],
+        'timestamp': block['timestamp'],
+        'proof': block['proof'],
+        'previous_hash': block['previous_hash'],
+        'short_ids': [short_id(transaction, salt) for transaction in block['transactions']],
+    }
+
+
+def reconstruct(compact, transactions):
+    """
+    Rebuilds a Block from its compact form and the transactions we already have
+    :param compact: <dict> Compact block
+    :param transactions: <list> Candidate transactions, usually our mempool
+    :return: <tuple> (Block with None where a transaction is missing, indexes of the missing transactions)
+    """
+    salt = str(compact['previous_hash'])
+    known = {short_id(transaction, salt): transaction for transaction in transactions}
+    block_transactions = [known.get(sid) for sid in compact['short_ids']]
+    missing = [i for i, transaction in enumerate(block_transactions) if transaction is None]
+    block = {
+        'index': compact['index'],
+        'timestamp': compact['timestamp'],
+        'transactions': block_transactions,
+        'proof': compact['proof'],
+        'previous_hash': compact['previous_hash'],
+    }
+    return block, missing
+
+
+def fill_missing(block, missing, transactions):
+    """
+    Puts the transactions we asked for in their place
+    :param block: <dict> Block returned by reconstruct
+    :param missing: <list> Indexes of the missing transactions
+    :param transactions: <list> The transactions, in the same order as missing
+    :return: <dict> The complete Block
+    """
+    for i, transaction in zip(missing, transactions):
+        block['transactions'][i] = transaction
+    return block
@@ -1,3 +1,82 @@
-PROOF_OF_WORK_DIFFICULTY = "0000000"
+import os
+
+PROOF_OF_WORK_DIFFICULTY = os.environ.get('STELLANOVA_POW_DIFFICULTY', "0000000")  # local test networks mine at a lower one
 MINING_REWARD = 1
 COIN_VALUE = 0.00001
+SIGNING_SESSION_TTL = 300  # seconds an unlocked wallet key stays in memory without use
+PEER_TIMEOUT = (3.05, 10)  # connect, read timeout in seconds for peer requests
+PEER_FETCH_WORKERS = 8
+SLOW_PEER_SECONDS = 2
+HEADERS_PER_REQUEST = 2000
+BODIES_PER_REQUEST = 100
+CHAIN_PAGE_LIMIT = 500  # max blocks in one paginated /chain response
+GOSSIP_SEEN_SIZE = 100000  # inventory ids remembered to stop relay loops
+GOSSIP_LATENCY_SAMPLES = 1000
+PEER_DEFAULT_RTT = 1.0  # seconds assumed for peers we haven't measured yet
+PEER_BACKOFF_BASE = 5  # seconds, doubled on every consecutive failure
+PEER_BACKOFF_MAX = 600
+PEER_MAX_FAILURES = 6  # consecutive failures (or invalid answers) before a peer is evicted
+PEER_EVICT_SECONDS = 3600  # an evicted peer can't be added back before this
+PEER_INVALID_PENALTY = 5  # seconds added to the score for every invalid answer
+GOSSIP_FANOUT = 8  # best peers a new item is announced to
+REGISTRY_DB = "../data/registry.db"
+REGISTRY_NODE_TTL = 900  # seconds without a heartbeat before a node expires, nodes beat every 300
+REGISTRY_SAMPLE_SIZE = 50
+REGISTRY_MAX_SAMPLE = 1000
+REGISTRY_FLUSH_SECONDS = 5
+REGISTRY_TIMEOUT = 5
+SCHEDULER_JITTER = 0.1  # fraction of a job's interval its delay can vary by
+SCHEDULER_MAX_BACKOFF = 3600
+SCHEDULER_WORKERS = 4
+PEER_REFRESH_SECONDS = 300
+SYNC_CHECK_SECONDS = 60
+MEMPOOL_EXPIRY_SECONDS = 60
+MEMPOOL_TX_TTL = 3600  # seconds a transaction can wait in the mempool
+MEMPOOL_SHARDS = 16  # mempool shards by sender (and balances by account), each with its own lock
+SNAPSHOT_SECONDS = 600
+CHAIN_SNAPSHOT = "../data/chain_snapshot.json"
+SERVER_THREADS = 32  # request threads of the production server
+SERVER_CONNECTION_LIMIT = 5000
+CPU_WORKERS = None  # processes for proof of work, None is one per CPU
+RESPONSE_CACHE_ENTRIES = 256
+RESPONSE_CACHE_MAX_BYTES = 8 * 1024 * 1024  # bigger responses are streamed but not cached
+EXPLORER_WINDOW = 50  # blocks shown when the explorer page opens
+EXPLORER_CHUNK = 10  # blocks rendered (and cached) together
+EXPLORER_CACHED_CHUNKS = 1000
+EVENTS_BUFFER_BYTES = 256 * 1024  # events buffered per subscriber before it is dropped as too slow
+EVENTS_KEEPALIVE_SECONDS = 15
+EVENTS_MAX_SUBSCRIBERS = 10000
+EVENTS_PORT_OFFSET = 100  # the event stream listens on the API port plus this
+INGEST_CHUNK = 100  # items checked, and announced, together by the bulk endpoints
+INGEST_WORKERS = 4
+INGEST_MAX_ITEMS = 10000  # per request
+CHAIN_WRITER_BATCH = 256  # changes applied by the chain writer before readers see them
+RATE_LIMIT_ENABLED = os.environ.get('STELLANOVA_RATE_LIMIT', '1') != '0'  # off for load tests that measure the node itself
+RATE_LIMIT_RATE = 20  # tokens per second of a client
+RATE_LIMIT_BURST = 100
+RATE_LIMIT_PEER_RATE = 200  # nodes we sync with gossip and page through our chain
+RATE_LIMIT_PEER_BURST = 1000
+RATE_LIMIT_COST_PER_KB = 0.1  # bulk requests pay for their size
+RATE_LIMIT_CLIENTS = 100000
+RATE_LIMIT_COSTS = {  # tokens per request by URL rule, the rest cost 1
+    '/mine': 100,
+    '/nodes/resolve': 100,
+    '/nodes/sync': 50,
+    '/network/sync': 50,
+    '/generate_keypair': 20,
+    '/wallet': 20,
+    '/transactions/new': 5,
+    '/transactions': 5,
+    '/transactions/bulk': 10,
+    '/blocks/bulk': 10,
+    '/contracts/execute': 10,
+    '/contracts/<string:address>/execute': 10,
+    '/contracts/deploy': 10,
+    '/contracts': 10,
+}
+ADMIN_TOKEN = os.environ.get('STELLANOVA_ADMIN_TOKEN')  # the /admin routes need it in X-Admin-Token
+# Without a token the /admin routes answer to localhost, but only if turned on: behind a proxy every client is localhost
+ADMIN_LOCALHOST = os.environ.get('STELLANOVA_ADMIN', '0') == '1'
+PROFILE_MAX_SECONDS = 300
+PROFILE_SAMPLE_INTERVAL = 0.01  # seconds between stack samples
+TRACEMALLOC_FRAMES = 25
@@ -28,7 +28,7 @@ class DB_manager:
         self.create_Balance_table()
 
     def create_Wallet_table(self):
-        self.execute_sql_command("""
+        self.execute_command("""
         CREATE TABLE IF NOT EXISTS wallet (
             id PRIMARY KEY,
             username TEXT,
@@ -44,7 +44,7 @@ class DB_manager:
         """)
 
     def create_Security_table(self):
-        self.execute_sql_command("""
+        self.execute_command("""
         CREATE TABLE IF NOT EXISTS security (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             key TEXT NOT NULL,
@@ -55,7 +55,7 @@ class DB_manager:
         """)
         
     def create_Blocks_table(self):
-        self.execute_sql_command('''
+        self.execute_command('''
             CREATE TABLE IF NOT EXISTS Blocks (
                 block_hash TEXT PRIMARY KEY,
                 previous_hash TEXT,
@@ -66,7 +66,7 @@ class DB_manager:
         ''')
 
     def create_Transaction_table(self):
-        self.execute_sql_command('''
+        self.execute_command('''
             CREATE TABLE IF NOT EXISTS Transactions (
                 transaction_id INTEGER PRIMARY KEY,
                 sender_address TEXT,
@@ -78,8 +78,19 @@ class DB_manager:
             )
         ''')
 
+    def create_Mempool_table(self):
+        self.execute_command('''
+            CREATE TABLE IF NOT EXISTS Mempool (
+                transaction_id TEXT PRIMARY KEY,
+                sender_address TEXT,
+                recipient_address TEXT,
+                amount FLOAT,
+                timestamp TEXT
+            )
+        ''')
+
     def create_Balance_table(self):
-        self.execute_sql_command("""
+        self.execute_command("""
         CREATE TABLE IF NOT EXISTS balance (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             cash INTEGER,
@@ -90,7 +101,7 @@ class DB_manager:
         """)
         
     def create_Contract_table(self):
-        self.execute_sql_command('''
+        self.execute_command('''
             CREATE TABLE IF NOT EXISTS Contracts (
                 contract_id INTEGER PRIMARY KEY,
                 code TEXT,
@@ -100,27 +111,73 @@ class DB_manager:
         ''')
         
     def create_Peer_table(self):
-        self.execute_sql_command('''
+        self.execute_command('''
             CREATE TABLE IF NOT EXISTS Peers (
                 peer_id INTEGER PRIMARY KEY,
                 ip_address TEXT,
                 port INTEGER,
                 public_key TEXT,
+                rtt FLOAT,
+                throughput FLOAT,
+                successes INTEGER,
+                failures INTEGER,
+                invalid INTEGER,
+                last_seen FLOAT,
+                UNIQUE(ip_address, port)
             )
         ''')
         
     def insert_wallet(self, public_key, private_key, balance, username, email, password):
-        self.execute_sql_command(f'''
+        self.execute_command(f'''
             INSERT INTO Wallet (public_key, private_key, balance, username, email, password)
             VALUES ('{public_key}', '{private_key}', {balance}, '{username}', '{email}', '{password}')
         ''')
     
     def insert_block(self, block_hash, previous_hash, nonce, timestamp, transactions):
-        self.execute_sql_command(f'''
+        self.execute_command(f'''
             INSERT INTO Blocks (block_hash, previous_hash, nonce, timestamp, transactions)
             VALUES ('{block_hash}', '{previous_hash}', {nonce}, '{timestamp}', '{transactions}')
         ''')
 
+    def save_peers(self, peers):
+        """
+        Saves the address book, replacing the old one
+        :param peers: <list> dicts with address, rtt, throughput, successes, failures, invalid, last_seen
+        """
+        rows = []
+        for peer in peers:
+            ip_address, _, port = peer['address'].rpartition(':')
+            if not ip_address or not port.isdigit():
+                ip_address, port = peer['address'], None
+            rows.append((ip_address, port, peer['rtt'], peer['throughput'], peer['successes'],
+                         peer['failures'], peer['invalid'], peer['last_seen']))
+        try:
+            self.cursor.execute('DELETE FROM Peers')
+            self.cursor.executemany('''
+                INSERT INTO Peers (ip_address, port, rtt, throughput, successes, failures, invalid, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            self.conn.commit()
+        except Exception as e:
+            print(f"An error occoured: {e}")
+
+    def load_peers(self):
+        self.cursor.execute('''
+            SELECT ip_address, port, rtt, throughput, successes, failures, invalid, last_seen FROM Peers
+        ''')
+        peers = []
+        for ip_address, port, rtt, throughput, successes, failures, invalid, last_seen in self.cursor.fetchall():
+            peers.append({
+                'address': f'{ip_address}:{port}' if port is not None else ip_address,
+                'rtt': rtt,
+                'throughput': throughput,
+                'successes': successes or 0,
+                'failures': failures or 0,
+                'invalid': invalid or 0,
+                'last_seen': last_seen,
+            })
+        return peers
+
     # can be static? or should I make it self??
     def search_user(self, user_id):
         self.cursor.execute(f"""
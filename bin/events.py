@@ -0,0 +1,153 @@
+'''
+This module pushes node events (new blocks, reorgs, mempool adds and removes) to subscribers as server-sent events.
+The stream is served by a small asyncio server on its own port and thread, so thousands of open connections
+don't each hold one of the API's request threads.
+Publishing only hands the event to the event loop, the chain code never waits on subscribers.
+Every subscriber has a bounded queue (the write buffer of its connection), a subscriber that falls behind is dropped.
+
+Neetre 2024
+'''
+
+import json
+import asyncio
+import logging
+import threading
+from time import time
+from urllib.parse import urlparse, parse_qs
+from config import EVENTS_BUFFER_BYTES, EVENTS_KEEPALIVE_SECONDS, EVENTS_MAX_SUBSCRIBERS
+
+EVENT_TYPES = ('block', 'reorg', 'mempool_add', 'mempool_remove')
+
+
+class Subscriber:
+    def __init__(self, types, writer):
+        self.types = types
+        self.writer = writer
+        self.closed = asyncio.Event()
+
+    def send(self, message):
+        """
+        Queues a message on the connection, the transport's write buffer is the subscriber's queue
+        :return: <bool> False if the subscriber is too far behind
+        """
+        self.writer.write(message)
+        return self.writer.transport.get_write_buffer_size() <= EVENTS_BUFFER_BYTES
+
+
+class EventBus:
+    def __init__(self):
+        self.subscribers = set()
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.published = 0
+        self.dropped = 0
+
+    # Called from any thread
+    def publish(self, event, data):
+        """
+        Send an event to every subscriber
+        :param event: <str> One of EVENT_TYPES
+        :param data: JSON serializable payload
+        """
+        if self.loop is None or not self.subscribers:
+            return
+        # Serialized once for all the subscribers
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+        self.loop.call_soon_threadsafe(self._fanout, event, message)
+
+    def __call__(self, event, data):
+        self.publish(event, data)
+
+    # Event loop side
+    def _fanout(self, event, message):
+        self.published += 1
+        for subscriber in list(self.subscribers):
+            if event not in subscriber.types:
+                continue
+            if not subscriber.send(message):
+                self.dropped += 1
+                self._close(subscriber)
+
+    def _close(self, subscriber):
+        self.subscribers.discard(subscriber)
+        subscriber.writer.transport.abort()  # doesn't wait for the buffered events
+        subscriber.closed.set()
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), EVENTS_KEEPALIVE_SECONDS)
+            while (await asyncio.wait_for(reader.readline(), EVENTS_KEEPALIVE_SECONDS)) not in (b'\r\n', b'\n', b''):
+                pass  # headers are not needed
+            parts = request_line.decode('latin-1').split()
+            url = urlparse(parts[1]) if len(parts) == 3 else None
+            if url is None or parts[0] != 'GET' or url.path != '/events':
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                return
+            if len(self.subscribers) >= EVENTS_MAX_SUBSCRIBERS:
+                writer.write(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                return
+
+            requested = parse_qs(url.query).get('types', [','.join(EVENT_TYPES)])[0].split(',')
+            subscriber = Subscriber({event for event in requested if event in EVENT_TYPES}, writer)
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                         b'Access-Control-Allow-Origin: *\r\nConnection: keep-alive\r\n\r\n'
+                         b': connected\n\n')
+            self.subscribers.add(subscriber)
+            try:
+                # Events are written by _fanout, this only keeps the connection alive and notices when it ends
+                while not subscriber.closed.is_set():
+                    try:
+                        await asyncio.wait_for(reader.read(1024), EVENTS_KEEPALIVE_SECONDS)
+                        if reader.at_eof():
+                            break
+                    except asyncio.TimeoutError:
+                        if not subscriber.send(b': keepalive\n\n'):
+                            self.dropped += 1
+                            break
+            finally:
+                self._close(subscriber)
+        except (asyncio.TimeoutError, ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve(self, host, port, started):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logging.info(f"Serving events on {host}:{port}/events")
+        started.set()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start(self, host='0.0.0.0', port=5100):
+        """
+        Starts the event server on its own daemon thread
+        """
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(self._serve(host, port, started))
+            except asyncio.CancelledError:
+                pass
+            except OSError as e:
+                logging.error(f"Error starting the event server: {str(e)}")
+                started.set()
+
+        self.thread = threading.Thread(target=run, name='events', daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self):
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    def stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'published': self.published,
+            'dropped': self.dropped,
+            'time': time(),
+        }
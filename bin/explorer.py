@@ -0,0 +1,54 @@
+'''
+This module renders the block list of the explorer page.
+Only a window of the most recent blocks is rendered, older ones are loaded by the page through /chain?start=&limit=.
+Blocks are rendered in fixed chunks and each chunk's HTML is cached, keyed by the hash of its last block,
+so a new block only renders the newest chunk again.
+
+Neetre 2024
+'''
+
+import threading
+from collections import OrderedDict
+from config import EXPLORER_WINDOW, EXPLORER_CHUNK, EXPLORER_CACHED_CHUNKS
+
+
+class Explorer:
+    def __init__(self, blockchain, window=EXPLORER_WINDOW, chunk=EXPLORER_CHUNK):
+        self.blockchain = blockchain
+        self.window = window
+        self.chunk = chunk
+        self.fragments = OrderedDict()  # (first index, last index, hash of the last block) -> HTML
+        self.lock = threading.Lock()
+
+    def render_window(self, render):
+        """
+        HTML of the most recent blocks, newest first
+        :param render: <callable> Renders a list of blocks to HTML
+        :return: <tuple> (HTML, index of the oldest block shown)
+        """
+        chain = self.blockchain.chain
+        height = len(chain)
+        # Start the window on a chunk boundary so only the newest chunk is ever partial
+        first = max(1, (height - self.window) // self.chunk * self.chunk + 1)
+        parts = []
+        # Chunk k holds the blocks with index k * chunk + 1 ... (k + 1) * chunk
+        for k in range((height - 1) // self.chunk, (first - 1) // self.chunk - 1, -1):
+            low = max(k * self.chunk + 1, first)
+            high = min((k + 1) * self.chunk, height)
+            parts.append(self.render_chunk(chain, low, high, render))
+        return ''.join(parts), first
+
+    def render_chunk(self, chain, low, high, render):
+        # The hash of the last block commits to the whole range, so a reorg changes the key
+        key = (low, high, self.blockchain.hash(chain[high - 1]))
+        with self.lock:
+            html = self.fragments.get(key)
+            if html is not None:
+                self.fragments.move_to_end(key)
+                return html
+        html = render(list(reversed(chain[low - 1:high])))
+        with self.lock:
+            self.fragments[key] = html
+            while len(self.fragments) > EXPLORER_CACHED_CHUNKS:
+                self.fragments.popitem(last=False)
+        return html
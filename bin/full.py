@@ -15,8 +15,7 @@ Neetre 2024
 
 import hashlib
 import json
-import time
-from time import time
+from time import time, sleep
 from urllib.parse import urlparse
 import requests
 import logging
@@ -386,7 +385,6 @@ registry_url = "http://127.0.0.1:5001"  # Replace with your actual registry serv
 peer_discovery = PeerDiscovery(registry_url)
 
 my_node_url = "http://127.0.0.1:5000"  # Replace with your actual node URL
-peer_discovery.register(my_node_url)
 
 
 @app.route('/')
@@ -539,11 +537,7 @@ def update_peers_periodically():
         peers = peer_discovery.get_peers()
         for peer in peers:
             blockchain.register_node(peer)
-        time.sleep(300)
-
-
-peer_update_thread = threading.Thread(target=update_peers_periodically)
-peer_update_thread.start()
+        sleep(300)
 
 
 if __name__ == '__main__':
@@ -552,4 +546,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
     port = args.port
 
+    peer_discovery.register(f"http://127.0.0.1:{port}")  # not at import, importing the module has no side effects
+    peer_update_thread = threading.Thread(target=update_peers_periodically, daemon=True)
+    peer_update_thread.start()
+
     app.run(host='0.0.0.0', port=port)
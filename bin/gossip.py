@@ -0,0 +1,275 @@
+'''
+This is a simple push gossip layer for blocks and transactions.
+When a node mines a block or admits a transaction it announces the inventory hash to its peers,
+the peers pull only the items they haven't seen and announce them in turn.
+A bounded seen-set stops the announcements from looping around the network.
+
+Neetre 2024
+'''
+
+import json
+import hashlib
+import logging
+import threading
+from time import time, perf_counter
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.backends import default_backend
+from compact_block import compact_block, reconstruct, fill_missing
+from config import PEER_TIMEOUT, PEER_FETCH_WORKERS, GOSSIP_SEEN_SIZE, GOSSIP_LATENCY_SAMPLES, GOSSIP_FANOUT
+
+
+class Gossip:
+    def __init__(self, blockchain, node_address, chain_sync=None):
+        """
+        :param blockchain: <Blockchain> The node's blockchain
+        :param node_address: <str> Our address as peers see it. Eg. '192.168.0.5:5000'
+        :param chain_sync: (Optional) <ChainSync> Used to catch up when a block doesn't fit on our tip
+        """
+        self.blockchain = blockchain
+        self.node_address = node_address
+        self.chain_sync = chain_sync
+        self.session = blockchain.session
+        self.seen = OrderedDict()
+        self.pulling = set()  # items being pulled, unmarked as seen if the pull fails
+        self.transactions = OrderedDict()  # txid -> signed transaction, served to peers that pull it
+        self.latencies = deque(maxlen=GOSSIP_LATENCY_SAMPLES)
+        self.counters = {'compact_blocks': 0, 'missing_transactions': 0, 'full_blocks': 0}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=PEER_FETCH_WORKERS, thread_name_prefix='gossip')
+
+    @staticmethod
+    def transaction_id(transaction):
+        return hashlib.sha256(json.dumps(transaction, sort_keys=True).encode()).hexdigest()
+
+    def mark_seen(self, item_id):
+        """
+        Remember an inventory id
+        :param item_id: <str> Block hash or transaction id
+        :return: <bool> True if it is new to us, False if we had seen it already
+        """
+        with self.lock:
+            if item_id in self.seen:
+                return False
+            self.seen[item_id] = time()
+            if len(self.seen) > GOSSIP_SEEN_SIZE:
+                self.seen.popitem(last=False)
+            return True
+
+    def unmark_seen(self, item_id):
+        # So the next announcement of it, from any peer, is pulled again
+        with self.lock:
+            self.seen.pop(item_id, None)
+
+    @staticmethod
+    def valid_inventory(items, origin):
+        """
+        :return: <bool> True if items is a list of inventory entries and origin an address
+        """
+        return isinstance(origin, str) and isinstance(items, list) and all(
+            isinstance(item, dict) and item.get('type') in ('block', 'tx') and isinstance(item.get('hash'), str)
+            for item in items)
+
+    # Outgoing
+    def announce(self, items, exclude=None):
+        """
+        Send inventory to our best peers but the one we got it from, without waiting for them
+        :param items: <list> Inventory entries {'type', 'hash', 'created'}
+        :param exclude: (Optional) <str> Peer to skip
+        """
+        peers = [node for node in self.blockchain.nodes.best() if node != exclude and node != self.node_address]
+        for node in peers[:GOSSIP_FANOUT]:
+            self.executor.submit(self._send_inventory, node, items)
+
+    def _send_inventory(self, node, items):
+        start = perf_counter()
+        try:
+            response = self.session.post(f'http://{node}/gossip/inv', json={'inventory': items, 'origin': self.node_address}, timeout=PEER_TIMEOUT)
+            response.raise_for_status()  # a peer answering with errors isn't a good peer
+            self.blockchain.nodes.record_success(node, perf_counter() - start)
+        except requests.RequestException as e:
+            logging.warning(f"Error announcing inventory to {node}: {str(e)}")
+            self.blockchain.nodes.record_failure(node)
+
+    def announce_block(self, block, created=None, exclude=None):
+        block_hash = self.blockchain.hash(block)
+        self.mark_seen(block_hash)
+        self.announce([{'type': 'block', 'hash': block_hash, 'created': created or time()}], exclude)
+
+    def announce_transaction(self, transaction, signature, public_key, created=None, exclude=None):
+        """
+        Keep a signed transaction for peers to pull, and announce it
+        :param transaction: <dict> The transaction
+        :param signature: <str> Hex signature
+        :param public_key: <str> PEM public key of the sender
+        """
+        self.announce([self.keep_transaction(transaction, signature, public_key, created)], exclude)
+
+    def keep_transaction(self, transaction, signature, public_key, created=None):
+        """
+        Keep a signed transaction for peers to pull, without announcing it yet
+        :return: <dict> Its inventory entry
+        """
+        txid = self.transaction_id(transaction)
+        with self.lock:
+            self.transactions[txid] = {'transaction': transaction, 'signature': signature, 'public_key': public_key}
+            if len(self.transactions) > GOSSIP_SEEN_SIZE:
+                self.transactions.popitem(last=False)
+        self.mark_seen(txid)
+        return {'type': 'tx', 'hash': txid, 'created': created or time()}
+
+    def get_transaction(self, txid):
+        with self.lock:
+            return self.transactions.get(txid)
+
+    # Incoming
+    def receive_inventory(self, items, origin):
+        """
+        Handle an announcement: pull the items we don't have from the peer that sent it
+        :param items: <list> Inventory entries, checked with valid_inventory
+        :param origin: <str> Address of the announcing peer
+        :return: <list> Hashes we are going to pull
+        """
+        wanted = []
+        for item in items:
+            if item.get('type') == 'block' and self.blockchain.get_block_by_hash(item['hash']) is not None:
+                continue
+            if self.mark_seen(item['hash']):
+                wanted.append(item)
+                with self.lock:
+                    self.pulling.add(item['hash'])
+                self.executor.submit(self._pull, origin, item)
+        return [item['hash'] for item in wanted]
+
+    def _pull(self, origin, item):
+        pulled = False
+        try:
+            pulled = self._pull_item(origin, item)
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Error pulling {item['type']} {item['hash']} from {origin}: {str(e)}")
+        finally:
+            with self.lock:
+                self.pulling.discard(item['hash'])
+            if not pulled:
+                self.unmark_seen(item['hash'])
+
+    def _pull_item(self, origin, item):
+        """
+        :return: <bool> False if origin didn't serve the item, another peer announcing it may
+        """
+        if item['type'] == 'block':
+            block = self.pull_compact_block(origin, item['hash'])
+            if block is None:
+                response = self.session.get(f'http://{origin}/blocks/{item["hash"]}', timeout=PEER_TIMEOUT)
+                if response.status_code != 200:
+                    return False
+                block = response.json()
+                self.count('full_blocks')
+            return self.accept_block(block, item, origin)
+        response = self.session.get(f'http://{origin}/gossip/transactions/{item["hash"]}', timeout=PEER_TIMEOUT)
+        if response.status_code != 200:
+            return False
+        return self.accept_transaction(response.json(), item, origin)
+
+    def pull_compact_block(self, origin, block_hash):
+        """
+        Downloads the compact form of a block and rebuilds it from our mempool,
+        pulling only the transactions we don't have
+        :return: <dict> The Block, or None if it couldn't be rebuilt
+        """
+        response = self.session.get(f'http://{origin}/gossip/compact/{block_hash}', timeout=PEER_TIMEOUT)
+        if response.status_code != 200:
+            return None
+        block, missing = reconstruct(response.json(), self.blockchain.mempool.all_transactions())
+        if missing:
+            response = self.session.post(f'http://{origin}/gossip/compact/{block_hash}/transactions',
+                                         json={'indexes': missing}, timeout=PEER_TIMEOUT)
+            if response.status_code != 200:
+                return None
+            block = fill_missing(block, missing, response.json()['transactions'])
+            self.count('missing_transactions', len(missing))
+        if self.blockchain.hash(block) != block_hash:
+            return None  # short id collision, fall back to the full block
+        self.count('compact_blocks')
+        return block
+
+    def compact_block(self, block_hash):
+        block = self.blockchain.get_block_by_hash(block_hash)
+        return compact_block(block) if block is not None else None
+
+    def block_transactions(self, block_hash, indexes):
+        block = self.blockchain.get_block_by_hash(block_hash)
+        if block is None:
+            return None
+        return [block['transactions'][i] for i in indexes if 0 <= i < len(block['transactions'])]
+
+    def accept_block(self, block, item, origin):
+        """
+        :return: <bool> False if the block isn't the announced one
+        """
+        if self.blockchain.hash(block) != item['hash']:
+            logging.warning(f"Peer {origin} served a block that doesn't match {item['hash']}")
+            self.blockchain.nodes.record_invalid(origin)
+            return False
+        if self.blockchain.add_block(block):
+            self.record_latency(item)
+            self.announce([item], exclude=origin)
+        elif block['index'] > len(self.blockchain.chain) and self.chain_sync is not None:
+            # We are behind or on another fork, let the headers-first sync sort it out
+            self.blockchain.register_node(origin)
+            if self.chain_sync.sync():
+                self.record_latency(item)
+                self.announce([item], exclude=origin)
+        return True
+
+    def accept_transaction(self, envelope, item, origin):
+        """
+        :return: <bool> False if the transaction isn't the announced one
+        """
+        transaction = envelope['transaction']
+        if self.transaction_id(transaction) != item['hash']:
+            logging.warning(f"Peer {origin} served a transaction that doesn't match {item['hash']}")
+            self.blockchain.nodes.record_invalid(origin)
+            return False
+        public_key = serialization.load_pem_public_key(envelope['public_key'].encode(), backend=default_backend())
+        try:
+            self.blockchain.new_transaction(
+                transaction['sender'],
+                transaction['recipient'],
+                transaction['amount'],
+                bytes.fromhex(envelope['signature']),
+                public_key
+            )
+        except ValueError as e:
+            logging.info(f"Rejected transaction {item['hash']} from {origin}: {str(e)}")
+            return True  # it was the announced one, just not valid for us
+        with self.lock:
+            self.transactions[item['hash']] = envelope
+        self.record_latency(item)
+        self.announce([item], exclude=origin)
+        return True
+
+    # Propagation latency, from the first announcement to our acceptance
+    def record_latency(self, item):
+        if 'created' in item:
+            self.latencies.append(time() - item['created'])
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {'samples': 0, 'pulling': len(self.pulling), **self.counters}
+        return {
+            **self.counters,
+            'pulling': len(self.pulling),
+            'samples': len(latencies),
+            'mean': sum(latencies) / len(latencies),
+            'p50': latencies[len(latencies) // 2],
+            'p95': latencies[int(len(latencies) * 0.95)],
+            'max': latencies[-1],
+        }
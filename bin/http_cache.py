@@ -0,0 +1,167 @@
+'''
+This module adds conditional GET, compression and a response cache to the read endpoints.
+ETags are derived from the tip hash, so a peer polling an unchanged chain
+gets back an empty 304 instead of the whole document.
+The cache keeps the finished (compressed) bytes of each response until the tip or the mempool changes.
+
+Neetre 2024
+'''
+
+import zlib
+import hashlib
+import threading
+from functools import wraps
+from collections import OrderedDict
+from flask import request, make_response, Response
+from config import RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_MAX_BYTES
+
+# wbits for zlib.compressobj: 31 writes a gzip container, 15 the zlib format HTTP calls "deflate"
+ENCODINGS = {'gzip': 31, 'deflate': 15}
+MIN_COMPRESS_SIZE = 512
+
+
+def chain_etag(blockchain):
+    """
+    ETag of a chain response: the tip hash plus the query and representation asked for
+    :param blockchain: <Blockchain> The node's blockchain
+    :return: <str>
+    """
+    variant = f"{request.query_string.decode()}|{request.headers.get('Accept', '')}"
+    return f"{blockchain.tip_hash}-{hashlib.sha256(variant.encode()).hexdigest()[:16]}"
+
+
+class ResponseCache:
+    def __init__(self, state_version, max_entries=RESPONSE_CACHE_ENTRIES, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        """
+        :param state_version: <callable> Returns a value that changes whenever the tip or the mempool change
+        :param max_entries: <int> Responses kept, least recently used are dropped first
+        :param max_bytes: <int> Bigger responses are served but not cached
+        """
+        self.state_version = state_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (version, headers, body)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, headers, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            self.entries[key] = (version, headers, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def store(self, key, version, response):
+        headers = [(name, value) for name, value in response.headers.items() if name != 'Content-Length']
+        if response.is_streamed:
+            response.response = self.tee(key, version, headers, response.response)
+        else:
+            self.put(key, version, headers, response.get_data())
+
+    def tee(self, key, version, headers, chunks):
+        # Stream to the client and keep a copy, unless the body turns out too big to cache
+        body = []
+        size = 0
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if body is not None:
+                size += len(chunk)
+                if size > self.max_bytes:
+                    body = None
+                else:
+                    body.append(chunk)
+            yield chunk
+        if body is not None:
+            self.put(key, version, headers, b''.join(body))
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': sum(len(entry[2]) for entry in self.entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else None,
+            }
+
+
+def conditional(etag_for=None, cache=None):
+    """
+    Decorator for GET views: answers If-None-Match with 304 before the view runs,
+    serves the cached bytes while the state is unchanged, otherwise tags, compresses and caches the response.
+    :param etag_for: (Optional) <callable> Takes the view's arguments, returns the ETag or None
+    :param cache: (Optional) <ResponseCache> Where to keep the finished responses
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            encoding = request.accept_encodings.best_match(list(ENCODINGS))
+            etag = etag_for(*args, **kwargs) if etag_for is not None else None
+            if etag is not None:
+                if encoding:
+                    etag = f'{etag}-{encoding}'  # strong ETags must differ per encoding
+                if request.if_none_match.contains(etag):
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    response.vary.add('Accept-Encoding')
+                    return response
+
+            if cache is not None:
+                version = cache.state_version()
+                key = (request.path, request.query_string, request.headers.get('Accept', ''), encoding)
+                entry = cache.get(key, version)
+                if entry is not None:
+                    return Response(entry[2], status=200, headers=entry[1])
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            if encoding:
+                compress(response, encoding)
+            if etag is not None:
+                response.set_etag(etag)
+            if cache is not None:
+                cache.store(key, version, response)
+            return response
+        return wrapper
+    return decorator
+
+
+def compress(response, encoding):
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        compressor = zlib.compressobj(6, zlib.DEFLATED, ENCODINGS[encoding])
+        response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def compress_chunks(chunks, encoding):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, ENCODINGS[encoding])
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
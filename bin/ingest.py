@@ -0,0 +1,190 @@
+'''
+This module takes transactions and blocks in bulk, as NDJSON (one item per line) or a JSON array.
+Items go through a pipeline: parsed as they are read, checked in parallel (signatures, keys, shape),
+then applied to the chain in order. A result line is streamed back for every item as soon as it is known,
+so one bad entry only fails itself and a big batch doesn't wait for its end to answer.
+Accepted items are announced to peers once per chunk instead of once per item.
+
+Neetre 2024
+'''
+
+import json
+import logging
+from itertools import islice
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, stream_with_context
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.backends import default_backend
+from security import Security
+from config import INGEST_CHUNK, INGEST_WORKERS, INGEST_MAX_ITEMS
+
+TRANSACTION_FIELDS = ('sender', 'recipient', 'amount', 'public_key', 'signature')
+BLOCK_FIELDS = ('index', 'timestamp', 'transactions', 'proof', 'previous_hash')
+
+
+class IngestError(Exception):
+    pass
+
+
+def read_items(stream, content_type):
+    """
+    The items of a request body, NDJSON is read lazily and a malformed line is yielded as an IngestError
+    :param stream: File-like body of the request
+    :param content_type: <str> 'application/x-ndjson' for one item per line, JSON array otherwise
+    :return: <iterable> Items
+    :raises ValueError: The body is not a JSON array
+    """
+    if 'ndjson' in (content_type or ''):
+        return ndjson_items(stream)
+    items = json.load(stream)
+    if not isinstance(items, list):
+        raise ValueError("Expected a JSON array")
+    return items
+
+
+def ndjson_items(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield IngestError(f"Malformed JSON: {str(e)}")
+
+
+def bulk_response(process, request):
+    """
+    Streams back the result of every item of a bulk request as NDJSON
+    :param process: <callable> BulkIngest.transactions or BulkIngest.blocks
+    :param request: <Request> The Flask request
+    :return: <Response>
+    """
+    try:
+        items = read_items(request.stream, request.content_type)
+    except ValueError as e:
+        return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+    results = (json.dumps(result) + '\n' for result in process(items))
+    return Response(stream_with_context(results), mimetype='application/x-ndjson')
+
+
+@lru_cache(maxsize=1024)
+def load_public_key(pem):
+    # Bulk senders sign with few keys, don't parse the same PEM for every transaction
+    return serialization.load_pem_public_key(pem.encode(), backend=default_backend())
+
+
+class BulkIngest:
+    def __init__(self, blockchain, gossip=None, workers=INGEST_WORKERS, chunk=INGEST_CHUNK):
+        """
+        :param blockchain: <Blockchain> The node's blockchain
+        :param gossip: (Optional) <Gossip> Announces the accepted items
+        :param workers: <int> Threads checking items
+        :param chunk: <int> Items checked together, and announced together
+        """
+        self.blockchain = blockchain
+        self.gossip = gossip
+        self.chunk = chunk
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+
+    def _chunks(self, items):
+        items = enumerate(islice(items, INGEST_MAX_ITEMS))
+        while True:
+            chunk = list(islice(items, self.chunk))
+            if not chunk:
+                return
+            yield chunk
+
+    def _checked(self, items, check):
+        # The next chunk is being checked while the current one is applied
+        pending = None
+        for chunk in self._chunks(items):
+            submitted = [(position, self.executor.submit(check, item)) for position, item in chunk]
+            if pending is not None:
+                yield pending
+            pending = submitted
+        if pending is not None:
+            yield pending
+
+    # Transactions
+    @staticmethod
+    def check_transaction(item):
+        if isinstance(item, Exception):
+            raise item
+        if not isinstance(item, dict) or not all(k in item for k in TRANSACTION_FIELDS):
+            raise IngestError('Missing values')
+        transaction = {
+            'sender': item['sender'],
+            'recipient': item['recipient'],
+            'amount': item['amount']
+        }
+        try:
+            public_key = load_public_key(item['public_key'])
+            signature = bytes.fromhex(item['signature'])
+        except (ValueError, TypeError) as e:
+            raise IngestError(f"Malformed key or signature: {str(e)}")
+        if not Security.verify_signature(transaction, signature, public_key):
+            raise IngestError('Invalid signature')
+        return transaction, item['signature'], item['public_key']
+
+    def transactions(self, items):
+        """
+        Adds signed transactions to the mempool
+        :param items: <iterable> dicts with the fields of /transactions/new
+        :return: <generator> One result per item, in order: {'item', 'accepted', 'block' or 'error'}
+        """
+        for chunk in self._checked(items, self.check_transaction):
+            announced = []
+            for position, future in chunk:
+                try:
+                    transaction, signature, public_key = future.result()
+                    # The signature was checked above, only the balance is left
+                    index = self.blockchain.new_transaction(transaction['sender'], transaction['recipient'], transaction['amount'])
+                except (IngestError, ValueError) as e:
+                    yield {'item': position, 'accepted': False, 'error': str(e)}
+                    continue
+                except Exception as e:
+                    logging.error(f"Error ingesting transaction {position}: {str(e)}")
+                    yield {'item': position, 'accepted': False, 'error': str(e)}
+                    continue
+                if self.gossip is not None:
+                    announced.append(self.gossip.keep_transaction(transaction, signature, public_key))
+                yield {'item': position, 'accepted': True, 'block': index}
+            if announced:
+                self.gossip.announce(announced)
+
+    # Blocks
+    def check_block(self, item):
+        if isinstance(item, Exception):
+            raise item
+        if not isinstance(item, dict) or not all(k in item for k in BLOCK_FIELDS):
+            raise IngestError('Missing values')
+        if not all(self.blockchain.valid_transaction(transaction) for transaction in item['transactions']):
+            raise IngestError('Invalid transaction')
+        return item, self.blockchain.hash(item)
+
+    def blocks(self, items):
+        """
+        Appends blocks to our tip, in the order given
+        :param items: <iterable> Blocks
+        :return: <generator> One result per item, in order: {'item', 'accepted', 'hash' or 'error'}
+        """
+        for chunk in self._checked(items, self.check_block):
+            announced = []
+            for position, future in chunk:
+                try:
+                    block, block_hash = future.result()
+                except (IngestError, TypeError, ValueError) as e:
+                    yield {'item': position, 'accepted': False, 'error': str(e)}
+                    continue
+                if self.blockchain.get_block_by_hash(block_hash) is not None:
+                    yield {'item': position, 'accepted': False, 'hash': block_hash, 'error': 'Already in the chain'}
+                elif self.blockchain.add_block(block):
+                    if self.gossip is not None and self.gossip.mark_seen(block_hash):
+                        announced.append({'type': 'block', 'hash': block_hash, 'created': block['timestamp']})
+                    yield {'item': position, 'accepted': True, 'hash': block_hash}
+                else:
+                    yield {'item': position, 'accepted': False, 'hash': block_hash, 'error': "Doesn't fit on our tip"}
+            if announced:
+                self.gossip.announce(announced)
@@ -0,0 +1,298 @@
+'''
+This script load tests a local network: it starts a registry (register_server.py) and N nodes (app.py)
+on localhost, each in its own working directory, drives signed transactions, mining, chain reads and
+consensus calls at them at fixed rates, and reports throughput, latency percentiles and error rates per endpoint.
+Everything runs on the loopback interface, no network access is needed.
+
+Requests are sent open loop, at the configured rate whatever the nodes answer, and latency is counted from
+when a request was due, so a node that falls behind shows it in the percentiles instead of slowing the load down.
+The nodes mine at a low difficulty (--difficulty), the rate limiter is on unless --no-rate-limit.
+The transactions come from a sender that is funded on every node before the clock starts, so they go through
+the balance checks like real ones. --sender 0 uses the mint address instead, which skips the checks.
+
+Usage: python load_test.py --nodes 3 --duration 60 --tx-rate 50 --mine-rate 0.5 --read-rate 20 --resolve-rate 0.5
+
+Neetre 2024
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from time import perf_counter
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from cryptography.hazmat.primitives import serialization
+from bench_ingest import signed_transactions
+from security import Security
+
+BIN = os.path.dirname(os.path.abspath(__file__))
+TIMEOUT = 30
+
+
+def wait_for(url, process, log, timeout=60):
+    """
+    Polls url until it answers 200
+    :param process: <Popen> Serving url, if it exits there is no point in waiting
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode}, see {log}")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} didn't answer in {timeout}s, see {log}")
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class LocalNetwork:
+    '''
+    A registry and N nodes on localhost. Each process runs in its own directory,
+    so their snapshots, address books and databases (all under ../data) don't mix.
+    '''
+    def __init__(self, nodes, base_port=6000, difficulty='0000', rate_limit=True, server='production', root=None):
+        self.root = root or tempfile.mkdtemp(prefix='stellanova-load-')
+        self.registry_port = base_port
+        self.ports = [base_port + 1 + 2 * i for i in range(nodes)]  # each node's event stream on port + 1
+        self.server = server
+        self.env = dict(os.environ, STELLANOVA_POW_DIFFICULTY=difficulty, STELLANOVA_RATE_LIMIT='1' if rate_limit else '0')
+        self.processes = []  # (name, process, log)
+
+    @property
+    def registry(self):
+        return f'http://127.0.0.1:{self.registry_port}'
+
+    @property
+    def nodes(self):
+        return [f'http://127.0.0.1:{port}' for port in self.ports]
+
+    def spawn(self, name, script, *args):
+        cwd = os.path.join(self.root, name, 'bin')
+        os.makedirs(cwd)
+        os.makedirs(os.path.join(self.root, name, 'data'))
+        log = os.path.join(self.root, f'{name}.log')
+        with open(log, 'wb') as output:
+            # In its own process group, with the proof of work pool it forks
+            process = subprocess.Popen([sys.executable, os.path.join(BIN, script), *args], cwd=cwd, env=self.env,
+                                       stdout=output, stderr=subprocess.STDOUT, start_new_session=True)
+        self.processes.append((name, process, log))
+        return process, log
+
+    def start(self):
+        process, log = self.spawn('registry', 'register_server.py', '--host', '127.0.0.1', '--port', str(self.registry_port))
+        wait_for(f'{self.registry}/peers', process, log)
+        started = []
+        for i, port in enumerate(self.ports):
+            started.append(self.spawn(f'node{i}', 'app.py', '--port', str(port), '--events-port', str(port + 1),
+                                      '--registry', self.registry, '--server', self.server))
+        for node, (process, log) in zip(self.nodes, started):
+            wait_for(f'{node}/nodes/boot', process, log)
+        # The nodes find each other through the registry too, but only at their next peer refresh
+        for node in self.nodes:
+            peers = [peer for peer in self.nodes if peer != node]
+            if peers:
+                requests.post(f'{node}/nodes/register', json={'nodes': peers}, timeout=TIMEOUT)
+
+    def fund(self, sender, amount):
+        """
+        Mints amount to sender on every node. Each node keeps its own balances, and the load's transactions
+        reach every node through gossip, so each one needs the whole amount. A node that also gets the
+        mint from a peer before our request just ends up with more than enough.
+        """
+        private_key, public_key = Security.generate_keypair()
+        transaction = {'sender': '0', 'recipient': sender, 'amount': amount}
+        transaction['signature'] = Security.sign_with_key(transaction, private_key).hex()
+        transaction['public_key'] = public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode()
+        for node in self.nodes:
+            response = requests.post(f'{node}/transactions/new', json=transaction, timeout=TIMEOUT)
+            if response.status_code != 201:
+                raise RuntimeError(f"Couldn't fund {sender} on {node}: {response.status_code} {response.text}")
+
+    def heights(self):
+        heights = {}
+        for node in self.nodes:
+            try:
+                heights[node] = requests.get(f'{node}/headers', params={'count': 0}, timeout=TIMEOUT).json()['height']
+            except (requests.RequestException, ValueError, KeyError):
+                heights[node] = None
+        return heights
+
+    def stop(self, keep=False):
+        for name, process, log in reversed(self.processes):
+            # Interrupted like with Ctrl+C, so the node shuts its process pool down and saves its snapshot
+            process.send_signal(signal.SIGINT if os.name == 'posix' else signal.SIGTERM)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                if os.name == 'posix':
+                    os.killpg(process.pid, signal.SIGKILL)
+                else:
+                    process.kill()
+        if keep:
+            print(f"Logs and data kept in {self.root}")
+        else:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+class LoadGenerator:
+    '''
+    Sends each operation at its own rate to a random node, from a pool of worker threads
+    '''
+    def __init__(self, nodes, workers=64):
+        self.nodes = nodes
+        self.workers = workers
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def call(self, name, request, due):
+        try:
+            status = request(self.session(), random.choice(self.nodes)).status_code
+        except requests.RequestException:
+            status = 'error'
+        latency = perf_counter() - due
+        with self.lock:
+            self.latencies[name].append(latency)
+            self.statuses[name][status] += 1
+
+    def schedule(self, executor, name, rate, request, start, duration):
+        count = int(rate * duration)
+        for i in range(count):
+            due = start + i / rate
+            delay = due - perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(self.call, name, request, due)
+
+    def run(self, operations, duration):
+        """
+        :param operations: <dict> name -> (requests per second, function(session, node) -> Response)
+        :param duration: <float> Seconds of load
+        :return: <float> Seconds until the last answer
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            start = perf_counter()
+            schedulers = [threading.Thread(target=self.schedule, args=(executor, name, rate, request, start, duration))
+                          for name, (rate, request) in operations.items() if rate > 0]
+            for scheduler in schedulers:
+                scheduler.start()
+            for scheduler in schedulers:
+                scheduler.join()
+        return perf_counter() - start
+
+    def report(self, elapsed):
+        report = {}
+        for name, latencies in self.latencies.items():
+            statuses = self.statuses[name]
+            ordered = sorted(latencies)
+            ok = sum(count for status, count in statuses.items() if status != 'error' and 200 <= status < 300)
+            limited = statuses.get(429, 0)
+            errors = len(ordered) - ok - limited
+            report[name] = {
+                'requests': len(ordered),
+                'ok': ok,
+                'rate_limited': limited,
+                'rate_limited_rate': limited / len(ordered),
+                'errors': errors,
+                'error_rate': errors / len(ordered),
+                'throughput': ok / elapsed,
+                'p50': percentile(ordered, 0.5),
+                'p90': percentile(ordered, 0.9),
+                'p99': percentile(ordered, 0.99),
+                'max': ordered[-1],
+                'statuses': {str(status): count for status, count in statuses.items()},
+            }
+        return report
+
+
+def operations(args, transactions):
+    transactions = iter(transactions)
+    return {
+        'POST /transactions/new': (args.tx_rate, lambda session, node: session.post(
+            f'{node}/transactions/new', json=next(transactions), timeout=TIMEOUT)),
+        'GET /mine': (args.mine_rate, lambda session, node: session.get(f'{node}/mine', timeout=TIMEOUT)),
+        'GET /chain': (args.read_rate, lambda session, node: session.get(
+            f'{node}/chain', params={'limit': args.read_limit}, timeout=TIMEOUT)),
+        'GET /nodes/resolve': (args.resolve_rate, lambda session, node: session.get(f'{node}/nodes/resolve', timeout=TIMEOUT)),
+    }
+
+
+def print_report(report, elapsed):
+    print(f"\n{'endpoint':<24} {'requests':>8} {'ok/s':>8} {'429':>6} {'429%':>6} {'errors':>6} {'err%':>6} "
+          f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, result in report.items():
+        print(f"{name:<24} {result['requests']:>8} {result['throughput']:>8.1f} {result['rate_limited']:>6} "
+              f"{result['rate_limited_rate']:>6.1%} {result['errors']:>6} {result['error_rate']:>6.1%} " +
+              ' '.join(f"{result[key] * 1000:>8.1f}" for key in ('p50', 'p90', 'p99', 'max')))
+    print(f"{elapsed:.1f}s until the last answer")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', default=3, type=int, help='node processes to start')
+    parser.add_argument('--base-port', default=6000, type=int, help='port of the registry, the nodes take the ones after it')
+    parser.add_argument('--duration', default=60, type=float, help='seconds of load')
+    parser.add_argument('--tx-rate', default=20, type=float, help='signed transactions per second, over all nodes')
+    parser.add_argument('--mine-rate', default=0.5, type=float, help='/mine calls per second')
+    parser.add_argument('--read-rate', default=20, type=float, help='/chain reads per second')
+    parser.add_argument('--read-limit', default=100, type=int, help='blocks per /chain read')
+    parser.add_argument('--resolve-rate', default=0.5, type=float, help='/nodes/resolve calls per second')
+    parser.add_argument('--workers', default=64, type=int, help='requests in flight at most')
+    parser.add_argument('--difficulty', default='0000', help='proof of work difficulty of the nodes')
+    parser.add_argument('--sender', default='load-test', help='sender of the transactions, funded on every node before the run, '
+                                                              "'0' mints instead and skips the balance checks")
+    parser.add_argument('--server', default='production', choices=['dev', 'production'], help='server the nodes run')
+    parser.add_argument('--no-rate-limit', action='store_true', help="turn the nodes' rate limiter off")
+    parser.add_argument('--output', default=None, help='write the report as JSON here')
+    parser.add_argument('--keep', action='store_true', help='keep the logs and data of the nodes')
+    args = parser.parse_args()
+
+    network = LocalNetwork(args.nodes, args.base_port, args.difficulty, not args.no_rate_limit, args.server)
+    failed = True
+    try:
+        print(f"Starting a registry and {args.nodes} nodes in {network.root}")
+        network.start()
+        # Signed before the clock starts, so the load generator doesn't compete with the nodes for CPU
+        transactions = signed_transactions(int(args.tx_rate * args.duration), args.sender)
+        if args.sender != '0':
+            network.fund(args.sender, sum(transaction['amount'] for transaction in transactions))
+        load = LoadGenerator(network.nodes, args.workers)
+        work = operations(args, transactions)
+        print(f"Running for {args.duration:.0f}s")
+        elapsed = load.run(work, args.duration)
+        report = load.report(elapsed)
+        heights = network.heights()
+        print_report(report, elapsed)
+        print(f"Chain heights: {', '.join(str(height) for height in heights.values())}")
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump({'config': vars(args), 'elapsed': elapsed, 'endpoints': report, 'heights': heights}, file, indent=2)
+        failed = False
+    finally:
+        network.stop(args.keep or failed)
@@ -1,20 +1,280 @@
 '''
-This is a simple mempool implementation for a blockchain
+This is a simple mempool implementation for a blockchain.
+Transactions are sharded by sender address, each shard with its own lock, and so are the balances, by account:
+a transaction is admitted under the locks of its sender's and recipient's shards only, where its balance check,
+the debit, the credit and the insert happen at once. Request threads admit transactions side by side,
+only those touching the same shards wait for each other, the chain writer (see chain_state.py) is left
+with the blocks and the expiry. Readers like block templates, /transactions/pending and compact block rebuilds
+lock one shard at a time, balances are read from each shard's last published Balances without locking.
+Transactions taken by a Block stay, marked with the chain version that has the Block, until the chain state
+after it is published: a MempoolView (see ChainState) shows them as pending exactly while its chain doesn't have them.
+Every transaction gets a sequence number when it's admitted, block templates merge the shards by it:
+oldest first, and a sender's transactions in the order they came.
 
 neetre 2024
 '''
 
-class Mempool:
+import json
+import heapq
+import threading
+from time import time
+from itertools import count, islice
+from operator import itemgetter
+from contextlib import ExitStack, contextmanager
+from collections import OrderedDict
+from collections.abc import Mapping
+from config import MEMPOOL_SHARDS
+from chain_state import Balances
+from metrics import Counter, Gauge
+
+MEMPOOL_TRANSACTIONS = Gauge('stellanova_mempool_transactions', 'Transactions waiting in the mempool')
+MEMPOOL_OPERATIONS = Counter('stellanova_mempool_transactions_total', 'Transactions added to or removed from the mempool', ('operation',))
+MEMPOOL_ADDED = MEMPOOL_OPERATIONS.labels('add')
+MEMPOOL_REMOVED = MEMPOOL_OPERATIONS.labels('remove')
+MEMPOOL_EXPIRED = MEMPOOL_OPERATIONS.labels('expire')
+
+
+def transaction_key(transaction):
+    # Equal transactions have the same key, like with == on the dicts
+    key = tuple(sorted(transaction.items()))
+    try:
+        hash(key)
+    except TypeError:  # a list or dict in it, eg. contract arguments
+        return json.dumps(transaction, sort_keys=True)
+    return key
+
+
+class MempoolShard:
+    '''
+    The transactions of some senders, in admission order, and the balances of the same accounts
+    '''
     def __init__(self):
-        self.transactions = []
-        
+        self.lock = threading.RLock()  # reentrant: listeners told of an admission may admit another
+        self.entries = OrderedDict()  # sequence number -> (admission time, transaction)
+        self.index = {}  # transaction key -> sequence numbers of the equal transactions
+        self.mined = {}  # sequence number -> chain version with the Block that took it, until purged
+        self.version = 0
+        self.balances = {}  # account -> balance, changed under the lock
+        self.published = Balances()  # the same, for readers that don't lock
+
+    def set_balance(self, account, balance):
+        self.balances[account] = balance
+        self.published = self.published.changed({account: balance}, self.balances)
+
+    def add(self, sequence, transaction):
+        self.entries[sequence] = (time(), transaction)
+        self.index.setdefault(transaction_key(transaction), []).append(sequence)
+        self.version += 1
+
+    def remove(self, transaction, mined_at=None):
+        """
+        :param mined_at: (Optional) <int> Chain version with the Block that took it, to keep it marked until purged
+        """
+        key = transaction_key(transaction)
+        sequences = self.index.get(key)
+        if not sequences:
+            return False
+        sequence = sequences.pop(0)
+        if mined_at is None:
+            del self.entries[sequence]
+        else:
+            self.mined[sequence] = mined_at
+        if not sequences:
+            del self.index[key]
+        self.version += 1
+        return True
+
+    def pending(self, sequence, version=None):
+        # Still waiting for a Block in the chain with the given version, or in ours if None
+        mined_at = self.mined.get(sequence)
+        return mined_at is None or (version is not None and mined_at > version)
+
+    def head(self, n=None, version=None):
+        """
+        :param version: (Optional) <int> Chain version the transactions are pending for, see pending()
+        :return: <list> (sequence number, transaction) of the n oldest transactions
+        """
+        with self.lock:
+            items = ((sequence, transaction) for sequence, (added, transaction) in self.entries.items()
+                     if not self.mined or self.pending(sequence, version))
+            return list(items if n is None else islice(items, n))
+
+    def discard(self, sequence):
+        if sequence not in self.entries or sequence in self.mined:
+            return  # removed meanwhile, eg. mined
+        added, transaction = self.entries.pop(sequence)
+        key = transaction_key(transaction)
+        self.index[key].remove(sequence)
+        if not self.index[key]:
+            del self.index[key]
+        self.version += 1
+
+    def purge(self, version):
+        # Drops the marked transactions whose Block is in the chain with the given version
+        with self.lock:
+            for sequence in [sequence for sequence, mined_at in self.mined.items() if mined_at <= version]:
+                del self.entries[sequence]
+                del self.mined[sequence]
+
+    def admitted_before(self, before):
+        """
+        :return: <list> (sequence number, transaction) of the transactions admitted before the given time
+        """
+        expiring = []
+        with self.lock:
+            # Admission times grow with the sequence numbers, so they come first
+            for sequence, (added, transaction) in self.entries.items():
+                if added >= before:
+                    break
+                if sequence not in self.mined:
+                    expiring.append((sequence, transaction))
+        return expiring
+
+
+class ShardedBalances(Mapping):
+    '''
+    Read only account -> balance mapping over the shards' published Balances
+    '''
+    def __init__(self, mempool):
+        self.mempool = mempool
+
+    def __getitem__(self, account):
+        return self.mempool.shard(account).published[account]
+
+    def __iter__(self):
+        for shard in self.mempool.shards:
+            yield from shard.published
+
+    def __len__(self):
+        return sum(len(shard.published) for shard in self.mempool.shards)
+
+
+class MempoolView:
+    '''
+    The pending transactions as of one chain version: the ones taken by a Block of a later version still show
+    '''
+    __slots__ = ('mempool', 'version')
+
+    def __init__(self, mempool, version):
+        self.mempool = mempool
+        self.version = version
+
+    def get_transactions(self, n):
+        return self.mempool.merged(n, self.version)
+
+    def all_transactions(self):
+        return self.mempool.merged(version=self.version)
+
+
+class Mempool:
+    def __init__(self, shards=MEMPOOL_SHARDS):
+        self.shards = [MempoolShard() for _ in range(shards)]
+        self.sequence = count()  # next() on it is atomic
+        self.balances = ShardedBalances(self)
+
+    def shard(self, account):
+        return self.shards[hash(account) % len(self.shards)]
+
+    @contextmanager
+    def locked(self, *accounts):
+        """
+        Holds the locks of the accounts' shards, taken in shard order so two callers can't wait for each other
+        """
+        with ExitStack() as stack:
+            for position in sorted({hash(account) % len(self.shards) for account in accounts}):
+                stack.enter_context(self.shards[position].lock)
+            yield
+
+    @property
+    def version(self):
+        # Changes whenever the content changes: every shard's version only grows
+        return sum(shard.version for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard.entries) - len(shard.mined) for shard in self.shards)
+
     def add_transactions(self, transaction: object):
-        self.transactions.append(transaction)
-        
+        with self.shard(transaction['sender']).lock:
+            self.insert(transaction)
+
+    def insert(self, transaction):
+        # The caller holds the sender's shard lock, the number is taken under it so each shard stays in sequence order
+        self.shard(transaction['sender']).add(next(self.sequence), transaction)
+        MEMPOOL_ADDED.inc()
+        MEMPOOL_TRANSACTIONS.inc()
+
+    def balance(self, account):
+        return self.shard(account).balances.get(account, 0)
+
+    def transfer(self, sender, recipient, amount):
+        """
+        Moves amount from sender to recipient, the caller holds both shard locks, see locked()
+        :param sender: <str> Address, "0" mints the amount
+        :raises ValueError: if the sender doesn't have the amount
+        """
+        if sender != "0":  # "0" is used for mining rewards
+            balances = self.shard(sender).balances
+            if sender not in balances or balances[sender] < amount:
+                raise ValueError("Insufficient balance")
+            self.credit(sender, -amount)
+        self.credit(recipient, amount)
+
+    def credit(self, account, amount):
+        # The caller holds the account's shard lock, a negative amount is a debit
+        shard = self.shard(account)
+        shard.set_balance(account, shard.balances.get(account, 0) + amount)
+
+    def merged(self, n=None, version=None):
+        heads = [shard.head(n, version) for shard in self.shards]
+        return [transaction for sequence, transaction in islice(heapq.merge(*heads, key=itemgetter(0)), n)]
+
     def get_transactions(self, n):
-        return self.transactions[:n]
-    
-    def remove_transactions(self, transactions):
+        return self.merged(n)
+
+    def all_transactions(self):
+        return self.merged()
+
+    def remove_transactions(self, transactions, mined_at=None):
+        """
+        :param mined_at: (Optional) <int> Chain version with the Block that took them: they stay for the views
+                         of older versions until purge() is called with a version at least as new
+        """
+        removed = 0
         for transaction in transactions:
-            if transaction in self.transactions:
-                self.transactions.remove(transaction)
+            shard = self.shard(transaction.get('sender'))
+            with shard.lock:
+                removed += shard.remove(transaction, mined_at)
+        if removed:
+            MEMPOOL_REMOVED.inc(removed)
+            MEMPOOL_TRANSACTIONS.dec(removed)
+
+    def purge(self, version):
+        for shard in self.shards:
+            if shard.mined:
+                shard.purge(version)
+
+    def expire(self, max_age, refund=None):
+        """
+        Drops the transactions that waited longer than max_age seconds
+        :param refund: (Optional) <callable> Called with each of them, newest first, under the locks of
+                       its sender's and recipient's shards; one it returns False for stays
+        :return: <list> The expired transactions, oldest first
+        """
+        before = time() - max_age
+        candidates = list(heapq.merge(*[shard.admitted_before(before) for shard in self.shards], key=itemgetter(0)))
+        expired = []
+        # Newest first: undoing the later transactions gives back what the earlier ones paid
+        for sequence, transaction in reversed(candidates):
+            shard = self.shard(transaction['sender'])
+            with self.locked(transaction['sender'], transaction['recipient']):
+                if sequence not in shard.entries or sequence in shard.mined:
+                    continue  # removed meanwhile, eg. mined
+                if refund is not None and not refund(transaction):
+                    continue
+                shard.discard(sequence)
+            expired.append(transaction)
+        expired.reverse()
+        if expired:
+            MEMPOOL_EXPIRED.inc(len(expired))
+            MEMPOOL_TRANSACTIONS.dec(len(expired))
+        return expired
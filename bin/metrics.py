@@ -0,0 +1,264 @@
+'''
+This is a small metrics registry for the node: counters, gauges and histograms, with optional labels,
+rendered in the Prometheus text format at /metrics.
+Metrics are module level objects next to the code they measure, recording one is a dict lookup
+and a short locked update, cheap enough to leave on in production.
+
+Neetre 2024
+'''
+
+import threading
+from abc import ABC, abstractmethod
+from time import perf_counter
+from bisect import bisect_left
+from functools import wraps
+from flask import request, g
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+
+    def render(self):
+        """
+        All the metrics in the Prometheus text format
+        :return: <str>
+        """
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{name}="{escape(value)}"' for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        """
+        :param name: <str> Metric name, eg. 'stellanova_blocks_mined_total'
+        :param documentation: <str> One line of help
+        :param labelnames: (Optional) <tuple> Names of the labels, values are given to labels()
+        :param registry: <Registry> Where the metric is rendered from
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.children[()] = self.new_child()
+        registry.register(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def items(self):
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            yield list(zip(self.labelnames, values)), child
+
+    @abstractmethod
+    def new_child(self):
+        """
+        :return: The object holding the value of one set of label values
+        """
+
+    @abstractmethod
+    def samples(self):
+        """
+        :return: <generator> (name suffix, labels, value) of every sample to render
+        """
+
+
+class Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def new_child(self):
+        return Value()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def samples(self):
+        for labels, child in self.items():
+            yield '', labels, child.value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, function=None):
+        """
+        :param function: (Optional) <callable> Read at every scrape instead of keeping a value
+        """
+        self.function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self):
+        return Value()
+
+    def set_function(self, function):
+        """
+        Read function at every scrape from now on, eg. for an object made after the gauge
+        :param function: <callable> Returns the value
+        """
+        self.function = function
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def samples(self):
+        if self.function is not None:
+            yield '', [], self.function()
+            return
+        for labels, child in self.items():
+            yield '', labels, child.value
+
+
+class Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        position = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[position] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: <tuple> Upper bounds of the buckets, in increasing order
+        """
+        self.bounds = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self):
+        return Buckets(self.bounds)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def time(self):
+        """
+        Decorator that observes how long each call takes
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        for labels, child in self.items():
+            with child.lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.bounds + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield '_bucket', labels + [('le', format_value(float(bound)))], cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+
+REQUEST_SECONDS = Histogram('stellanova_http_request_seconds', 'Time spent answering HTTP requests',
+                            ('endpoint', 'method', 'status'))
+
+
+def init_app(app):
+    """
+    Times every request of a Flask app, by URL rule, method and status
+    """
+    @app.before_request
+    def start_timer():
+        g.metrics_start = perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.get('metrics_start')
+        if start is not None:
+            rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            REQUEST_SECONDS.labels(rule, request.method, str(response.status_code)).observe(perf_counter() - start)
+        return response
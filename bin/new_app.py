@@ -2,38 +2,82 @@
 Neetre 2024
 '''
 
+from boot import BootSequence
+boot_sequence = BootSequence()  # first, so the imports are timed too
+
 import time
 import argparse
+from urllib.parse import urlparse
 from uuid import uuid4
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, redirect, Response
 from flask_restful import Api, Resource
 from argparse import ArgumentParser
-from config import MINING_REWARD
+from config import (HEADERS_PER_REQUEST, BODIES_PER_REQUEST, PEER_REFRESH_SECONDS,
+                    SYNC_CHECK_SECONDS, MEMPOOL_EXPIRY_SECONDS, MEMPOOL_TX_TTL, SNAPSHOT_SECONDS, CHAIN_SNAPSHOT,
+                    SERVER_THREADS, EVENTS_PORT_OFFSET)
 from blockchain import Blockchain
 from peer_discovery import PeerDiscovery
+from chain_sync import ChainSync
+from gossip import Gossip
+from chain_stream import chain_response
+from http_cache import conditional, chain_etag, ResponseCache
 from contract import SmartContract
+from scheduler import Scheduler
+from admission import RateLimiter
+import metrics
+from profiling import Profiler
+from ingest import BulkIngest, bulk_response
+from events import EventBus
+from serve import serve, cpu_executor
 import logging
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from security import Security
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+boot_sequence.mark('imports')
 
 
 blockchain = Blockchain()
 node_identifier = str(uuid4()).replace('-', '')
-registry_url = "http://127.0.0.1:5000"  # Replace with your actual registry server URL
-peer_discovery = PeerDiscovery(registry_url)
+registry_url = "http://127.0.0.1:5001"  # Replace with your actual registry server URL
+my_node_url = "http://127.0.0.1:5000"  # Replace with your actual node URL, boot() sets the port
+peer_discovery = PeerDiscovery(registry_url, my_node_url)  # registers with the first heartbeat, not at import
+chain_sync = ChainSync(blockchain)
+gossip = Gossip(blockchain, urlparse(my_node_url).netloc, chain_sync)
+scheduler = Scheduler()
+response_cache = ResponseCache(blockchain.state_version)
+events = EventBus()
+bulk = BulkIngest(blockchain, gossip)
+blockchain.listeners.append(events.publish)
 
 
 app = Flask(__name__)
+app.config['EVENTS_PORT'] = 5000 + EVENTS_PORT_OFFSET
 api = Api(app)
+limiter = RateLimiter(is_peer=blockchain.nodes.has_host)
+metrics.init_app(app)  # first, so the requests the limiter turns away are counted too
+limiter.init_app(app)
+profiler = Profiler()
+profiler.init_app(app)
+blockchain.watch_metrics()
+boot_sequence.mark('app')
 
 
 class NodeInfo(Resource):
     def get(self):
         # Info about current node
-        pass
+        return {
+            'node_identifier': node_identifier,
+            'height': len(blockchain.chain),
+            'peers': len(blockchain.nodes),
+            'jobs': scheduler.stats(),
+            'cache': response_cache.stats(),
+            'boot': boot_sequence.report(),
+            'rate_limit': limiter.stats(),
+            'sync': chain_sync.sync.stats(),
+            'writer': blockchain.writer.stats()
+        }, 200
 
 
 class NodeRegister(Resource):
@@ -61,20 +105,52 @@ class NodePeers(Resource):
 
 
 class Blockchain(Resource):
+    method_decorators = [conditional(lambda: chain_etag(blockchain), response_cache)]
+
     def get(self):
-        response = {
-            'chain' : blockchain.chain,
-            'length' : len(blockchain.chain)
-        }
-        return response, 200
+        return chain_response(blockchain, request.args, request.headers.get('Accept', ''))
+
+
+class Headers(Resource):
+    method_decorators = [conditional(lambda: chain_etag(blockchain), response_cache)]
+
+    def get(self):
+        start = request.args.get('from', default=1, type=int)
+        count = min(request.args.get('count', default=HEADERS_PER_REQUEST, type=int), HEADERS_PER_REQUEST)
+        return {'headers': blockchain.get_headers(start, count), 'height': len(blockchain.chain)}, 200
+
+
+class Block(Resource):
+    method_decorators = [conditional(lambda block_hash: block_hash if blockchain.get_block_by_hash(block_hash) else None)]
+
+    def get(self, block_hash):
+        block = blockchain.get_block_by_hash(block_hash)
+        if block is None:
+            return {'error': 'Block not found'}, 404
+        return block, 200
+
+
+class BlockBatch(Resource):
+    def post(self):
+        values = request.get_json()
+        hashes = values.get('hashes')
+        if hashes is None:
+            return "Error: Please supply a list of block hashes", 400
+        if len(hashes) > BODIES_PER_REQUEST:
+            return f"Error: At most {BODIES_PER_REQUEST} blocks per request", 400
+        return {'blocks': [blockchain.get_block_by_hash(block_hash) for block_hash in hashes]}, 200
 
 
 class LatestBlock(Resource):
+    method_decorators = [conditional(lambda: chain_etag(blockchain), response_cache)]
+
     def get(self):
         return blockchain.last_block, 200
 
 
 class BlockchainHeight(Resource):
+    method_decorators = [conditional(cache=response_cache)]
+
     def get(self):
         # get the current height of the blockchain
         return {'height': len(blockchain.chain)}, 200
@@ -83,16 +159,16 @@ class BlockchainHeight(Resource):
 class Mine(Resource):
     def get(self):
         last_block = blockchain.last_block
-        proof = blockchain.proof_or_work(last_block)
-        
-        blockchain.new_transaction(
-            sender='0',
-            recipient=node_identifier,
-            amount=MINING_REWARD,
-        )
+        proof = blockchain.proof_or_work(last_block, cpu_executor())
         
         previous_hash = blockchain.hash(last_block)
-        block = blockchain.new_block(proof, previous_hash)
+        try:
+            # The reward is credited with the Block, so a 409 leaves nothing behind
+            block = blockchain.new_block(proof, previous_hash, reward_to=node_identifier)
+        except ValueError as e:
+            # A Block from a peer took the tip while we were mining
+            return {'error': str(e)}, 409
+        gossip.announce_block(block)
 
         response = {
             'message': "New Block Forged",
@@ -110,7 +186,7 @@ class Transactions(Resource):
             values = request.get_json()
             required = ['sender', 'recipient', 'amount', 'public_key', 'signature']
             if not all(k in values for k in required):
-                return jsonify({'error': 'Missing values'}), 400
+                return {'error': 'Missing values'}, 400
             
             # Convert the public key from string to key object
             public_key = serialization.load_pem_public_key(
@@ -135,18 +211,31 @@ class Transactions(Resource):
                     signature,
                     public_key
                 )
+                gossip.announce_transaction(transaction, values['signature'], values['public_key'])
                 response = {'message': f'Transaction will be added to Block {index}'}
-                return jsonify(response), 201
+                return response, 201
             else:
-                return jsonify({'error': 'Invalid signature'}), 400
+                return {'error': 'Invalid signature'}, 400
         except Exception as e:
             return {'error': str(e)}, 500
 
 
+class TransactionsBulk(Resource):
+    def post(self):
+        # NDJSON or a JSON array of transactions, one result line per transaction
+        return bulk_response(bulk.transactions, request)
+
+
+class BlocksBulk(Resource):
+    def post(self):
+        # NDJSON or a JSON array of blocks to append to our tip, one result line per block
+        return bulk_response(bulk.blocks, request)
+
+
 class PendingTransactions(Resource):
     def get(self):
-        # get all pending transactions in the mempool
-        return blockchain.current_transactions, 200
+        # get all pending transactions in the mempool, as of the published chain
+        return blockchain.state.mempool.all_transactions(), 200
 
 
 class TransactionDetails(Resource):
@@ -199,15 +288,77 @@ class ExecuteContract(Resource):
         # Execute a smart contract
         pass
 
+class GossipInventory(Resource):
+    def post(self):
+        values = request.get_json()
+        if not isinstance(values, dict) or 'inventory' not in values or 'origin' not in values:
+            return "Error: Please supply inventory and origin", 400
+        if not gossip.valid_inventory(values['inventory'], values['origin']):
+            return "Error: Please supply a valid inventory", 400
+        return {'wanted': gossip.receive_inventory(values['inventory'], values['origin'])}, 202
+
+
+class GossipTransaction(Resource):
+    def get(self, txid):
+        envelope = gossip.get_transaction(txid)
+        if envelope is None:
+            return {'error': 'Transaction not found'}, 404
+        return envelope, 200
+
+
+class GossipCompactBlock(Resource):
+    def get(self, block_hash):
+        compact = gossip.compact_block(block_hash)
+        if compact is None:
+            return {'error': 'Block not found'}, 404
+        return compact, 200
+
+
+class GossipBlockTransactions(Resource):
+    def post(self, block_hash):
+        values = request.get_json()
+        if not values or 'indexes' not in values:
+            return "Error: Please supply the transaction indexes", 400
+        transactions = gossip.block_transactions(block_hash, values['indexes'])
+        if transactions is None:
+            return {'error': 'Block not found'}, 404
+        return {'transactions': transactions}, 200
+
+
+class GossipStats(Resource):
+    def get(self):
+        return gossip.stats(), 200
+
+
 class NetworkStatus(Resource):
     def get(self):
         # get the overall network status
-        pass
+        return {'height': len(blockchain.chain), 'peers': blockchain.nodes.stats()}, 200
     
 class NetworkSync(Resource):
     def post(self):
         # Manually trigger the network sync
-        pass
+        synced = chain_sync.sync()
+        return {'synced': synced, 'height': len(blockchain.chain)}, 200
+
+
+
+class Events(Resource):
+    def get(self):
+        # The stream is served by the event server, see events.py
+        host = request.host.rsplit(':', 1)[0]
+        query = f"?{request.query_string.decode()}" if request.query_string else ''
+        return redirect(f"{request.scheme}://{host}:{app.config['EVENTS_PORT']}/events{query}", code=307)
+
+
+class Metrics(Resource):
+    def get(self):
+        return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+class EventStats(Resource):
+    def get(self):
+        return events.stats(), 200
 
 
 # Add resources to API
@@ -215,22 +366,78 @@ api.add_resource(NodeInfo, '/node/info')
 api.add_resource(NodeRegister, '/node/register')
 api.add_resource(NodePeers, '/node/peers')
 api.add_resource(Blockchain, '/blockchain')
+api.add_resource(Headers, '/headers')
+api.add_resource(Block, '/blocks/<string:block_hash>')
+api.add_resource(BlockBatch, '/blocks/batch')
+api.add_resource(BlocksBulk, '/blocks/bulk')
 api.add_resource(LatestBlock, '/blockchain/latest')
 api.add_resource(BlockchainHeight, '/blockchain/height')
 api.add_resource(Mine, '/mine')
 api.add_resource(Transactions, '/transactions')
 api.add_resource(PendingTransactions, '/transactions/pending')
+api.add_resource(TransactionsBulk, '/transactions/bulk')
 api.add_resource(TransactionDetails, '/transactions/<string:txid>')
 api.add_resource(Wallet, '/wallet')
 api.add_resource(WalletBalance, '/wallet/<string:address>/balance')
 api.add_resource(Contracts, '/contracts')
 api.add_resource(ContractDetails, '/contracts/<string:address>')
 api.add_resource(ExecuteContract, '/contracts/<string:address>/execute')
+api.add_resource(GossipInventory, '/gossip/inv')
+api.add_resource(GossipTransaction, '/gossip/transactions/<string:txid>')
+api.add_resource(GossipCompactBlock, '/gossip/compact/<string:block_hash>')
+api.add_resource(GossipBlockTransactions, '/gossip/compact/<string:block_hash>/transactions')
+api.add_resource(GossipStats, '/gossip/stats')
 api.add_resource(NetworkStatus, '/network/status')
 api.add_resource(NetworkSync, '/network/sync')
+api.add_resource(Events, '/events')
+api.add_resource(EventStats, '/network/events')
+api.add_resource(Metrics, '/metrics')
+
+def refresh_peers():
+    alive = peer_discovery.heartbeat()
+    for peer in peer_discovery.get_peers():
+        blockchain.register_node(peer)
+    if not alive:
+        raise RuntimeError("Registry unreachable")
+
+
+def start_background_jobs():
+    scheduler.add_job('peer_refresh', refresh_peers, interval=PEER_REFRESH_SECONDS, run_at_start=True)
+    scheduler.add_job('sync_check', chain_sync.sync, interval=SYNC_CHECK_SECONDS)
+    scheduler.add_job('mempool_expiry', lambda: blockchain.expire_transactions(MEMPOOL_TX_TTL), interval=MEMPOOL_EXPIRY_SECONDS)
+    scheduler.add_job('snapshot', lambda: blockchain.save_snapshot(CHAIN_SNAPSHOT), interval=SNAPSHOT_SECONDS)
+    scheduler.start()
+
+
+def boot(port=5000, events_port=None):
+    # Everything with side effects, timed by phase, nothing here waits for the network
+    global my_node_url
+    my_node_url = f"http://127.0.0.1:{port}"
+    peer_discovery.node_url = my_node_url
+    gossip.node_address = urlparse(my_node_url).netloc
+    app.config['EVENTS_PORT'] = events_port or port + EVENTS_PORT_OFFSET
+
+    with boot_sequence.phase('snapshot'):
+        blockchain.load_snapshot(CHAIN_SNAPSHOT)
+    with boot_sequence.phase('events'):
+        events.start(port=app.config['EVENTS_PORT'])
+    with boot_sequence.phase('jobs'):
+        start_background_jobs()
+    boot_sequence.ready()
+
 
 if __name__ == '__main__':
     args = argparse.ArgumentParser()
     args.add_argument('--port', default=5000, type=int)
+    args.add_argument('--server', default='dev', choices=['dev', 'production'])
+    args.add_argument('--threads', default=SERVER_THREADS, type=int)
+    args.add_argument('--events-port', default=None, type=int)
     args = args.parse_args()
-    app.run(debug=True, port=args.port)
\ No newline at end of file
+    boot(args.port, args.events_port)
+    try:
+        serve(app, port=args.port, server=args.server, threads=args.threads)
+    finally:
+        scheduler.stop(wait=False)
+        events.stop()
+        blockchain.save_snapshot(CHAIN_SNAPSHOT)
+        blockchain.writer.stop()
\ No newline at end of file
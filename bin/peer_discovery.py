@@ -7,19 +7,24 @@ Neetre 2024
 
 import requests
 import logging
+from config import REGISTRY_TIMEOUT
 
 class PeerDiscovery:
-    def __init__(self, registy_url):
+    def __init__(self, registy_url, node_url=None):
         self.registry_url = registy_url
         self.known_peers = set()
+        self.node_url = node_url  # set without any request, the first heartbeat registers us
         
     def register(self, node_url):
+        self.node_url = node_url
         try:
             data = {"url": node_url}
-            response = requests.post(f"{self.registry_url}/register", json=data)
+            response = requests.post(f"{self.registry_url}/register", json=data, timeout=REGISTRY_TIMEOUT)
             if response.status_code == 200:
                 logging.info(f"Successfully registered node {node_url}")
-                return response.json()
+                result = response.json()
+                self.known_peers.update(result.get('peers', []))
+                return result
             else:
                 logging.error(f"Failed to register node {node_url}. Status code {response.status_code}")
                 return None
@@ -27,9 +32,26 @@ class PeerDiscovery:
             logging.error(f"Error registering node {node_url}: {str(e)}")
             return None
     
+    def heartbeat(self):
+        """
+        Tell the registry we are still alive, nodes that stop sending heartbeats expire
+        :return: <bool> True if the registry answered
+        """
+        if self.node_url is None:
+            return False
+        try:
+            response = requests.post(f"{self.registry_url}/heartbeat", json={"url": self.node_url}, timeout=REGISTRY_TIMEOUT)
+            if response.status_code == 200:
+                return True
+            logging.error(f"Failed to send heartbeat. Status code: {response.status_code}")
+        except requests.RequestException as e:
+            logging.error(f"Error sending heartbeat: {str(e)}")
+        return False
+
     def get_peers(self):
         try:
-            response = requests.get(f"{self.registry_url}/peers")
+            params = {"exclude": self.node_url} if self.node_url else None
+            response = requests.get(f"{self.registry_url}/peers", params=params, timeout=REGISTRY_TIMEOUT)
             if response.status_code == 200:
                 new_peers = set(response.json())
                 self.known_peers.update(new_peers)
@@ -0,0 +1,174 @@
+'''
+This is a simple peer manager for the blockchain node.
+It keeps per-peer round trip time, throughput, failures and how often a peer served invalid data,
+hands out the best peers first and backs off, then evicts, peers that keep failing.
+It behaves like the set of nodes it replaces: add, discard, in, len and iteration (best peers first).
+
+Neetre 2024
+'''
+
+import threading
+from time import time
+from config import (PEER_DEFAULT_RTT, PEER_BACKOFF_BASE, PEER_BACKOFF_MAX, PEER_MAX_FAILURES,
+                    PEER_EVICT_SECONDS, PEER_INVALID_PENALTY)
+from metrics import Counter, Histogram
+
+PEER_RTT = Histogram('stellanova_peer_rtt_seconds', 'Round trip time of successful peer requests')
+PEER_FAILURES = Counter('stellanova_peer_failures_total', 'Peer requests that failed or returned invalid data', ('kind',))
+PEER_EVICTIONS = Counter('stellanova_peer_evictions_total', 'Peers evicted for failing too often')
+
+EWMA_WEIGHT = 0.3
+
+
+class PeerStats:
+    def __init__(self):
+        self.rtt = None  # seconds, moving average
+        self.throughput = None  # bytes per second, moving average
+        self.successes = 0
+        self.failures = 0  # consecutive
+        self.invalid = 0
+        self.backoff_until = 0
+        self.last_seen = None
+
+    @staticmethod
+    def ewma(old, new):
+        return new if old is None else (1 - EWMA_WEIGHT) * old + EWMA_WEIGHT * new
+
+    @property
+    def score(self):
+        # Lower is better, peers we know nothing about get a middling score so they are tried
+        rtt = PEER_DEFAULT_RTT if self.rtt is None else self.rtt
+        return rtt + PEER_INVALID_PENALTY * self.invalid
+
+    def to_dict(self):
+        return {
+            'rtt': self.rtt,
+            'throughput': self.throughput,
+            'successes': self.successes,
+            'failures': self.failures,
+            'invalid': self.invalid,
+            'backoff_until': self.backoff_until,
+            'last_seen': self.last_seen,
+            'score': self.score,
+        }
+
+
+class PeerManager:
+    def __init__(self):
+        self.peers = {}
+        self.evicted = {}  # node -> time of eviction
+        self.lock = threading.Lock()
+
+    # Set interface
+    def add(self, node):
+        with self.lock:
+            evicted_at = self.evicted.get(node)
+            if evicted_at is not None:
+                if time() - evicted_at < PEER_EVICT_SECONDS:
+                    return
+                del self.evicted[node]
+            self.peers.setdefault(node, PeerStats())
+
+    def discard(self, node):
+        with self.lock:
+            self.peers.pop(node, None)
+
+    def __contains__(self, node):
+        return node in self.peers
+
+    def __len__(self):
+        return len(self.peers)
+
+    def has_host(self, host):
+        """
+        True if one of our peers runs on this host, whatever its port
+        :param host: <str> IP address or host name
+        """
+        return any(node.rsplit(':', 1)[0] == host for node in list(self.peers))
+
+    def __iter__(self):
+        return iter(self.best())
+
+    # Selection
+    def best(self, n=None, key='score'):
+        """
+        Peers that are not backing off, best first
+        :param n: (Optional) <int> How many peers
+        :param key: <str> 'score' to sort by latency, 'throughput' for bulk downloads
+        :return: <list> Peers
+        """
+        now = time()
+        with self.lock:
+            available = [(node, stats) for node, stats in self.peers.items() if stats.backoff_until <= now]
+        if key == 'throughput':
+            available.sort(key=lambda peer: -(peer[1].throughput or 0))
+        else:
+            available.sort(key=lambda peer: peer[1].score)
+        nodes = [node for node, _ in available]
+        return nodes if n is None else nodes[:n]
+
+    # Recording
+    def record_success(self, node, latency, size=0):
+        PEER_RTT.observe(latency)
+        with self.lock:
+            stats = self.peers.get(node)
+            if stats is None:
+                return
+            stats.rtt = stats.ewma(stats.rtt, latency)
+            if size and latency > 0:
+                stats.throughput = stats.ewma(stats.throughput, size / latency)
+            stats.successes += 1
+            stats.failures = 0
+            stats.backoff_until = 0
+            stats.last_seen = time()
+
+    def record_failure(self, node):
+        PEER_FAILURES.labels('failure').inc()
+        with self.lock:
+            stats = self.peers.get(node)
+            if stats is None:
+                return
+            stats.failures += 1
+            if stats.failures >= PEER_MAX_FAILURES:
+                self._evict(node)
+            else:
+                stats.backoff_until = time() + min(PEER_BACKOFF_BASE * 2 ** (stats.failures - 1), PEER_BACKOFF_MAX)
+
+    def record_invalid(self, node):
+        PEER_FAILURES.labels('invalid').inc()
+        with self.lock:
+            stats = self.peers.get(node)
+            if stats is None:
+                return
+            stats.invalid += 1
+            if stats.invalid >= PEER_MAX_FAILURES:
+                self._evict(node)
+
+    def _evict(self, node):
+        PEER_EVICTIONS.inc()
+        del self.peers[node]
+        self.evicted[node] = time()
+
+    def stats(self):
+        with self.lock:
+            return {node: stats.to_dict() for node, stats in self.peers.items()}
+
+    # Address book
+    def records(self):
+        with self.lock:
+            return [{'address': node, **stats.to_dict()} for node, stats in self.peers.items()]
+
+    def restore(self, records):
+        """
+        Loads peers saved by a previous run, their backoff doesn't carry over
+        :param records: <list> dicts as returned by records()
+        """
+        with self.lock:
+            for record in records:
+                stats = self.peers.setdefault(record['address'], PeerStats())
+                stats.rtt = record.get('rtt')
+                stats.throughput = record.get('throughput')
+                stats.successes = record.get('successes', 0)
+                stats.failures = record.get('failures', 0)
+                stats.invalid = record.get('invalid', 0)
+                stats.last_seen = record.get('last_seen')
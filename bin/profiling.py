@@ -0,0 +1,205 @@
+'''
+This module lets an admin look inside a live node without restarting it under a profiler.
+ - cProfile for the next N requests, or for every request during a time window, downloaded as a .pstats file
+ - stack samples of every thread (request threads, scheduler jobs, gossip and peer threads), as collapsed stacks
+   for flamegraph.pl or speedscope
+ - tracemalloc snapshots, as the top allocation sites or a binary snapshot
+The routes are under /admin and only answer to the ADMIN_TOKEN, or without one to loopback clients
+when ADMIN_LOCALHOST is turned on (STELLANOVA_ADMIN=1), they are off by default.
+Proof of work runs in a process pool, its time shows in the profiles as the wait for the pool's result.
+
+Neetre 2024
+'''
+
+import io
+import sys
+import hmac
+import pickle
+import marshal
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+import traceback
+from collections import Counter
+from functools import wraps
+from flask import request, jsonify, g, Response
+from config import ADMIN_TOKEN, ADMIN_LOCALHOST, PROFILE_MAX_SECONDS, PROFILE_SAMPLE_INTERVAL, TRACEMALLOC_FRAMES
+
+LOOPBACK = ('127.0.0.1', '::1')
+
+
+def admin_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if ADMIN_TOKEN:
+            allowed = hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+        else:
+            allowed = ADMIN_LOCALHOST and request.remote_addr in LOOPBACK
+        if not allowed:
+            return jsonify({'error': 'Admin only'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def sample_stacks(seconds, interval=PROFILE_SAMPLE_INTERVAL):
+    """
+    Samples the stacks of all threads but the calling one
+    :param seconds: <float> How long to sample
+    :param interval: <float> Seconds between samples
+    :return: <str> Collapsed stacks: 'thread;outer;...;inner count' per line
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            frames = [f"{entry.name} ({entry.filename.rsplit('/', 1)[-1]}:{entry.lineno})"
+                      for entry in traceback.extract_stack(frame)]
+            stacks[';'.join([names.get(ident, str(ident))] + frames)] += 1
+        time.sleep(interval)
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = None
+        self.remaining = 0  # requests still to profile
+        self.until = 0  # or profile until this time
+        self.profiled = 0
+        self.busy = False  # one request is profiled at a time, profilers of different threads can't overlap on every Python
+
+    # cProfile
+    def start(self, requests=None, seconds=None):
+        with self.lock:
+            self.stats = None
+            self.profiled = 0
+            self.remaining = requests or 0
+            self.until = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS) if seconds else 0
+
+    def active(self):
+        return self.remaining > 0 or time.monotonic() < self.until
+
+    def begin_request(self):
+        if not self.active() or request.path.startswith('/admin'):
+            return
+        with self.lock:
+            if self.busy:
+                return
+            if self.remaining > 0:
+                self.remaining -= 1
+            self.busy = True
+        profile = cProfile.Profile()
+        g.profile = profile
+        profile.enable()
+
+    def end_request(self, error=None):
+        # A teardown, so it also runs when the view raised
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+                self.profiled += 1
+                self.busy = False
+
+    def dump(self):
+        """
+        :return: <bytes> The collected profile in the pstats format, None if there is none
+        """
+        with self.lock:
+            if self.stats is None:
+                return None
+            return marshal.dumps(self.stats.stats)  # what Stats.dump_stats writes
+
+    def report(self, limit=50):
+        with self.lock:
+            if self.stats is None:
+                return None
+            out = io.StringIO()
+            self.stats.stream = out
+            self.stats.sort_stats('cumulative').print_stats(limit)
+            return out.getvalue()
+
+    def status(self):
+        return {
+            'active': self.active(),
+            'remaining_requests': self.remaining,
+            'remaining_seconds': max(0, self.until - time.monotonic()),
+            'profiled_requests': self.profiled,
+            'tracemalloc': tracemalloc.is_tracing(),
+        }
+
+    def init_app(self, app):
+        app.before_request(self.begin_request)
+        app.teardown_request(self.end_request)
+
+        def route(rule, name, view, methods=('GET',)):
+            app.add_url_rule(rule, name, admin_only(view), methods=list(methods))
+
+        route('/admin/profile', 'profile_status', lambda: (jsonify(self.status()), 200))
+        route('/admin/profile/start', 'profile_start', self.start_view, methods=('POST',))
+        route('/admin/profile/download', 'profile_download', self.download_view)
+        route('/admin/stacks', 'stack_samples', self.stacks_view)
+        route('/admin/tracemalloc/start', 'tracemalloc_start', self.tracemalloc_start_view, methods=('POST',))
+        route('/admin/tracemalloc/stop', 'tracemalloc_stop', self.tracemalloc_stop_view, methods=('POST',))
+        route('/admin/tracemalloc/snapshot', 'tracemalloc_snapshot', self.tracemalloc_snapshot_view)
+
+    # Views
+    def start_view(self):
+        requests = request.args.get('requests', type=int)
+        seconds = request.args.get('seconds', type=float)
+        if not requests and not seconds:
+            return jsonify({'error': 'Please supply requests or seconds'}), 400
+        self.start(requests, seconds)
+        return jsonify(self.status()), 200
+
+    def download_view(self):
+        if request.args.get('format') == 'text':
+            report = self.report(request.args.get('limit', default=50, type=int))
+            data, mimetype, name = report, 'text/plain', 'profile.txt'
+        else:
+            data, mimetype, name = self.dump(), 'application/octet-stream', 'profile.pstats'
+        if data is None:
+            return jsonify({'error': 'No profile collected'}), 404
+        return Response(data, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename={name}'})
+
+    def stacks_view(self):
+        seconds = min(request.args.get('seconds', default=5, type=float), PROFILE_MAX_SECONDS)
+        interval = max(request.args.get('interval', default=PROFILE_SAMPLE_INTERVAL, type=float), 0.001)
+        return Response(sample_stacks(seconds, interval), mimetype='text/plain',
+                        headers={'Content-Disposition': 'attachment; filename=stacks.collapsed'})
+
+    def tracemalloc_start_view(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(request.args.get('frames', default=TRACEMALLOC_FRAMES, type=int))
+        return jsonify(self.status()), 200
+
+    def tracemalloc_stop_view(self):
+        tracemalloc.stop()
+        return jsonify(self.status()), 200
+
+    def tracemalloc_snapshot_view(self):
+        if not tracemalloc.is_tracing():
+            return jsonify({'error': 'tracemalloc is not running, POST /admin/tracemalloc/start first'}), 409
+        snapshot = tracemalloc.take_snapshot()
+        if request.args.get('format') == 'binary':
+            data = pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)  # what Snapshot.dump writes, Snapshot.load reads it
+            return Response(data, mimetype='application/octet-stream',
+                            headers={'Content-Disposition': 'attachment; filename=snapshot.tracemalloc'})
+        limit = request.args.get('limit', default=50, type=int)
+        key = request.args.get('key', default='lineno')
+        if key not in ('lineno', 'filename', 'traceback'):
+            return jsonify({'error': 'key must be lineno, filename or traceback'}), 400
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"traced: {current} bytes, peak: {peak} bytes"]
+        lines += [str(stat) for stat in snapshot.statistics(key)[:limit]]
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain')
@@ -1,14 +1,137 @@
 '''
-This program is a simple implementation of a blockchain node registration server
+This program is a simple implementation of a blockchain node registration server.
+Registrations are kept in memory for fast answers and written to SQLite in batches, so they survive a restart.
+Nodes have to send a heartbeat, the ones that miss them for longer than the TTL expire.
+/peers returns a random sample (or a page) of the live nodes instead of all of them.
 
 Neetre 2024
 '''
 
 from flask import Flask, jsonify, request
+from argparse import ArgumentParser
+import random
+import sqlite3
+import threading
 import logging
+from time import time, sleep
+from config import REGISTRY_DB, REGISTRY_NODE_TTL, REGISTRY_SAMPLE_SIZE, REGISTRY_MAX_SAMPLE, REGISTRY_FLUSH_SECONDS
+
+
+class NodeRegistry:
+    def __init__(self, db_name=REGISTRY_DB, ttl=REGISTRY_NODE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.last_seen = {}  # url -> last heartbeat
+        self.urls = []  # same urls, for O(k) random samples
+        self.positions = {}  # url -> position in self.urls
+        self.dirty = set()
+        self.removed = set()
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS RegisteredNodes (
+                url TEXT PRIMARY KEY,
+                last_seen REAL
+            )
+        ''')
+        self.conn.commit()
+        self.load()
+
+    def load(self):
+        oldest = time() - self.ttl
+        self.conn.execute('DELETE FROM RegisteredNodes WHERE last_seen < ?', (oldest,))
+        self.conn.commit()
+        for url, last_seen in self.conn.execute('SELECT url, last_seen FROM RegisteredNodes WHERE last_seen >= ?', (oldest,)):
+            self._add(url, last_seen)
+        logging.info(f"Loaded {len(self.urls)} live nodes")
+
+    def _add(self, url, last_seen):
+        if url not in self.last_seen:
+            self.positions[url] = len(self.urls)
+            self.urls.append(url)
+        self.last_seen[url] = last_seen
+
+    def _remove(self, url):
+        # Swap with the last url so removal stays O(1)
+        position = self.positions.pop(url)
+        last = self.urls.pop()
+        if last != url:
+            self.urls[position] = last
+            self.positions[last] = position
+        del self.last_seen[url]
+
+    def heartbeat(self, url):
+        """
+        Register a node, or refresh it if it is already known
+        :param url: <str> URL of the node
+        :return: <bool> True if the node is new
+        """
+        with self.lock:
+            new = url not in self.last_seen
+            self._add(url, time())
+            self.dirty.add(url)
+            self.removed.discard(url)
+            return new
+
+    def alive(self, url, now):
+        return now - self.last_seen[url] <= self.ttl
+
+    def sample(self, k=REGISTRY_SAMPLE_SIZE, exclude=None):
+        """
+        A random sample of live nodes
+        :param k: <int> Size of the sample
+        :param exclude: (Optional) <str> The asking node, left out of the sample
+        :return: <list> URLs
+        """
+        now = time()
+        with self.lock:
+            candidates = random.sample(self.urls, min(len(self.urls), k + 1))
+            return [url for url in candidates if url != exclude and self.alive(url, now)][:k]
+
+    def page(self, start, limit):
+        now = time()
+        with self.lock:
+            return [url for url in self.urls[start:start + limit] if self.alive(url, now)]
+
+    def __len__(self):
+        return len(self.urls)
+
+    def expire(self):
+        now = time()
+        with self.lock:
+            expired = [url for url in self.urls if not self.alive(url, now)]
+            for url in expired:
+                self._remove(url)
+                self.dirty.discard(url)
+                self.removed.add(url)
+        if expired:
+            logging.info(f"Expired {len(expired)} nodes")
+        return expired
+
+    def flush(self):
+        # Heartbeats are written in one batch, not one transaction per request
+        with self.lock:
+            updates = [(url, self.last_seen[url]) for url in self.dirty]
+            removed = [(url,) for url in self.removed]
+            self.dirty = set()
+            self.removed = set()
+        if updates:
+            self.conn.executemany('INSERT OR REPLACE INTO RegisteredNodes (url, last_seen) VALUES (?, ?)', updates)
+        if removed:
+            self.conn.executemany('DELETE FROM RegisteredNodes WHERE url = ?', removed)
+        self.conn.commit()
+
+    def maintain(self):
+        while True:
+            sleep(REGISTRY_FLUSH_SECONDS)
+            try:
+                self.expire()
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error(f"Error saving registrations: {str(e)}")
+
 
 app = Flask(__name__)
-registered_nodes = set()
+registry = NodeRegistry()
 
 @app.route('/register', methods=['POST'])
 def register_node():
@@ -16,17 +139,39 @@ def register_node():
     node = values.get('url')
     if node is None:
         return "Error: Please supply a valid node URL", 400
-    registered_nodes.add(node)
+    registry.heartbeat(node)
     response = {
         'message': 'Node registered successfully',
-        'total_nodes': list(registered_nodes)
+        'total_nodes': len(registry),
+        'peers': registry.sample(exclude=node),
+        'ttl': registry.ttl
     }
     logging.info(f"Registered node: {node}")
     return jsonify(response), 200
 
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    values = request.get_json()
+    node = values.get('url')
+    if node is None:
+        return "Error: Please supply a valid node URL", 400
+    new = registry.heartbeat(node)
+    return jsonify({'registered': new, 'ttl': registry.ttl}), 200
+
 @app.route('/peers', methods=['GET'])
 def get_peers():
-    return jsonify(list(registered_nodes)), 200
+    if 'start' in request.args:
+        start = max(request.args.get('start', default=0, type=int), 0)
+        limit = min(request.args.get('limit', default=REGISTRY_SAMPLE_SIZE, type=int), REGISTRY_MAX_SAMPLE)
+        return jsonify(registry.page(start, limit)), 200
+    size = min(request.args.get('sample', default=REGISTRY_SAMPLE_SIZE, type=int), REGISTRY_MAX_SAMPLE)
+    return jsonify(registry.sample(size, exclude=request.args.get('exclude'))), 200
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001)  # Run on a different port from your main application
+    parser = ArgumentParser()
+    parser.add_argument('-p', '--port', default=5001, type=int, help='port to listen on, a different one from your nodes')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    args = parser.parse_args()
+
+    threading.Thread(target=registry.maintain, daemon=True).start()
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,151 @@
+'''
+This is a small scheduler for the node's background jobs (peer refresh, sync checks, mempool expiry, snapshots).
+One daemon thread waits for the next due job and hands it to a worker pool, so a slow job doesn't hold back the others.
+Intervals are jittered so nodes started together don't hit the network in lockstep,
+a failing job backs off exponentially and every job keeps timing stats.
+
+Neetre 2024
+'''
+
+import heapq
+import random
+import logging
+import threading
+from time import monotonic, perf_counter, time
+from concurrent.futures import ThreadPoolExecutor
+from config import SCHEDULER_JITTER, SCHEDULER_MAX_BACKOFF, SCHEDULER_WORKERS
+
+
+class Job:
+    def __init__(self, name, func, interval, jitter=SCHEDULER_JITTER, run_at_start=False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.run_at_start = run_at_start
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.last_time = None
+        self.last_run = None
+        self.last_error = None
+        self.next_run = None
+
+    def next_delay(self):
+        if self.consecutive_failures:
+            delay = min(self.interval * 2 ** self.consecutive_failures, SCHEDULER_MAX_BACKOFF)
+        else:
+            delay = self.interval
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def to_dict(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'running': self.running,
+            'last_run': self.last_run,
+            'last_time': self.last_time,
+            'mean_time': self.total_time / self.runs if self.runs else None,
+            'max_time': self.max_time,
+            'last_error': self.last_error,
+        }
+
+
+class Scheduler:
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.jobs = {}
+        self.queue = []  # (due, name)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.thread = None
+
+    def add_job(self, name, func, interval, jitter=SCHEDULER_JITTER, run_at_start=False):
+        """
+        Register a job
+        :param name: <str> Unique name of the job
+        :param func: <callable> Called with no arguments
+        :param interval: <float> Seconds between runs, None for a job that runs once at start
+        :param jitter: <float> Fraction of the interval the delay can vary by
+        :param run_at_start: <bool> Run once as soon as the scheduler starts
+        """
+        job = Job(name, func, interval, jitter, run_at_start or interval is None)
+        with self.lock:
+            self.jobs[name] = job
+            if self.thread is not None:
+                self._schedule(job, 0 if job.run_at_start else job.next_delay())
+        self.wakeup.set()
+        return job
+
+    def _schedule(self, job, delay):
+        job.next_run = monotonic() + delay
+        heapq.heappush(self.queue, (job.next_run, job.name))
+
+    def start(self):
+        with self.lock:
+            for job in self.jobs.values():
+                self._schedule(job, 0 if job.run_at_start else job.next_delay())
+        self.thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self, wait=True):
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None and wait:
+            self.thread.join()
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _loop(self):
+        while not self.stopping.is_set():
+            with self.lock:
+                due = []
+                now = monotonic()
+                while self.queue and self.queue[0][0] <= now:
+                    _, name = heapq.heappop(self.queue)
+                    job = self.jobs.get(name)
+                    if job is not None:
+                        due.append(job)
+                timeout = self.queue[0][0] - now if self.queue else None
+
+            for job in due:
+                if job.running:
+                    continue  # still running from last time, it is scheduled again when it ends
+                job.running = True
+                self.executor.submit(self._run, job)
+
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def _run(self, job):
+        start = perf_counter()
+        try:
+            job.func()
+            job.consecutive_failures = 0
+            job.last_error = None
+        except Exception as e:
+            job.failures += 1
+            job.consecutive_failures += 1
+            job.last_error = str(e)
+            logging.error(f"Job {job.name} failed ({job.consecutive_failures} in a row): {str(e)}")
+        finally:
+            elapsed = perf_counter() - start
+            job.runs += 1
+            job.total_time += elapsed
+            job.max_time = max(job.max_time, elapsed)
+            job.last_time = elapsed
+            job.last_run = time()
+            job.running = False
+            if job.interval is not None and not self.stopping.is_set():
+                with self.lock:
+                    self._schedule(job, job.next_delay())
+                self.wakeup.set()
+
+    def stats(self):
+        with self.lock:
+            return {name: job.to_dict() for name, job in self.jobs.items()}
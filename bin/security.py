@@ -5,17 +5,21 @@ Neetre 2024
 '''
 
 import json
+import secrets
+import threading
+import time
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.hazmat.backends import default_backend
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import serialization
 
-import numpy as np
+from config import SIGNING_SESSION_TTL
+from metrics import Counter, Histogram
 
-import data_manager
-from email_sender import send_email
-from email_templates import security_settigs_change_subject, security_settigs_change_body
+SIGNATURE_SECONDS = Histogram('stellanova_signature_verify_seconds', 'Time spent verifying a transaction signature',
+                              buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+SIGNATURES = Counter('stellanova_signatures_verified_total', 'Transaction signatures verified', ('result',))
 
 
 class Security:
@@ -75,6 +79,16 @@ class Security:
         
         return pem, public_key
 
+    @staticmethod
+    def generate_keypair():
+        # Unencrypted key objects, for /generate_keypair and the benchmarks
+        private_key = rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=2048,
+            backend=default_backend()
+        )
+        return private_key, private_key.public_key()
+
     @staticmethod
     def decode_pem(pem_data, password):
         private_key = serialization.load_pem_private_key(
@@ -87,8 +101,12 @@ class Security:
 
     @staticmethod
     def sign_transaction(transaction, pem, password):
-        transaction_bytes = json.dumps(transaction, sort_keys=True).encode("utf-8")
         private_key = Security.decode_pem(pem, password)
+        return Security.sign_with_key(transaction, private_key)
+
+    @staticmethod
+    def sign_with_key(transaction, private_key):
+        transaction_bytes = json.dumps(transaction, sort_keys=True).encode("utf-8")
         signature = private_key.sign(
             transaction_bytes,
             padding.PSS(
@@ -100,6 +118,7 @@ class Security:
         return signature
 
     @staticmethod
+    @SIGNATURE_SECONDS.time()
     def verify_signature(transaction, signature, public_key):
         transaction_bytes = json.dumps(transaction, sort_keys=True).encode("utf-8")
         try:
@@ -112,18 +131,82 @@ class Security:
                 ),
                 hashes.SHA256()
             )
+            SIGNATURES.labels('valid').inc()
             return True
         except:
+            SIGNATURES.labels('invalid').inc()
             return False
 
     # 2FA
     @staticmethod
     def generate_2FA_code():
         # 6 cifers, random
-        code = np.random.randint(100000, 999999)
+        code = 100000 + secrets.randbelow(900000)
         return code
 
 
+class SigningSession:
+    '''
+    Keeps a wallet's private key unlocked in memory, so the expensive
+    PKCS8 decryption is paid once and not for every signature.
+    The key is dropped after `ttl` seconds without use, or on lock().
+    '''
+    def __init__(self, pem, password, ttl=SIGNING_SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._private_key = Security.decode_pem(pem, password)
+        self._last_used = time.monotonic()
+
+    @property
+    def unlocked(self):
+        with self._lock:
+            return self._check_expiry()
+
+    def _check_expiry(self):
+        if self._private_key is None:
+            return False
+        if time.monotonic() - self._last_used > self.ttl:
+            self._private_key = None
+            return False
+        return True
+
+    def _key(self):
+        if not self._check_expiry():
+            raise PermissionError("Signing session is locked, unlock the wallet again")
+        self._last_used = time.monotonic()
+        return self._private_key
+
+    def sign_transaction(self, transaction):
+        with self._lock:
+            private_key = self._key()
+        return Security.sign_with_key(transaction, private_key)
+
+    def sign_transactions(self, transactions):
+        """
+        Sign a batch of transactions with the unlocked key
+        :param transactions: <list> Transactions to sign
+        :return: <list> Signatures, in the same order
+        """
+        with self._lock:
+            private_key = self._key()
+        signatures = [Security.sign_with_key(transaction, private_key) for transaction in transactions]
+        with self._lock:
+            if self._private_key is not None:
+                self._last_used = time.monotonic()
+        return signatures
+
+    def lock(self):
+        # Drop our only reference to the key object; the backend frees the key material
+        with self._lock:
+            self._private_key = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.lock()
+
+
 class ModSecurity:
     def __init__(self, to_email: str, user_id, username: str):
         self.to_email = to_email
@@ -133,6 +216,7 @@ class ModSecurity:
         self.changes = None
 
     def check_account(self):
+        import data_manager  # only the account checks need it, not the node
         old_settings, new_settings = data_manager.search_user(self.user_id)  # probably going to a sql DB or to a search engine
         changes = self.find_changes(old_settings, new_settings)
 
@@ -158,6 +242,8 @@ class ModSecurity:
         self.send_security_email()
 
     def send_security_email(self):
+        from email_sender import send_email
+        from email_templates import security_settigs_change_subject, security_settigs_change_body
         send_email(self.to_email, security_settigs_change_subject, security_settigs_change_body.format(self.username, self.changes))
 
     def MOD(self):
@@ -0,0 +1,54 @@
+'''
+This module runs the node API.
+The development server is fine for testing, the production mode serves the same Flask app with waitress:
+connections are handled by an async I/O loop and responses are buffered, so slow clients don't hold request threads.
+CPU heavy work (proof of work) is handed to a process pool, so it doesn't take the GIL from the threads serving reads.
+
+Neetre 2024
+'''
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from config import SERVER_THREADS, SERVER_CONNECTION_LIMIT, CPU_WORKERS
+
+_cpu_executor = None
+
+
+def cpu_executor():
+    """
+    The process pool for CPU heavy work, created the first time it is needed
+    :return: <ProcessPoolExecutor>
+    """
+    global _cpu_executor
+    if _cpu_executor is None:
+        _cpu_executor = ProcessPoolExecutor(max_workers=CPU_WORKERS)
+    return _cpu_executor
+
+
+def shutdown():
+    global _cpu_executor
+    if _cpu_executor is not None:
+        _cpu_executor.shutdown(wait=False, cancel_futures=True)
+        _cpu_executor = None
+
+
+def serve(app, host='0.0.0.0', port=5000, server='dev', threads=SERVER_THREADS):
+    """
+    Runs the app until it is stopped
+    :param app: <Flask> The node API
+    :param server: <str> 'dev' for Flask's server, 'production' for waitress
+    :param threads: <int> Request threads of the production server
+    """
+    try:
+        if server == 'production':
+            try:
+                from waitress import serve as waitress_serve
+            except ImportError:
+                logging.warning("waitress is not installed, falling back to Flask's development server")
+            else:
+                logging.info(f"Serving on {host}:{port} with waitress, {threads} threads")
+                waitress_serve(app, host=host, port=port, threads=threads, connection_limit=SERVER_CONNECTION_LIMIT)
+                return
+        app.run(host=host, port=port, threaded=True, use_reloader=False)
+    finally:
+        shutdown()
@@ -0,0 +1,425 @@
+'''
+This is a discrete-event simulator of a StellaNova network: hundreds of Blockchain instances in one process,
+joined by simulated links (latency, bandwidth, loss) and driven by a virtual clock, so consensus and propagation
+can be studied at a scale real nodes can't reach on one machine.
+
+Mining is a Poisson process per node: a block takes 16^len(difficulty) hashes on average, so a node with
+hashrate h finds one every 16^len(difficulty) / h seconds. Blocks are built and accepted by the nodes' own
+add_block, valid_chain and replace_chain, and relayed like gossip.py does: a block that extends the tip is
+announced to the neighbours, one that doesn't fit makes the node fetch the sender's Blocks from the fork point on.
+Every node also syncs with a random neighbour every SYNC_CHECK_SECONDS, which heals lost messages.
+
+Measured: fork rate, orphan (stale block) rate, propagation delay to 50/90/100% of the nodes,
+reorgs, and the time the network takes to agree on one tip after the last block. Mining goes on after the
+duration until it does: branches of the same height only resolve when a Block lands on one of them, so the
+report says whether the network was tied when the duration ended and how many Blocks it took to break it.
+
+Usage: python simulator.py --nodes 200 --duration 3600 --difficulty 000000 0000000 --block-size 10 1000
+
+Neetre 2024
+'''
+
+import json
+import heapq
+import random
+import argparse
+import statistics
+from itertools import count, product
+from collections import Counter
+import blockchain as blockchain_module
+from blockchain import Blockchain
+from config import MINING_REWARD, SYNC_CHECK_SECONDS, GOSSIP_FANOUT
+
+CHAIN_REQUEST_BYTES = 100
+
+
+class VirtualClock:
+    '''
+    A queue of callbacks ordered by virtual time, time only moves when the next callback runs
+    '''
+    def __init__(self):
+        self.now = 0.0
+        self.queue = []
+        self.sequence = count()  # keeps callbacks due at the same time in scheduling order
+
+    def schedule(self, delay, callback, *args):
+        heapq.heappush(self.queue, (self.now + delay, next(self.sequence), callback, args))
+
+    def run(self, until, stop=None):
+        """
+        Runs the callbacks due until `until`, or until stop() is True
+        """
+        while self.queue and self.queue[0][0] <= until:
+            self.now, _, callback, args = heapq.heappop(self.queue)
+            callback(*args)
+            if stop is not None and stop():
+                return
+        self.now = until
+
+
+class Link:
+    '''
+    One direction of a connection: messages queue behind each other for the bandwidth, then take the latency
+    '''
+    def __init__(self, clock, rng, latency, bandwidth, loss):
+        """
+        :param latency: <float> Seconds
+        :param bandwidth: <float> Bytes per second
+        :param loss: <float> Probability a message is dropped
+        """
+        self.clock = clock
+        self.rng = rng
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.free_at = 0.0
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, size, callback, *args):
+        """
+        :return: <bool> False if the message was lost
+        """
+        self.sent += 1
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return False
+        self.free_at = max(self.clock.now, self.free_at) + size / self.bandwidth
+        self.clock.schedule(self.free_at - self.clock.now + self.latency, callback, *args)
+        return True
+
+
+# Relative hashrates of the nodes, by name, each takes (nodes, rng)
+MINING_MODELS = {
+    'equal': lambda nodes, rng: [1.0] * nodes,
+    'exponential': lambda nodes, rng: [rng.expovariate(1) for _ in range(nodes)],
+    'pareto': lambda nodes, rng: [rng.paretovariate(1.16) for _ in range(nodes)],  # about 80% of the power on 20% of the nodes
+    'pools': lambda nodes, rng: [20.0 if i < 5 else 1.0 for i in range(nodes)],  # 5 pools with 20 times a solo miner each
+}
+
+
+class Simulator:
+    def __init__(self, nodes=100, degree=GOSSIP_FANOUT, hashrates=None, network_hashrate=50_000_000,
+                 difficulty='0000000', block_size=100, tx_rate=0, latency=0.1, bandwidth=1_250_000, loss=0.0,
+                 sync_seconds=SYNC_CHECK_SECONDS, seed=0):
+        """
+        :param nodes: <int> Number of nodes
+        :param degree: <int> Neighbours each node connects to
+        :param hashrates: (Optional) <list> Relative hashrate of each node, all equal by default, see MINING_MODELS
+        :param network_hashrate: <float> Hashes per second of the whole network
+        :param difficulty: <str> Proof of work difficulty the block times are drawn from
+        :param block_size: <int> Most transactions per block
+        :param tx_rate: <float> Transactions per second sent to random nodes and gossiped,
+                        with 0 every block is full of made up transactions
+        :param latency: <float> Mean one-way latency of a link in seconds, each link gets 0.5 to 1.5 times this
+        :param bandwidth: <float> Bytes per second of a link
+        :param loss: <float> Probability a message is lost
+        :param sync_seconds: <float> Seconds between the syncs of a node with a random neighbour
+        """
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+        self.block_size = block_size
+        self.tx_rate = tx_rate
+        self.sync_seconds = sync_seconds
+        self.draining = False  # after the duration: no new transactions, mining only until one branch wins
+
+        hashrates = hashrates or [1.0] * nodes
+        total = sum(hashrates)
+        hashes_per_block = 16 ** len(difficulty)
+        self.block_rates = [network_hashrate * share / total / hashes_per_block for share in hashrates]
+        self.block_interval = hashes_per_block / network_hashrate
+
+        genesis = {'index': 1, 'timestamp': 0, 'transactions': [], 'proof': 100, 'previous_hash': 1}
+        genesis_hash = Blockchain.hash(genesis)
+        self.blocks = {id(genesis): (genesis, genesis_hash, len(json.dumps(genesis)))}  # id(block) -> (block, hash, bytes)
+        self.nodes = []
+        for i in range(nodes):
+            node = Blockchain(genesis, threaded=False)  # one genesis Block for the whole network, and no writer threads
+            node.listeners.append(lambda event, data, i=i: self.chain_changed(i, event, data))
+            self.nodes.append(node)
+
+        # Each node dials `degree` random others, plus a ring so the network is connected
+        self.neighbours = [set() for _ in range(nodes)]
+        for i in range(nodes):
+            if nodes > 1:
+                self.neighbours[i].add((i + 1) % nodes)
+            for j in self.rng.sample(range(nodes), min(degree, nodes - 1) + 1):
+                if j != i and len(self.neighbours[i]) < degree:
+                    self.neighbours[i].add(j)
+        for i in range(nodes):
+            for j in self.neighbours[i]:
+                self.neighbours[j].add(i)
+        self.neighbours = [sorted(peers) for peers in self.neighbours]
+        self.links = {}
+        for i in range(nodes):
+            for j in self.neighbours[i]:
+                if (i, j) not in self.links:
+                    one_way = latency * self.rng.uniform(0.5, 1.5)
+                    self.links[(i, j)] = Link(self.clock, self.rng, one_way, bandwidth, loss)
+                    self.links[(j, i)] = Link(self.clock, self.rng, one_way, bandwidth, loss)
+
+        self.mined = []  # (hash, index, miner, time)
+        self.arrivals = {}  # hash -> times the Block reached each node
+        self.seen = [{genesis_hash} for _ in range(nodes)]  # hashes each node has had in its chain
+        self.seen_transactions = [set() for _ in range(nodes)]
+        self.transactions = count()
+        self.reorgs = 0
+        self.tips = Counter({genesis_hash: nodes})
+        self.tip_of = [genesis_hash] * nodes
+        self.agreed_at = 0.0  # since when all the nodes have had the same tip, None while they haven't
+        self.in_flight = 0
+        self.mined_in_duration = 0
+        self.split_at_end = (1, 1)  # split() when the duration ended
+
+    # Chain events, from the nodes' listeners
+    def chain_changed(self, i, event, data):
+        node = self.nodes[i]
+        if event == 'block':
+            self.arrived(i, [data])
+        elif event == 'reorg':
+            self.reorgs += 1
+            new_blocks = []
+            for block in reversed(node.chain):
+                if self.blocks[id(block)][1] in self.seen[i]:
+                    break
+                new_blocks.append(block)
+            self.arrived(i, new_blocks)
+        else:
+            return
+        tip = node.tip_hash
+        if tip != self.tip_of[i]:
+            self.tips[self.tip_of[i]] -= 1
+            self.tips[tip] += 1
+            self.tip_of[i] = tip
+            if self.tips[tip] == len(self.nodes):
+                self.agreed_at = self.clock.now
+            else:
+                self.agreed_at = None
+
+    def arrived(self, i, blocks):
+        for block in blocks:
+            block_hash = self.blocks[id(block)][1]
+            self.seen[i].add(block_hash)
+            self.arrivals[block_hash].append(self.clock.now)
+
+    # Messages
+    def send(self, i, j, size, callback, *args):
+        if self.links[(i, j)].send(size, self.delivered, callback, args):
+            self.in_flight += 1
+
+    def delivered(self, callback, args):
+        self.in_flight -= 1
+        callback(*args)
+
+    def relay(self, i, block, exclude=None):
+        _, block_hash, size = self.blocks[id(block)]
+        for j in self.neighbours[i]:
+            if j != exclude:
+                self.send(i, j, size, self.receive_block, j, i, block, block_hash)
+
+    def receive_block(self, i, origin, block, block_hash):
+        # What gossip.accept_block does
+        node = self.nodes[i]
+        if node.get_block_by_hash(block_hash) is not None:
+            return
+        if node.add_block(block):
+            self.relay(i, block, exclude=origin)
+        elif block['index'] > len(node.chain):
+            self.request_chain(i, origin)
+
+    def request_chain(self, i, j):
+        self.send(i, j, CHAIN_REQUEST_BYTES, self.serve_chain, j, i, len(self.nodes[i].chain))
+
+    def serve_chain(self, j, i, height):
+        chain = self.nodes[j].chain
+        if len(chain) <= height:
+            return
+        # Only the Blocks after the last one we have in common cross the link, like a headers-first sync
+        requester = self.nodes[i]
+        fork = len(chain)
+        while fork > 1 and requester.get_block_by_hash(self.blocks[id(chain[fork - 1])][1]) is None:
+            fork -= 1
+        blocks = chain[fork:]
+        size = CHAIN_REQUEST_BYTES + sum(self.blocks[id(block)][2] for block in blocks)
+        self.send(j, i, size, self.receive_chain, i, j, fork, blocks)
+
+    def receive_chain(self, i, origin, fork, blocks):
+        # What chain_sync.sync does with the Blocks of a taller peer
+        node = self.nodes[i]
+        new_chain = node.chain[:fork] + blocks
+        if len(new_chain) > len(node.chain) and node.valid_chain(new_chain[fork - 1:]):
+            node.replace_chain(new_chain)
+            self.relay(i, node.last_block, exclude=origin)
+
+    def receive_transaction(self, i, origin, number, transaction):
+        if number in self.seen_transactions[i]:
+            return
+        self.seen_transactions[i].add(number)
+        self.nodes[i].new_transaction(transaction['sender'], transaction['recipient'], transaction['amount'])
+        size = len(json.dumps(transaction))
+        for j in self.neighbours[i]:
+            if j != origin:
+                self.send(i, j, size, self.receive_transaction, j, i, number, transaction)
+
+    # Workload
+    def mine(self, i):
+        if self.draining and self.split()[1] == 1:
+            return  # one branch is the tallest, relaying and syncing settle the rest
+        node = self.nodes[i]
+        reward = {'sender': '0', 'recipient': f'node{i}', 'amount': MINING_REWARD}
+        if self.tx_rate:
+            transactions = node.mempool.get_transactions(self.block_size - 1)
+        else:
+            transactions = [{'sender': '0', 'recipient': f'user{next(self.transactions)}', 'amount': 1}
+                            for _ in range(self.block_size - 1)]
+        block = {
+            'index': len(node.chain) + 1,
+            'timestamp': self.clock.now,
+            'transactions': transactions + [reward],
+            'proof': self.rng.getrandbits(32),
+            'previous_hash': node.tip_hash,
+        }
+        block_hash = Blockchain.hash(block)
+        self.blocks[id(block)] = (block, block_hash, len(json.dumps(block)))
+        self.arrivals[block_hash] = []
+        self.mined.append((block_hash, block['index'], i, self.clock.now))
+        node.add_block(block)
+        self.relay(i, block)
+        self.clock.schedule(self.rng.expovariate(self.block_rates[i]), self.mine, i)
+
+    def new_transaction(self):
+        if self.draining:
+            return
+        number = next(self.transactions)
+        transaction = {'sender': '0', 'recipient': f'user{number}', 'amount': 1}
+        self.receive_transaction(self.rng.randrange(len(self.nodes)), None, number, transaction)
+        self.clock.schedule(self.rng.expovariate(self.tx_rate), self.new_transaction)
+
+    def split(self):
+        """
+        :return: <tuple> (distinct tips, tips of the tallest chains) among the nodes
+        """
+        best = max(len(node.chain) for node in self.nodes)
+        return len(set(self.tip_of)), len({self.tip_of[i] for i, node in enumerate(self.nodes) if len(node.chain) == best})
+
+    def sync(self, i):
+        self.request_chain(i, self.rng.choice(self.neighbours[i]))
+        self.clock.schedule(self.sync_seconds, self.sync, i)
+
+    # Running
+    def run(self, duration, drain=None):
+        """
+        Mines for `duration` virtual seconds, then lets the network settle for up to `drain` seconds,
+        still mining while the nodes are on different tips
+        :return: <dict> The measurements, see report()
+        """
+        drain = drain if drain is not None else max(10 * self.block_interval, self.sync_seconds * 2)
+        saved = blockchain_module.PROOF_OF_WORK_DIFFICULTY
+        blockchain_module.PROOF_OF_WORK_DIFFICULTY = ''  # block times come from the clock, every proof passes
+        try:
+            for i, rate in enumerate(self.block_rates):
+                if rate > 0:
+                    self.clock.schedule(self.rng.expovariate(rate), self.mine, i)
+                self.clock.schedule(self.rng.uniform(0, self.sync_seconds), self.sync, i)
+            if self.tx_rate:
+                self.clock.schedule(self.rng.expovariate(self.tx_rate), self.new_transaction)
+            self.clock.run(duration)
+            self.draining = True
+            self.mined_in_duration = len(self.mined)
+            self.split_at_end = self.split()
+            self.clock.run(duration + drain, stop=lambda: self.agreed_at is not None and not self.in_flight)
+        finally:
+            blockchain_module.PROOF_OF_WORK_DIFFICULTY = saved
+        return self.report(duration)
+
+    def report(self, duration):
+        nodes = len(self.nodes)
+        # The longest chain is the one the network settles on, or would
+        best = max(self.nodes, key=lambda node: len(node.chain))
+        canonical = {self.blocks[id(block)][1] for block in best.chain[1:]}
+        heights = Counter(index for _, index, _, _ in self.mined)
+        stale = sum(1 for block_hash, _, _, _ in self.mined if block_hash not in canonical)
+
+        reached = {share: [] for share in (0.5, 0.9, 1.0)}
+        for block_hash, _, _, mined_at in self.mined:
+            times = sorted(self.arrivals[block_hash])
+            for share in reached:
+                needed = max(1, int(share * nodes + 0.5))
+                if len(times) >= needed:
+                    reached[share].append(times[needed - 1] - mined_at)
+
+        def summary(values):
+            if not values:
+                return None
+            values = sorted(values)
+            return {'median': statistics.median(values), 'p90': values[int(0.9 * (len(values) - 1))], 'max': values[-1]}
+
+        # Measured from the last Block of the duration, so Blocks that broke a tie count in the time it took
+        last_mined = self.mined[self.mined_in_duration - 1][3] if self.mined_in_duration else 0
+        tips, tallest = self.split()
+        links = self.links.values()
+        return {
+            'nodes': nodes,
+            'virtual_seconds': duration,
+            'block_interval': self.block_interval,
+            'blocks_mined': len(self.mined),
+            'height': len(best.chain),
+            'fork_rate': sum(1 for mined in heights.values() if mined > 1) / len(heights) if heights else 0,
+            'orphan_rate': stale / len(self.mined) if self.mined else 0,
+            'reorgs': self.reorgs,
+            'propagation': {f'{int(share * 100)}%': summary(times) for share, times in reached.items()},
+            'converged': self.agreed_at is not None,
+            'time_to_convergence': max(0.0, self.agreed_at - last_mined) if self.agreed_at is not None else None,
+            'tied': self.split_at_end[1] > 1,  # tallest branches of the same height when the duration ended
+            'tiebreak_blocks': len(self.mined) - self.mined_in_duration,
+            'tips': tips,
+            'still_tied': tallest > 1,  # not converged because no Block broke the tie during the drain
+            'messages': sum(link.sent for link in links),
+            'messages_lost': sum(link.dropped for link in links),
+        }
+
+
+def print_report(results):
+    print(f"\n{'difficulty':>10} {'block size':>10} {'interval s':>10} {'mined':>6} {'fork %':>7} {'orphan %':>8} "
+          f"{'reorgs':>6} {'p50 to 90%':>10} {'p90 to 90%':>10} {'converge s':>10} {'tie':>4}")
+    for (difficulty, block_size), result in results:
+        to_90 = result['propagation']['90%'] or {}
+        converge = result['time_to_convergence']
+        converge = f'{converge:.1f}' if converge is not None else 'tied' if result['still_tied'] else 'no'
+        tie = f"+{result['tiebreak_blocks']}" if result['tied'] else '-'
+        print(f"{difficulty:>10} {block_size:>10} {result['block_interval']:>10.1f} {result['blocks_mined']:>6} "
+              f"{result['fork_rate']:>7.1%} {result['orphan_rate']:>8.1%} {result['reorgs']:>6} "
+              f"{to_90.get('median', float('nan')):>10.3f} {to_90.get('p90', float('nan')):>10.3f} "
+              f"{converge:>10} {tie:>4}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', default=100, type=int, help='nodes in the network')
+    parser.add_argument('--degree', default=GOSSIP_FANOUT, type=int, help='neighbours per node')
+    parser.add_argument('--duration', default=3600, type=float, help='virtual seconds of mining')
+    parser.add_argument('--difficulty', default=['0000000'], nargs='+', help='one or more proof of work difficulties')
+    parser.add_argument('--block-size', default=[100], type=int, nargs='+', help='one or more transactions per block')
+    parser.add_argument('--hashrate', default=50_000_000, type=float, help='hashes per second of the whole network')
+    parser.add_argument('--mining', default='equal', choices=sorted(MINING_MODELS), help='how the hashrate is spread over the nodes')
+    parser.add_argument('--tx-rate', default=0, type=float, help='gossiped transactions per second, 0 fills every block')
+    parser.add_argument('--latency', default=0.1, type=float, help='mean one-way link latency in seconds')
+    parser.add_argument('--bandwidth', default=1_250_000, type=float, help='link bandwidth in bytes per second')
+    parser.add_argument('--loss', default=0.0, type=float, help='probability a message is lost')
+    parser.add_argument('--sync-seconds', default=SYNC_CHECK_SECONDS, type=float, help='seconds between the syncs of a node')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default=None, help='write the results as JSON here')
+    args = parser.parse_args()
+
+    results = []
+    for difficulty, block_size in product(args.difficulty, args.block_size):
+        hashrates = MINING_MODELS[args.mining](args.nodes, random.Random(args.seed))
+        simulator = Simulator(args.nodes, args.degree, hashrates, args.hashrate, difficulty, block_size, args.tx_rate,
+                              args.latency, args.bandwidth, args.loss, args.sync_seconds, args.seed)
+        results.append(((difficulty, block_size), simulator.run(args.duration)))
+        print(f"difficulty {difficulty}, {block_size} transactions per block: {json.dumps(results[-1][1])}")
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump([{'difficulty': difficulty, 'block_size': block_size, **result}
+                       for (difficulty, block_size), result in results], file, indent=2)
@@ -1,13 +1,20 @@
 import os
-from twilio.rest import Client
 
 FROM_SMS = os.environ.get("FROM_SMS")
 ACCOUNT_SID = os.environ.get("ACCOUNT_SID")
 AUTH_TOKEN = os.environ.get("AUTH_TOKEN")
-client = Client(ACCOUNT_SID, AUTH_TOKEN)
+_client = None
+
+def get_client():
+    # Twilio is imported and the client built only when the first SMS is sent
+    global _client
+    if _client is None:
+        from twilio.rest import Client
+        _client = Client(ACCOUNT_SID, AUTH_TOKEN)
+    return _client
 
 def send_sms(to_sms, code):
-    message = client.messages.create(
+    message = get_client().messages.create(
         to = to_sms,
         from_ = FROM_SMS,
         body = f"{code} is your 2FA code"
@@ -0,0 +1,159 @@
+'''
+Tests of chain_state.py: the chain views, the layered balances and the chain writer.
+
+Usage: python -m unittest discover tests
+
+Neetre 2024
+'''
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+from chain_state import Balances, ChainView, ChainWriter
+
+
+class ChainViewTest(unittest.TestCase):
+    def setUp(self):
+        self.blocks = list(range(10))
+        self.view = ChainView(self.blocks, 6)
+
+    def test_only_the_first_height_blocks_show(self):
+        self.blocks.append(10)  # the writer appending after the view was made
+        self.assertEqual(len(self.view), 6)
+        self.assertEqual(list(self.view), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(self.view[-1], 5)
+        with self.assertRaises(IndexError):
+            self.view[6]
+        with self.assertRaises(IndexError):
+            self.view[-7]
+
+    def test_slices_match_a_list_of_the_same_blocks(self):
+        expected = self.blocks[:6]
+        for i in (slice(None), slice(2, 4), slice(-3, None), slice(None, -1), slice(4, 100), slice(None, None, 2),
+                  slice(None, None, -1), slice(4, None, -1), slice(4, -1, -1), slice(-1, 0, -2), slice(100, None, -1)):
+            self.assertEqual(self.view[i], expected[i], i)
+
+
+class BalancesTest(unittest.TestCase):
+    def test_no_changes_is_the_same_mapping(self):
+        balances = Balances({'a': 1})
+        self.assertIs(balances.changed({}, {'a': 1}), balances)
+
+    def test_changes_are_layered_over_an_unchanged_base(self):
+        current = {account: 10 for account in 'abcdefgh'}
+        base = Balances(dict(current))
+        current['a'] = 5
+        current['i'] = 1
+        balances = base.changed({'a': 5, 'i': 1}, current)
+        self.assertIs(balances.base, base.base)
+        self.assertEqual(dict(balances), current)
+        self.assertEqual(base['a'], 10)  # the older mapping doesn't change
+        self.assertNotIn('i', base)
+
+    def test_layers_are_folded_into_a_new_base(self):
+        current = {account: 0 for account in range(100)}
+        balances = Balances(dict(current))
+        first_base = balances.base
+        for account in range(60):
+            current[account] = account
+            balances = balances.changed({account: account}, current)
+            # Layers of similar size are merged: a handful, not one per change
+            self.assertLessEqual(len(balances.layers), 7)
+            self.assertEqual(dict(balances), current)
+        # Folded once half as many accounts as the base has were written to the layers
+        self.assertIsNot(balances.base, first_base)
+        self.assertIsNot(balances.base, current)  # a copy, the writer goes on changing its dict
+        self.assertLess(balances.layered, 50)
+        self.assertEqual(len(balances), 100)
+
+
+class ChainWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.published = []
+        self.writer = ChainWriter(lambda: self.published.append(len(self.published)))
+
+    def tearDown(self):
+        self.writer.stop(timeout=5)
+
+    def test_changes_run_on_the_writer_in_order(self):
+        applied = []
+
+        def change(i):
+            applied.append((i, threading.current_thread().name))
+            return i * 2
+        self.assertEqual([self.writer.submit(change, i) for i in range(5)], [0, 2, 4, 6, 8])
+        self.assertEqual(applied, [(i, 'chain-writer') for i in range(5)])
+        self.assertEqual(self.writer.stats()['applied'], 5)
+
+    def test_changes_waiting_together_are_one_batch(self):
+        started, release = threading.Event(), threading.Event()
+
+        def blocking():
+            started.set()
+            release.wait(5)
+        first = threading.Thread(target=self.writer.submit, args=(blocking,))
+        first.start()
+        started.wait(5)
+        results = []
+        others = [threading.Thread(target=lambda i=i: results.append(self.writer.submit(lambda: i))) for i in range(20)]
+        for thread in others:
+            thread.start()
+        while self.writer.queue.qsize() < 20:
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in [first] + others:
+            thread.join(5)
+        self.assertEqual(sorted(results), list(range(20)))
+        self.assertEqual(self.writer.stats(), {'applied': 21, 'batches': 2, 'queued': 0})
+        self.assertEqual(len(self.published), 2)  # once per batch, not per change
+
+    def test_an_exception_reaches_the_caller_and_the_writer_goes_on(self):
+        def failing():
+            raise ValueError('stale tip')
+        with self.assertRaises(ValueError):
+            self.writer.submit(failing)
+        self.assertEqual(self.writer.submit(lambda: 'next'), 'next')
+        self.assertTrue(self.writer.thread.is_alive())
+
+    def test_a_failing_publish_doesnt_stop_the_writer(self):
+        def publish():
+            raise RuntimeError('publish failed')
+        writer = ChainWriter(publish)
+        try:
+            with self.assertLogs(level='ERROR') as logs:
+                self.assertEqual(writer.submit(lambda: 1), 1)
+                self.assertEqual(writer.submit(lambda: 2), 2)
+            self.assertEqual(len(logs.records), 2)
+        finally:
+            writer.stop(timeout=5)
+
+    def test_a_change_made_by_a_change_runs_inline(self):
+        self.assertEqual(self.writer.submit(lambda: self.writer.submit(lambda: 'nested')), 'nested')
+
+    def test_stop_ends_the_thread_and_refuses_later_changes(self):
+        self.writer.submit(lambda: None)
+        thread = self.writer.thread
+        self.writer.stop(timeout=5)
+        self.assertFalse(thread.is_alive())
+        with self.assertRaises(RuntimeError):
+            self.writer.submit(lambda: None)
+
+    def test_without_a_thread_the_caller_applies_and_publishes(self):
+        writer = ChainWriter(lambda: self.published.append(len(self.published)), threaded=False)
+        caller = threading.current_thread().name
+        self.assertEqual(writer.submit(lambda: threading.current_thread().name), caller)
+        self.assertEqual(writer.submit(lambda: writer.submit(lambda: 'nested')), 'nested')
+        self.assertIsNone(writer.thread)
+        self.assertEqual(len(self.published), 2)
+        self.assertEqual(writer.stats(), {'applied': 2, 'batches': 2, 'queued': 0})
+        writer.stop()
+        with self.assertRaises(RuntimeError):
+            writer.submit(lambda: None)
+
+
+if __name__ == '__main__':
+    unittest.main()